@@ -0,0 +1,198 @@
+import os
+import random
+import re
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable
+
+from context import current_context
+
+# simulated backends: after backends.use(SimulatedBackend()), Execute mode runs against models
+# instead of people, machines and instruments, so a virtual experiment of any size can be
+# pushed through it end to end to see how fast it writes its sheets, how the engine schedules
+# it and how much memory it takes.
+#
+# everything Execute mode asks the operator and every program it runs goes through
+# engine.py's blocking_input and blocking_check_output (journal.ask and run_command in library
+# code), and with a backend in use, those go to the backend instead:
+#   - a measurement (ask(..., about=("measure", measurement, obj))) is answered by the
+#     measurement's entry in RESPONSE_MODELS, from the settings the object was made with, so
+#     readings (and their noise) follow the settings;
+#   - a prompt for a file (about=("file", ".stl")) gets a placeholder file;
+#   - slicers get a sliced placeholder back, and other programs no output;
+#   - anything else is confirmed ("y" to yes/no questions).
+# fab() on the Laser, Printer and KnittingMachine takes the machine's latency instead of
+# running the machine (they each call machine_job), and Environment's waits are skipped.
+# latencies are in seconds, by machine, measurement name, "operator" and "software"; they're
+# all 0 unless asked for, and with concurrent=True, branches wait on them side by side.
+
+LATENCY_SECONDS: dict[str, float] = {}
+
+
+def _number(value, default: float) -> float:
+    # "0.4", "50%", "3.0mm" -> 0.4, 50., 3.
+    found = re.match(r"\s*(-?\d+(\.\d+)?)", str(value)) if value is not None else None
+    return float(found.group(1)) if found else default
+
+
+@dataclass
+class ResponseModel:
+    """A numeric reading: mean(settings), plus gaussian noise with standard deviation
+    noise(settings); either can be a constant."""
+    mean: float | Callable[[dict], float]
+    noise: float | Callable[[dict], float] = 0.
+    digits: int = 2
+
+    def __call__(self, settings: dict, rng: random.Random) -> str:
+        mean = self.mean(settings) if callable(self.mean) else self.mean
+        noise = self.noise(settings) if callable(self.noise) else self.noise
+        return str(round(rng.gauss(mean, noise), self.digits))
+
+
+SLICER_FLAGS = {"layer_height": "--layer-height", "infill_density": "--fill-density", "nozzle": "--nozzle-diameter"}
+
+
+def _setting(settings: dict, name: str, default: float) -> float:
+    # a fab() argument, or the slicer flag it became (the gcode's metadata has '--layer-height')
+    value = settings.get(name, settings.get(SLICER_FLAGS.get(name)))
+    return _number(value, default)
+
+
+def _infill(settings: dict) -> float:
+    return _setting(settings, "infill_density", 50.) / 100
+
+
+def _layer(settings: dict) -> float:
+    return _setting(settings, "layer_height", .4)
+
+
+def _walls(settings: dict) -> float:
+    if "wall_thickness" not in settings and "--perimeters" in settings:
+        return _number(settings["--perimeters"], 3.) * _setting(settings, "nozzle", .4)
+    return _setting(settings, "wall_thickness", 1.2)
+
+
+def _charring(settings: dict) -> float:
+    # how much energy the laser put in, relative to its defaults
+    return _setting(settings, "cut_power", 100.) / max(_setting(settings, "cut_speed", 100.), 1.)
+
+
+def _yes_or_no(chance: float):
+    return lambda settings, rng: "yes" if rng.random() < chance else "no"
+
+
+# by Measurement name: function(settings of the object, random.Random) -> the reading
+RESPONSE_MODELS: dict[str, Callable[[dict, random.Random], str]] = {
+    "resistance": ResponseModel(lambda s: 800 / _charring(s), lambda s: 40 + 20 / _charring(s), 0),
+    "current": ResponseModel(.05, .002, 4),
+    "size": ResponseModel(20., lambda s: .05 + .2 * _layer(s), 2),
+    "angle": ResponseModel(90., lambda s: .2 + 2 * _layer(s), 1),
+    "force": ResponseModel(lambda s: 40 + 160 * _infill(s) + 20 * _walls(s),
+                           lambda s: 5 + 10 * _layer(s), 1),
+    "airspeed": ResponseModel(2., .1, 2),
+    "pressure": ResponseModel(101.3, .4, 1),
+    "weight": ResponseModel(lambda s: 2 + 10 * _infill(s), lambda s: .05 + .1 * _layer(s), 2),
+    "time elapsed": ResponseModel(30., 5., 1),
+    "true or false": _yes_or_no(.8),
+    "human judgement": _yes_or_no(.8),
+    "photograph": lambda settings, rng: "photograph.jpg",
+    "geometry scan": lambda settings, rng: "scan.stl",
+}
+DEFAULT_MODEL = ResponseModel(1., .05, 3)
+
+
+def settings_of(obj) -> dict:
+    """Everything obj was made with, including what went into the objects it was made from."""
+    from design import VirtualWorldObject
+    from fabricate import RealWorldObject
+    settings = {}
+    for key, value in obj.metadata.items():
+        if isinstance(value, (RealWorldObject, VirtualWorldObject)) and value is not obj:
+            settings.update(settings_of(value))
+        elif isinstance(value, dict):
+            settings.update(value)
+        else:
+            settings[key] = value
+    return settings
+
+
+class SimulatedBackend:
+    """Answers Execute mode from models; see the top of backends.py."""
+
+    def __init__(self, models: dict | None = None, latency: dict[str, float] | None = None, seed: int = 0,
+                 directory: str = "fedt_simulated"):
+        self.models = dict(RESPONSE_MODELS, **(models or {}))
+        self.latency = dict(LATENCY_SECONDS, **(latency or {}))
+        self.random = random.Random(seed)
+        self.directory = directory
+        self.calls = Counter() # what it was asked to do, by kind
+        self.files: dict[tuple[str, str], str] = {} # (suffix, contents) -> placeholder
+
+    def _wait(self, *names: str):
+        seconds = next((self.latency[x] for x in names if x in self.latency), 0.)
+        if seconds > 0:
+            from engine import blocking_wait_until
+            blocking_wait_until(datetime.now() + timedelta(seconds=seconds))
+
+    def _file(self, suffix: str, contents: str = "") -> str:
+        # files with the same contents are the same placeholder, so a big run doesn't write a file per object
+        path = self.files.get((suffix, contents))
+        if path is None:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"simulated-{len(self.files) + 1}{suffix}")
+            with open(path, "w") as f:
+                f.write(contents)
+            self.files[(suffix, contents)] = path
+        return path
+
+    def measure(self, measurement, obj) -> str:
+        self.calls["measure"] += 1
+        self._wait(measurement.name, "operator")
+        reading = self.models.get(measurement.name, DEFAULT_MODEL)(settings_of(obj), self.random)
+        if reading.endswith((".jpg", ".stl")):
+            reading = self._file(os.path.splitext(reading)[1])
+        return reading
+
+    def ask(self, prompt: str, about: tuple | None = None) -> str:
+        if about is not None and about[0] == "measure":
+            return self.measure(about[1], about[2])
+        if about is not None and about[0] == "file":
+            self.calls["file"] += 1
+            self._wait("operator")
+            return self._file(about[1])
+        self.calls["prompt"] += 1
+        self._wait("operator")
+        return "y" if "[y/n]" in prompt else ""
+
+    def run(self, command: list[str]) -> bytes:
+        self.calls["software"] += 1
+        self._wait("software")
+        command = [str(x) for x in command]
+        if "--export-gcode" in command:
+            settings = " ".join(command[1:command.index("--export-gcode")])
+            path = self._file(".gcode", f"; sliced by a simulated slicer with {settings}\nG28\n")
+            return f"Slicing result exported to {path}\n".encode()
+        return b""
+
+    def machine_job(self, device: type, settings: dict):
+        self.calls[device.__name__] += 1
+        self._wait(device.__name__)
+
+
+def use(backend: SimulatedBackend | None):
+    """Runs Execute mode against backend from now on (None for the real world again)."""
+    current_context().backend = backend
+
+
+def machine_job(device: type, settings: dict, run: Callable[[], object] | None = None):
+    # called by each fab() where its machine does the job: run() drives the real machine (through
+    # the journal, like any machine software), and in Execute mode a simulated one takes its time instead
+    from control import Execute
+    from journal import replaying
+    context = current_context()
+    if context.backend is None:
+        if run is not None:
+            run()
+    elif isinstance(context.mode, Execute) and not replaying():
+        context.backend.machine_job(device, settings)
@@ -0,0 +1,292 @@
+import json
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# the operator console: with @fedt_experiment(console=True), Execute mode doesn't ask its
+# questions on the terminal it was started from. every prompt (an instruction to confirm, a
+# measurement to enter, a file to point at) becomes a task on a small web page served on
+# localhost, and the experiment waits for the task's answer instead of stdin. with
+# concurrent=True (see engine.py), every Parallel iteration's tasks are up at once, so several
+# operators can each claim tasks from their own browser and work through them side by side.
+#
+# tasks are tagged with the station they're done at (see station()): the laser, the printer,
+# the measurement bench, ... and the page can be filtered to one, e.g. /?station=laser. a step
+# that several iterations are waiting on with the same wording ("ensure visicut is open") is
+# one task for all of them, as long as nobody has claimed it yet.
+#
+# the page polls a JSON API, which scripts can use too:
+#   GET  /tasks[?station=...]    the tasks that haven't been done
+#   POST /tasks/<id>/claim       {"operator": "sam"}; 409 if someone else has it
+#   POST /tasks/<id>/complete    {"operator": "sam", "answer": "12.5"}
+# answers go through the journal like typed ones, if there is one. POSTs have to be JSON
+# (Content-Type: application/json) and, from a browser, come from the console's own page, and
+# every request has to name the console's host, so other web pages can't drive it.
+
+CONSOLE_PORT = 8765
+
+STATIONS = {"Laser": "laser", "Printer": "printer", "KnittingMachine": "knitting machine"}
+
+
+def station(about: tuple | None) -> str:
+    """Where the operator goes to do what a prompt asks, from what it's about (see engine.py)."""
+    if about is None:
+        return "general"
+    if about[0] in ("measure", "sheet"):
+        return "measurement bench"
+    if about[0] == "file":
+        return "computer"
+    from measurement import Measurement
+    device = about[1] if len(about) > 1 else None
+    name = getattr(device, "__name__", None)
+    if name in STATIONS:
+        return STATIONS[name]
+    if device is not None and any(isinstance(x, Measurement) for x in vars(device).values()):
+        return "measurement bench" # an instrument, like the Calipers
+    return "general"
+
+
+def classify(about: tuple | None, shared: bool) -> tuple[str, str, str]:
+    """A prompt's station, its kind (measurement, file, instruction or question) and the name
+    of the device it's for ("" if none), from what it's about; metrics.py sorts prompts by
+    these too."""
+    if about is not None and about[0] in ("measure", "sheet"):
+        kind = "measurement"
+    elif about is not None and about[0] == "file":
+        kind = "file"
+    elif shared or (about is not None and about[0] == "instruction"):
+        kind = "instruction" # just to be done and confirmed
+    else:
+        kind = "question"
+    device = about[1] if about is not None and about[0] == "instruction" else None
+    return station(about), kind, getattr(device, "__name__", "")
+
+
+@dataclass
+class Task:
+    id: int
+    text: str
+    station: str
+    kind: str # measurement, file, instruction or question (see classify())
+    shared: bool
+    branches: list[str] = field(default_factory=list)
+    answers: list[Future] = field(default_factory=list) # one per prompt waiting on it
+    posted: str = field(default_factory=lambda: datetime.now().isoformat(timespec="seconds"))
+    claimed_by: str | None = None
+
+    def as_json(self) -> dict:
+        return {"id": self.id, "text": self.text, "station": self.station, "kind": self.kind,
+                "branches": self.branches, "posted": self.posted, "claimed_by": self.claimed_by}
+
+
+class OperatorConsole:
+    """The tasks waiting for an operator, and the HTTP server that hands them out."""
+
+    def __init__(self, port: int = CONSOLE_PORT, host: str = "127.0.0.1"):
+        self.tasks: dict[int, Task] = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+        class Handler(_Handler):
+            console = self
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        port = self.server.server_address[1]
+        self.url = f"http://{host}:{port}/"
+        # what the Host header can say (anything else is DNS rebinding), and where a browser's POSTs can come from
+        self.hosts = {f"{name}:{port}" for name in (host, "127.0.0.1", "localhost")}
+        self.origins = {f"http://{x}" for x in self.hosts}
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fedt-console", daemon=True)
+        self.thread.start()
+        print(f"operator console at {self.url}")
+
+    def post(self, text: str, branch: str = "", shared: bool = False, about: tuple | None = None) -> Future:
+        """A new task (or, for a shared prompt, the same one as an unclaimed task with the same
+        text), and the Future its answer will be set on."""
+        answer = Future()
+        where, kind, _ = classify(about, shared)
+        with self.lock:
+            task = None
+            if shared:
+                task = next((x for x in self.tasks.values()
+                             if x.shared and x.claimed_by is None and x.text == text and x.station == where), None)
+            if task is None:
+                task = Task(self.next_id, text, where, kind, shared)
+                self.tasks[task.id] = task
+                self.next_id += 1
+            if branch:
+                task.branches.append(branch.rstrip("/"))
+            task.answers.append(answer)
+        return answer
+
+    def pending(self, where: str | None = None) -> list[dict]:
+        with self.lock:
+            return [x.as_json() for x in self.tasks.values() if where is None or x.station == where]
+
+    def claim(self, task_id: int, operator: str) -> bool:
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None or task.claimed_by not in (None, operator):
+                return False
+            task.claimed_by = operator
+            return True
+
+    def complete(self, task_id: int, operator: str, answer: str) -> bool:
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None or task.claimed_by not in (None, operator):
+                return False
+            del self.tasks[task_id]
+        for x in task.answers:
+            x.set_result(answer)
+        return True
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            left = list(self.tasks.values())
+            self.tasks.clear()
+        for task in left:
+            for x in task.answers:
+                if not x.done():
+                    x.set_exception(RuntimeError(f"the operator console closed before {task.text!r} was done"))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    console: OperatorConsole = None
+
+    def log_message(self, format, *args):
+        pass # the terminal is for the experiment
+
+    def _send(self, status: int, body: str, content_type: str = "application/json"):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _allowed(self, posting: bool = False) -> bool:
+        # a request for this console by name, and for a POST, JSON from its own page (or a script)
+        if self.headers.get("Host") not in self.console.hosts:
+            self._send(403, json.dumps({"error": "wrong host"}))
+        elif posting and self.headers.get("Origin") not in (None, *self.console.origins):
+            self._send(403, json.dumps({"error": "wrong origin"}))
+        elif posting and self.headers.get("Content-Type", "").split(";")[0].strip() != "application/json":
+            self._send(415, json.dumps({"error": "the body should be JSON, with Content-Type: application/json"}))
+        else:
+            return True
+        return False
+
+    def do_GET(self):
+        if not self._allowed():
+            return
+        url = urlparse(self.path)
+        if url.path == "/":
+            self._send(200, PAGE, "text/html")
+        elif url.path == "/tasks":
+            where = parse_qs(url.query).get("station", [None])[0]
+            self._send(200, json.dumps(self.console.pending(where)))
+        else:
+            self._send(404, json.dumps({"error": "no such page"}))
+
+    def do_POST(self):
+        if not self._allowed(posting=True):
+            return
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if len(parts) != 3 or parts[0] != "tasks" or not parts[1].isdigit() or parts[2] not in ("claim", "complete"):
+            self._send(404, json.dumps({"error": "no such page"}))
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "{}")
+        except ValueError:
+            self._send(400, json.dumps({"error": "the body should be JSON"}))
+            return
+        operator = str(body.get("operator") or "operator")
+        if parts[2] == "claim":
+            done = self.console.claim(int(parts[1]), operator)
+        else:
+            done = self.console.complete(int(parts[1]), operator, str(body.get("answer", "")))
+        if done:
+            self._send(200, json.dumps({"ok": True}))
+        else:
+            self._send(409, json.dumps({"error": "that task is done or someone else has it"}))
+
+
+PAGE = """<!doctype html>
+<html><head><meta charset="utf-8"><title>FEDT operator console</title>
+<style>
+body { font-family: sans-serif; margin: 2em; }
+.task { border: 1px solid #ccc; padding: .6em; margin: .5em 0; }
+.station { font-weight: bold; margin-right: .5em; }
+.mine { border-color: #2a7; }
+.theirs { opacity: .5; }
+</style></head>
+<body>
+<h1>FEDT operator console</h1>
+<p>your name: <input id="operator"> station: <input id="station" placeholder="all"></p>
+<div id="tasks"></div>
+<script>
+const params = new URLSearchParams(location.search);
+const me = document.getElementById("operator");
+const where = document.getElementById("station");
+me.value = localStorage.getItem("fedt-operator") || "";
+me.onchange = () => localStorage.setItem("fedt-operator", me.value);
+where.value = params.get("station") || "";
+const typed = {};
+
+async function post(id, what, body) {
+  body.operator = me.value || "operator";
+  const response = await fetch(`/tasks/${id}/${what}`,
+                               {method: "POST", headers: {"Content-Type": "application/json"}, body: JSON.stringify(body)});
+  if (!response.ok) alert((await response.json()).error);
+  refresh();
+}
+
+function render(task) {
+  const div = document.createElement("div");
+  const mine = task.claimed_by === (me.value || "operator");
+  div.className = "task" + (mine ? " mine" : task.claimed_by ? " theirs" : "");
+  const branches = task.branches.length ? ` [${task.branches.join(", ")}]` : "";
+  div.innerHTML = `<span class="station"></span><span class="text"></span>`;
+  div.querySelector(".station").textContent = task.station + branches;
+  div.querySelector(".text").textContent = task.text;
+  if (!task.claimed_by) {
+    const claim = document.createElement("button");
+    claim.textContent = "claim";
+    claim.onclick = () => post(task.id, "claim", {});
+    div.append(" ", claim);
+  }
+  if (!task.claimed_by || mine) {
+    const answer = document.createElement("input");
+    answer.value = typed[task.id] || "";
+    answer.oninput = () => typed[task.id] = answer.value;
+    if (task.kind === "instruction") answer.style.display = "none";
+    const done = document.createElement("button");
+    done.textContent = "done";
+    done.onclick = () => post(task.id, "complete", {answer: answer.value});
+    div.append(" ", answer, " ", done);
+  } else {
+    div.append(` (${task.claimed_by})`);
+  }
+  return div;
+}
+
+async function refresh() {
+  if (document.activeElement && document.activeElement.closest && document.activeElement.closest(".task")) return;
+  const query = where.value ? "?station=" + encodeURIComponent(where.value) : "";
+  const tasks = await (await fetch("/tasks" + query)).json();
+  const list = document.getElementById("tasks");
+  list.replaceChildren(...tasks.map(render));
+  if (!tasks.length) list.textContent = "nothing to do right now";
+}
+where.onchange = refresh;
+refresh();
+setInterval(refresh, 1000);
+</script>
+</body></html>
+"""
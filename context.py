@@ -0,0 +1,100 @@
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, replace
+
+# everything an experiment changes while it's evaluated (its flowchart, the mode, the next
+# uids) lives in an ExperimentContext, and the current one is looked up through a ContextVar.
+# each thread and each asyncio task sees its own current context, so experiments evaluated
+# side by side don't write into each other's flowcharts.
+
+
+class UidCounter:
+    """Hands out 0, 1, 2, ...; safe to share between threads."""
+
+    def __init__(self, start: int = 0):
+        self.value = start
+        self.lock = threading.Lock()
+
+    def next(self) -> int:
+        with self.lock:
+            uid = self.value
+            self.value += 1
+            return uid
+
+    def peek(self) -> int:
+        return self.value
+
+
+def _evaluate():
+    from control import Evaluate
+    return Evaluate()
+
+
+@dataclass
+class ExperimentContext:
+    mode: object = field(default_factory=_evaluate)
+    flowchart: object = None # made by FlowChart() the first time it's asked for
+    physical_uids: UidCounter = field(default_factory=UidCounter) # RealWorldObjects
+    virtual_uids: UidCounter = field(default_factory=UidCounter) # VirtualWorldObjects
+    tracer: object = None # a tracing.Tracer while a traced experiment is evaluated
+    journal: object = None # a journal.Journal while a journaled experiment is executed
+    engine: object = None # an engine.Engine once Parallel iterations run side by side
+    branch: str = "" # which of those iterations this is, e.g. "0.2/"
+    devices: object = None # a lib.DeviceSchedule once DevicePool.plan has assigned fabrication jobs
+    changeovers: object = None # a planner.ChangeoverPlan once plan_changeovers has ordered Parallel loops
+    timers: object = None # a timers.TimerQueue while a decorated experiment is executed
+    backend: object = None # a backends.SimulatedBackend standing in for the outside world in Execute mode
+    console: object = None # a console.OperatorConsole that prompts go to instead of input()
+    metrics: object = None # a metrics.Metrics while an experiment with metrics=True is executed
+    rehearsing: bool = False # evaluating the experiment to plan how to execute it
+
+    def child(self) -> "ExperimentContext":
+        # a fresh flowchart, but the same mode and uids, so objects from different
+        # experiments in one run still get different numbers
+        return replace(self, flowchart=None)
+
+    def rehearsal(self, **changes) -> "ExperimentContext":
+        # for evaluating an experiment once before executing it: uids start where these are,
+        # without using them up, so the run that follows numbers things the same way
+        from control import Evaluate
+        return replace(self, mode=Evaluate(), flowchart=None, journal=None, engine=None, tracer=None, timers=None,
+                       backend=None, console=None, metrics=None,
+                       physical_uids=UidCounter(self.physical_uids.peek()),
+                       virtual_uids=UidCounter(self.virtual_uids.peek()), rehearsing=True, **changes)
+
+
+DEFAULT = None
+_default_lock = threading.Lock()
+_current: ContextVar[ExperimentContext] = ContextVar("fedt_experiment_context")
+
+
+def current_context() -> ExperimentContext:
+    """The context of whatever experiment is being evaluated here, or the process-wide one."""
+    global DEFAULT
+    try:
+        return _current.get()
+    except LookupError:
+        with _default_lock:
+            if DEFAULT is None:
+                DEFAULT = ExperimentContext()
+        return DEFAULT
+
+
+@contextmanager
+def experiment_context(context: ExperimentContext | None = None):
+    """Makes context (by default, a child of the current one) current until the block ends.
+
+    fedt_experiment already does this for every call. To evaluate independent protocol
+    variants in parallel with reproducible uids, give each one its own context:
+
+        with experiment_context(ExperimentContext()):
+            my_experiment()
+    """
+    if context is None:
+        context = current_context().child()
+    token = _current.set(context)
+    try:
+        yield context
+    finally:
+        _current.reset(token)
@@ -1,5 +1,6 @@
+import sys
+import types
 from dataclasses import dataclass
-from flowchart import FlowChart
 
 
 class Mode:
@@ -16,5 +17,26 @@ class Evaluate(Mode):
     pass
 
 
-global MODE
-MODE = Evaluate()
+@dataclass
+class Simulate(Evaluate):
+    # evaluates, and also estimates how long executing would take with each number of
+    # operators (see simulation.py)
+    operators: tuple[int, ...] = (1,)
+
+
+class _ControlModule(types.ModuleType):
+    # MODE belongs to the current experiment context (see context.py), but everyone reads and
+    # sets it as control.MODE, so the module looks it up there
+
+    @property
+    def MODE(self) -> Mode:
+        from context import current_context
+        return current_context().mode
+
+    @MODE.setter
+    def MODE(self, mode: Mode):
+        from context import current_context
+        current_context().mode = mode
+
+
+sys.modules[__name__].__class__ = _ControlModule
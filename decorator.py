@@ -1,20 +1,42 @@
 import ast
 import ast
 import copy
+from contextlib import contextmanager
 from functools import wraps
+import hashlib
 import inspect
+import itertools
+import marshal
+import os
+import sys
+import threading
 import types
 from datetime import datetime
+from typing import Literal
 
-from flowchart import FlowChart
+from context import experiment_context
+from control import Execute, Simulate
+from flowchart import FlowChart, XMLStreamSink, CountingSink
+from journal import Journal
+from simulation import Simulation
+from timers import TimerQueue
+from console import CONSOLE_PORT, OperatorConsole
+from metrics import Metrics
+from tracing import Tracer, device_class, trace_span
 
-UNIQUE_ID = 0
+UNIQUE_IDS = itertools.count(1)
+
+# transformed experiment code is cached in a .fedt_cache directory next to the module it came
+# from (like __pycache__), so importing a module full of experiments doesn't re-parse and
+# re-transform them every time. set CODE_CACHE = False to turn that off
+CODE_CACHE = True
+CACHE_DIR = ".fedt_cache"
+# FEDT_DEBUG=1 prints the transformed source of fedt_fabricate and fedt_measure functions
+DEBUG = bool(os.environ.get("FEDT_DEBUG"))
 
 
 def fresh_name():
-    global UNIQUE_ID
-    UNIQUE_ID += 1
-    return f"__FEDT_identifier_{UNIQUE_ID}"
+    return f"__FEDT_identifier_{next(UNIQUE_IDS)}"
 
 
 class UseVariables(ast.NodeTransformer):
@@ -30,16 +52,382 @@ class UseVariables(ast.NodeTransformer):
         return self.generic_visit(node)
 
 
+class DependsOnTarget(ast.NodeVisitor):
+    """Does the control flow of a loop body depend on the loop variable? That is, does the
+    loop variable (or anything computed from it) decide an if, a nested loop's range, or a
+    comprehension filter, or can the body leave early with break/continue/return."""
+
+    def __init__(self, loop):
+        self.tainted = set(self.names_in(loop.target))
+        self.dependent = False
+        assignments = [x for stmt in loop.body for x in ast.walk(stmt)
+                       if isinstance(x, (ast.Assign, ast.AugAssign, ast.AnnAssign, ast.For, ast.NamedExpr))]
+        # spread the taint through assignments until nothing changes
+        changed = True
+        while changed:
+            changed = False
+            for x in assignments:
+                source = x.iter if isinstance(x, ast.For) else x.value
+                if source is None or not (self.names_in(source) & self.tainted):
+                    continue
+                targets = x.targets if isinstance(x, ast.Assign) else [x.target]
+                for target in targets:
+                    new_names = self.names_in(target) - self.tainted
+                    if new_names:
+                        self.tainted |= new_names
+                        changed = True
+        for stmt in loop.body:
+            self.visit(stmt)
+
+    @staticmethod
+    def names_in(node) -> set[str]:
+        return {x.id for x in ast.walk(node) if isinstance(x, ast.Name)}
+
+    def check(self, test):
+        if self.names_in(test) & self.tainted:
+            self.dependent = True
+
+    def visit_If(self, node):
+        self.check(node.test)
+        self.generic_visit(node)
+
+    def visit_IfExp(self, node):
+        self.check(node.test)
+        self.generic_visit(node)
+
+    def visit_While(self, node):
+        self.check(node.test)
+        self.generic_visit(node)
+
+    def visit_For(self, node):
+        self.check(node.iter)
+        self.generic_visit(node)
+
+    def visit_Match(self, node):
+        self.check(node.subject)
+        self.generic_visit(node)
+
+    def visit_comprehension(self, node):
+        self.check(node.iter)
+        for test in node.ifs:
+            self.check(test)
+        self.generic_visit(node)
+
+    def visit_Break(self, node):
+        self.dependent = True
+
+    visit_Continue = visit_Break
+    visit_Return = visit_Break
+
+    def visit_FunctionDef(self, node):
+        pass # a break or return in there isn't ours
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_Lambda = visit_FunctionDef
+
+
+def control_names(function, skip=None) -> set[str]:
+    """Names that decide control flow somewhere in function (outside of skip), along with the
+    names they are computed from."""
+    nodes = []
+    stack = [function]
+    while stack:
+        x = stack.pop()
+        if x is skip:
+            continue
+        nodes.append(x)
+        stack.extend(ast.iter_child_nodes(x))
+    names = set()
+    for x in nodes:
+        match x:
+            case ast.For() | ast.AsyncFor():
+                names |= DependsOnTarget.names_in(x.iter)
+            case ast.If() | ast.While() | ast.IfExp():
+                names |= DependsOnTarget.names_in(x.test)
+            case ast.comprehension():
+                names |= DependsOnTarget.names_in(x.iter)
+                for test in x.ifs:
+                    names |= DependsOnTarget.names_in(test)
+            case ast.Match():
+                names |= DependsOnTarget.names_in(x.subject)
+    assignments = [x for x in nodes if isinstance(x, (ast.Assign, ast.AugAssign, ast.AnnAssign)) and x.value is not None]
+    changed = True
+    while changed:
+        changed = False
+        for x in assignments:
+            targets = x.targets if isinstance(x, ast.Assign) else [x.target]
+            if any(DependsOnTarget.names_in(t) & names for t in targets):
+                new_names = DependsOnTarget.names_in(x.value) - names
+                if new_names:
+                    names |= new_names
+                    changed = True
+    return names
+
+
+def written_names(body) -> set[str]:
+    # assigned to, augmented, stored into, or having a method called on them (xs.append(...))
+    names = set()
+    for x in (y for stmt in body for y in ast.walk(stmt)):
+        match x:
+            case ast.Assign(targets=targets):
+                for target in targets:
+                    names |= DependsOnTarget.names_in(target)
+            case ast.AugAssign(target=target) | ast.AnnAssign(target=target):
+                names |= DependsOnTarget.names_in(target)
+            case ast.Call(func=ast.Attribute(value=ast.Name(id=name))):
+                names.add(name)
+    return names
+
+
+def local_names(function) -> set[str]:
+    args = function.args
+    names = {x.arg for x in args.posonlyargs + args.args + args.kwonlyargs + [args.vararg, args.kwarg] if x}
+    return names | {x.id for x in ast.walk(function) if isinstance(x, ast.Name) and isinstance(x.ctx, ast.Store)}
+
+
+def free_names(node) -> set[str]:
+    # names node reads that it doesn't set itself (results += ... reads results)
+    augmented = {id(x.target) for x in ast.walk(node) if isinstance(x, ast.AugAssign)}
+    loaded, bound = set(), set()
+    for x in ast.walk(node):
+        if isinstance(x, ast.Name):
+            if isinstance(x.ctx, ast.Load) or id(x) in augmented:
+                loaded.add(x.id)
+            else:
+                bound.add(x.id)
+        elif isinstance(x, ast.arg):
+            bound.add(x.arg)
+    return loaded - bound
+
+
+def names_dict(names):
+    # lambda: {"name": name, ...}
+    return ast.Lambda(ast.arguments([], [], None, [], [], None, []), ast.Dict(
+        [ast.Constant(x) for x in sorted(names)], [ast.Name(x, ast.Load()) for x in sorted(names)]))
+
+
+def leaves_loop(node, nested=False) -> bool:
+    # can a loop body (node) leave the loop other than by finishing the iteration? a break or
+    # continue in a loop inside it is fine
+    match node:
+        case ast.Return() | ast.Yield() | ast.YieldFrom() | ast.Global() | ast.Nonlocal():
+            return True
+        case ast.Break() | ast.Continue():
+            return not nested
+        case ast.FunctionDef() | ast.AsyncFunctionDef() | ast.Lambda() | ast.ClassDef():
+            return False
+        case ast.For() | ast.AsyncFor() | ast.While():
+            return any(leaves_loop(x, True) for x in node.body) or \
+                any(leaves_loop(x, nested) for x in node.orelse)
+    return any(leaves_loop(x, nested) for x in ast.iter_child_nodes(node))
+
+
+def read_names(node) -> set[str]:
+    augmented = {id(x.target) for x in ast.walk(node) if isinstance(x, ast.AugAssign)}
+    return {x.id for x in ast.walk(node) if isinstance(x, ast.Name) and (isinstance(x.ctx, ast.Load) or id(x) in augmented)}
+
+
+def unordered(node) -> bool:
+    # a set, whose order can be different in the next run
+    match node:
+        case ast.Set() | ast.SetComp():
+            return True
+        case ast.Call(func=ast.Name(id="set" | "frozenset")):
+            return True
+    return False
+
+
+def changes_outside(loop, local: set[str]) -> bool:
+    # does the loop assign through anything but the function's own variables (a module's or a
+    # class's attribute, the items of a global)? replaying it wouldn't do that again
+    for x in ast.walk(loop):
+        if isinstance(x, (ast.Attribute, ast.Subscript)) and isinstance(x.ctx, (ast.Store, ast.Del)):
+            root = x
+            while isinstance(root, (ast.Attribute, ast.Subscript)):
+                root = root.value
+            if not (isinstance(root, ast.Name) and root.id in local):
+                return True
+    return False
+
+
+def reads_before_write(body, name: str) -> bool:
+    # might the body read name before it has set it? only plain assignments at the top of the
+    # body count as setting it for sure, and an inner loop over name reads its own value
+    for stmt in body:
+        match stmt:
+            case ast.Assign(value=value) | ast.AnnAssign(value=value) if value is not None:
+                targets = stmt.targets if isinstance(stmt, ast.Assign) else [stmt.target]
+                if name in read_names(value):
+                    return True
+                if any(name in DependsOnTarget.names_in(t) for t in targets):
+                    return False
+            case ast.For(target=target) | ast.AsyncFor(target=target) if name in DependsOnTarget.names_in(target):
+                if name in read_names(stmt.iter) | set().union(*(read_names(x) for x in stmt.orelse)):
+                    return True
+            case _ if name in read_names(stmt):
+                return True
+    return False
+
+
+class HoistAugmented(ast.NodeTransformer):
+    # shared += f(...) -> tmp = f(...); shared += tmp, so a branch that waits inside f doesn't
+    # add to what shared was before the others added to it
+
+    def __init__(self, names: set[str]):
+        self.names = names
+
+    def visit_AugAssign(self, node):
+        if not (isinstance(node.target, ast.Name) and node.target.id in self.names):
+            return node
+        value_name = fresh_name()
+        return [ast.Assign([ast.Name(value_name, ast.Store())], node.value),
+                ast.AugAssign(node.target, node.op, ast.Name(value_name, ast.Load()))]
+
+    def visit_FunctionDef(self, node):
+        return node
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_Lambda = visit_FunctionDef
+
+
+def loop_instruction(item):
+    # instruction("Loop for " + str(<item>), True, binding=("<item>", <item>))
+    binding = ast.Tuple([ast.Constant(ast.unparse(item)), copy.deepcopy(item)], ast.Load())
+    return ast.Expr(
+        ast.Call(ast.Name("instruction", ast.Load()), [
+            ast.BinOp(
+                ast.Constant(f"Loop for "), ast.Add(),
+                ast.Call(ast.Name("str", ast.Load()), [item], [])),
+            ast.Constant(True)
+        ], [ast.keyword("binding", binding)]))
+
+
 class FixLoops(ast.NodeTransformer):
 
+    def __init__(self, symbolic=False, cache_dir=None, processes=1, trace=False, concurrent=False,
+                 devices: frozenset[str] = frozenset()):
+        # in symbolic mode, loops whose body runs the same way whatever the loop variable is
+        # run their body once and then tell the flowchart how many more times it would have run
+        self.symbolic = symbolic
+        # with a cache_dir (incremental evaluation), top-level loops that can be are looked up
+        # in the loop cache before being run; see incremental.py
+        self.cache_dir = cache_dir
+        # with more than one process, top-level Parallel loops that can be are spread over
+        # that many worker processes; see parallel.py
+        self.processes = processes
+        # with trace, loops, iterations and calls on the devices (the global names of device and
+        # instrument classes, see tracing.device_class) are wrapped in spans; see tracing.py
+        self.trace = trace
+        self.devices = devices
+        # with concurrent, loops that can be run their body as a function of the loop value, so
+        # Parallel iterations can run side by side in Execute mode; see engine.py
+        self.concurrent = concurrent
+        self.function = None
+        self.locals = set()
+        self.nested_defs = 0
+
+    def visit_FunctionDef(self, node):
+        if self.function is not None:
+            self.nested_defs += 1
+            self.generic_visit(node)
+            self.nested_defs -= 1
+            return node
+        self.function = node
+        self.locals = local_names(node)
+        self.generic_visit(node)
+        if self.trace:
+            node.body.insert(0, ast.ImportFrom("tracing", [ast.alias("trace_span"), ast.alias("traced_call")], 0))
+        return node
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        # Laser.fab(...) -> traced_call(Laser, "fab")(...)
+        match node.func:
+            case ast.Attribute(value=ast.Name(id=owner) as owner_name, attr=attribute) \
+                    if self.trace and owner in self.devices and owner not in self.locals:
+                node.func = ast.Call(ast.Name("traced_call", ast.Load()),
+                                     [owner_name, ast.Constant(attribute)], [])
+        return node
+
+    def traced(self, name: str, category: str, body: list, **args) -> list:
+        # with trace_span(name, category, **args): body
+        if not self.trace:
+            return body
+        return [ast.With([ast.withitem(ast.Call(ast.Name("trace_span", ast.Load()),
+                                                [ast.Constant(name), ast.Constant(category)],
+                                                [ast.keyword(k, v) for k, v in args.items()]))],
+                         body)]
+
+    def can_extrapolate(self, loop) -> bool:
+        # the body mustn't branch on the loop variable, and mustn't build up anything that the
+        # rest of the experiment branches or loops on (e.g. a list of fabricated objects that a
+        # later loop measures), since that would only hold what the first iteration made
+        if DependsOnTarget(loop).dependent:
+            return False
+        if self.function is None:
+            return True
+        return not (written_names(loop.body) & control_names(self.function, skip=loop))
+
+    def loop_outputs(self, loop) -> set[str] | None:
+        # a loop can be cached or run elsewhere if it's at the top of the function and can't
+        # leave it early. the function's variables it uses that are used again after it
+        # (results it adds to, objects it fabricates or measures) are its outputs, which have
+        # to be brought back afterwards. None if the loop can't be
+        if self.function is None:
+            return None
+        body = self.function.body
+        if not any(x is loop for x in body):
+            return None
+        if any(isinstance(x, (ast.Return, ast.Yield, ast.YieldFrom, ast.Await, ast.Global, ast.Nonlocal))
+               for x in ast.walk(loop)):
+            return None
+        after = body[[i for i, x in enumerate(body) if x is loop][0] + 1:]
+        used_after = set().union(*(DependsOnTarget.names_in(x) for x in after))
+        return DependsOnTarget.names_in(loop) & local_names(self.function) & used_after
+
+    def concurrent_shared(self, loop) -> tuple[set[str], set[str]] | None:
+        # the experiment's variables a loop body shares with the rest of the function, when it
+        # becomes a function of the loop value: the ones it only adds to (results += ...) stay
+        # shared (nonlocal), and the ones it sets are its own, with the last iteration's values
+        # copied back out afterwards. None if the body can't be a function: it leaves the loop
+        # early, or might read a variable an earlier iteration set
+        if self.function is None or self.nested_defs or leaves_loop(loop):
+            return None
+        args = self.function.args
+        outside = {x.arg for x in args.posonlyargs + args.args + args.kwonlyargs + [args.vararg, args.kwarg] if x}
+        bound_outside = set(outside)
+        stack = [self.function]
+        while stack:
+            x = stack.pop()
+            if x is loop:
+                continue
+            if isinstance(x, ast.Name):
+                outside.add(x.id)
+                if isinstance(x.ctx, ast.Store):
+                    bound_outside.add(x.id)
+            stack.extend(ast.iter_child_nodes(x))
+        declared_global = {name for x in ast.walk(self.function) if isinstance(x, ast.Global) for name in x.names}
+        augmented = {x.target.id for x in ast.walk(loop) if isinstance(x, ast.AugAssign) and isinstance(x.target, ast.Name)}
+        augmented_ids = {id(x.target) for x in ast.walk(loop) if isinstance(x, ast.AugAssign)}
+        stored = {x.id for x in ast.walk(loop)
+                  if isinstance(x, ast.Name) and isinstance(x.ctx, ast.Store) and id(x) not in augmented_ids}
+        # nonlocal needs them bound in the experiment itself
+        shared = (augmented - stored) & bound_outside - declared_global
+        own = (stored | augmented) - shared
+        if own & declared_global or any(reads_before_write(loop.body, x) for x in own - DependsOnTarget.names_in(loop.target)):
+            return None
+        return shared, own & outside
+
     def visit_For(self, node):
 
-        def flowchart_call(fname):
+        def flowchart_call(fname, args=[]):
             return ast.Expr(
                 ast.Call(
                     ast.Attribute(
                         ast.Call(ast.Name("FlowChart", ast.Load()), [], []),
-                        fname, ast.Load()), [], []))
+                        fname, ast.Load()), args, []))
 
         def enter_loop_call(iter):
             arg = ast.Call(ast.Attribute(iter, "kind", ast.Load()), [], [])
@@ -49,31 +437,168 @@ class FixLoops(ast.NodeTransformer):
                         ast.Call(ast.Name("FlowChart", ast.Load()), [], []),
                         "enter_loop", ast.Load()), [arg], []))
 
-        def instruction_call(item):
-            return ast.Expr(
-                ast.Call(ast.Name("instruction", ast.Load()), [
-                    ast.BinOp(
-                        ast.Constant(f"Loop for "), ast.Add(),
-                        ast.Call(ast.Name("str", ast.Load()), [item], [])),
-                    ast.Constant(True)
-                ], []))
+        symbolic = self.symbolic and self.can_extrapolate(node)
+        outputs = self.loop_outputs(node)
+        loop_name = f"for {ast.unparse(node.target)} in {ast.unparse(node.iter)}"
+        # a loop that changes more than the function's variables, or that goes through a set,
+        # could replay differently than it ran (incremental.py checks the rest as it runs)
+        cached = self.cache_dir is not None and outputs is not None \
+            and not changes_outside(node, local_names(self.function)) \
+            and not any(unordered(x.iter) for x in ast.walk(node) if isinstance(x, (ast.For, ast.comprehension)))
+        if cached:
+            digest = hashlib.sha256(f"{symbolic}{ast.dump(node)}".encode()).hexdigest()
+            inputs = free_names(node)
+        spread = self.processes > 1 and not symbolic and outputs is not None \
+            and not any(isinstance(x, ast.Break) for x in ast.walk(node))
+        shared = self.concurrent_shared(node) if self.concurrent and not (symbolic or cached or spread) else None
+        if spread:
+            # the ones it sets outright (rather than adding to) keep the last iteration's value
+            augmented = {id(x.target) for x in ast.walk(node) if isinstance(x, ast.AugAssign)}
+            assigned = {x.id for x in ast.walk(node) if isinstance(x, ast.Name)
+                        and isinstance(x.ctx, ast.Store) and id(x) not in augmented}
 
         self.generic_visit(node)
 
         target_use = copy.deepcopy(node.target)
         UseVariables().visit(target_use)
         iter_name = fresh_name()
+        body = self.traced("iteration", "iteration",
+                           [loop_instruction(target_use)] + node.body + [flowchart_call("end_body")],
+                           value=ast.Call(ast.Name("str", ast.Load()), [copy.deepcopy(target_use)], []))
+
+        if shared is not None:
+            # def body(value): nonlocal <shared>; <target> = value; ...; return {<own>}
+            # from engine import iterate; own = iterate(<iter>, body); <own> = own[...]
+            nonlocal_names, copied_back = shared
+            is_async = isinstance(self.function, ast.AsyncFunctionDef)
+            body_name, value_name, own_name = fresh_name(), fresh_name(), fresh_name()
+            function_body = ([ast.Nonlocal(sorted(nonlocal_names))] if nonlocal_names else []) + [
+                ast.Assign([node.target], ast.Name(value_name, ast.Load())),
+            ] + [y for x in body for y in ([HoistAugmented(nonlocal_names).visit(x)] if nonlocal_names else [x])
+                 for y in (y if isinstance(y, list) else [y])] + [
+                ast.Return(ast.DictComp(
+                    ast.Name("k", ast.Load()), ast.Name("v", ast.Load()),
+                    [ast.comprehension(ast.Tuple([ast.Name("k", ast.Store()), ast.Name("v", ast.Store())], ast.Store()),
+                                       ast.Call(ast.Attribute(ast.Call(ast.Name("locals", ast.Load()), [], []),
+                                                              "items", ast.Load()), [], []),
+                                       [ast.Compare(ast.Name("k", ast.Load()), [ast.In()],
+                                                    [ast.Constant(tuple(sorted(copied_back)))])], 0)]))
+            ]
+            arguments = ast.arguments([], [ast.arg(value_name)], None, [], [], None, [])
+            iterate = ast.Call(ast.Name("iterate_async" if is_async else "iterate", ast.Load()),
+                               [ast.Name(iter_name, ast.Load()), ast.Name(body_name, ast.Load())], [])
+            loop = [
+                enter_loop_call(ast.Name(iter_name, ast.Load())),
+                (ast.AsyncFunctionDef if is_async else ast.FunctionDef)(body_name, arguments, function_body, [], None),
+                ast.ImportFrom("engine", [ast.alias("iterate_async" if is_async else "iterate")], 0),
+                ast.Assign([ast.Name(own_name, ast.Store())], ast.Await(iterate) if is_async else iterate),
+            ] + [
+                ast.If(ast.Compare(ast.Constant(x), [ast.In()], [ast.Name(own_name, ast.Load())]),
+                       [ast.Assign([ast.Name(x, ast.Store())],
+                                   ast.Subscript(ast.Name(own_name, ast.Load()), ast.Constant(x), ast.Load()))], [])
+                for x in sorted(copied_back)
+            ] + node.orelse + [
+                flowchart_call("exit_loop")
+            ]
+        elif spread:
+            # for <target> in pool.iterations(<iter>): ...
+            # if pool.forked: <outputs> = pool.outputs[...]
+            pool_name = fresh_name()
+            pool = ast.Name(pool_name, ast.Load())
+            loop = [
+                enter_loop_call(ast.Name(iter_name, ast.Load())),
+                ast.ImportFrom("parallel", [ast.alias("ParallelLoop")], 0),
+                ast.Assign([ast.Name(pool_name, ast.Store())],
+                           ast.Call(ast.Name("ParallelLoop", ast.Load()),
+                                    [ast.Constant(self.processes), names_dict(outputs),
+                                     names_dict(free_names(node) & local_names(self.function) - outputs),
+                                     ast.Call(ast.Name("frozenset", ast.Load()),
+                                              [ast.Constant(tuple(sorted(assigned & outputs)))], [])], [])),
+                ast.For(node.target,
+                        ast.Call(ast.Attribute(pool, "iterations", ast.Load()), [ast.Name(iter_name, ast.Load())], []),
+                        body, node.orelse, node.type_comment),
+                ast.If(ast.Attribute(pool, "forked", ast.Load()), [
+                    ast.Assign([ast.Name(x, ast.Store())],
+                               ast.Subscript(ast.Attribute(pool, "outputs", ast.Load()), ast.Constant(x), ast.Load()))
+                    for x in sorted(outputs)
+                ] or [ast.Pass()], []),
+                flowchart_call("exit_loop")
+            ]
+        elif not symbolic:
+            loop = [
+                enter_loop_call(ast.Name(iter_name, ast.Load())),
+                ast.For(node.target, ast.Name(iter_name, ast.Load()),
+                        body, node.orelse, node.type_comment),
+                flowchart_call("exit_loop")
+            ]
+        else:
+            first_name, rest_name = fresh_name(), fresh_name()
+            loop = [
+                ast.ImportFrom("iterators", [ast.alias("split_first")], 0),
+                enter_loop_call(ast.Name(iter_name, ast.Load())),
+                ast.Assign([ast.Tuple([ast.Name(first_name, ast.Store()), ast.Name(rest_name, ast.Store())], ast.Store())],
+                           ast.Call(ast.Name("split_first", ast.Load()), [ast.Name(iter_name, ast.Load())], [])),
+                ast.For(node.target, ast.Name(first_name, ast.Load()),
+                        body, node.orelse, node.type_comment),
+                flowchart_call("repeat_body", [ast.Name(rest_name, ast.Load()), ast.Constant(ast.unparse(target_use))]),
+                flowchart_call("exit_loop")
+            ]
+
+        if cached:
+            # if cache.replay(): <outputs> = cache.outputs[...]
+            # else: try: <loop>; cache.save(lambda: {outputs}) finally: cache.stop()
+            cache_name = fresh_name()
+
+            def cache_call(fname, args=[]):
+                return ast.Call(ast.Attribute(ast.Name(cache_name, ast.Load()), fname, ast.Load()), args, [])
+
+            loop = [
+                ast.ImportFrom("incremental", [ast.alias("LoopCache")], 0),
+                ast.Assign([ast.Name(cache_name, ast.Store())],
+                           ast.Call(ast.Name("LoopCache", ast.Load()),
+                                    [ast.Constant(self.cache_dir), ast.Constant(digest),
+                                     ast.Name(iter_name, ast.Load()), names_dict(inputs),
+                                     ast.Constant(tuple(sorted(inputs - outputs)))], [])),
+                ast.If(cache_call("replay"), [
+                    ast.Assign([ast.Name(x, ast.Store())],
+                               ast.Subscript(ast.Attribute(ast.Name(cache_name, ast.Load()), "outputs", ast.Load()),
+                                             ast.Constant(x), ast.Load()))
+                    for x in sorted(outputs)
+                ] or [ast.Pass()], [
+                    ast.Try(loop + [ast.Expr(cache_call("save", [names_dict(outputs)]))], [], [],
+                            [ast.Expr(cache_call("stop"))])
+                ])
+            ]
 
-        return [
-            ast.ImportFrom("flowchart", [ast.alias("FlowChart")], 0),
+        return [ast.ImportFrom("flowchart", [ast.alias("FlowChart")], 0)] + self.traced(loop_name, "loop", [
             ast.Assign([ast.Name(iter_name, ast.Store())], node.iter),
-            enter_loop_call(ast.Name(iter_name, ast.Load())),
-            ast.For(node.target, ast.Name(iter_name, ast.Load()),
-                    [instruction_call(target_use)] + node.body +
-                    [flowchart_call("end_body")], node.orelse,
-                    node.type_comment),
+        ] + loop)
+
+    def visit_AsyncFor(self, node):
+        # async for: a plain loop in the flowchart, run one iteration at a time. fedt's iterators
+        # aren't async, so there's no Parallel or Series kind unless the iterable says
+        target_use = copy.deepcopy(node.target)
+        UseVariables().visit(target_use)
+        loop_name = f"async for {ast.unparse(node.target)} in {ast.unparse(node.iter)}"
+        self.generic_visit(node)
+        iter_name = fresh_name()
+        iterable = ast.Name(iter_name, ast.Load())
+        kind = ast.IfExp(ast.Call(ast.Name("hasattr", ast.Load()), [iterable, ast.Constant("kind")], []),
+                         ast.Call(ast.Attribute(iterable, "kind", ast.Load()), [], []), ast.Constant("series"))
+
+        def flowchart_call(fname, args=[]):
+            return ast.Expr(ast.Call(ast.Attribute(ast.Call(ast.Name("FlowChart", ast.Load()), [], []),
+                                                   fname, ast.Load()), args, []))
+
+        body = self.traced("iteration", "iteration",
+                           [loop_instruction(target_use)] + node.body + [flowchart_call("end_body")],
+                           value=ast.Call(ast.Name("str", ast.Load()), [copy.deepcopy(target_use)], []))
+        return [ast.ImportFrom("flowchart", [ast.alias("FlowChart")], 0)] + self.traced(loop_name, "loop", [
+            ast.Assign([ast.Name(iter_name, ast.Store())], node.iter),
+            flowchart_call("enter_loop", [kind]),
+            ast.AsyncFor(node.target, iterable, body, node.orelse, node.type_comment),
             flowchart_call("exit_loop")
-        ]
+        ])
 
     def visit_While(self, node):
 
@@ -106,37 +631,227 @@ class FixLoops(ast.NodeTransformer):
                         ]), [ast.Break()], [])
             ]
 
+        cond = ast.unparse(node.test) # before tracing rewrites any calls in it
         self.generic_visit(node)
 
-        return [
-            ast.ImportFrom("flowchart", [ast.alias("FlowChart")], 0),
-            enter_loop_call(ast.unparse(node.test)),
+        return [ast.ImportFrom("flowchart", [ast.alias("FlowChart")], 0)] + self.traced(f"while {cond}", "loop", [
+            enter_loop_call(cond),
             ast.While(
                 node.test,
-                node.body + [flowchart_call("end_body")] + break_if_not_exec(),
+                self.traced("iteration", "iteration", node.body + [flowchart_call("end_body")]) + break_if_not_exec(),
                 node.orelse),
             flowchart_call("exit_loop")
-        ]
-
-
-def fedt_experiment(f):
-    source = inspect.getsource(f)
-    tree = ast.parse(source)
-    new_ast = ast.fix_missing_locations(FixLoops().visit(tree))
-    new_code = compile(new_ast, f.__code__.co_filename, "exec")
-    new_f = types.FunctionType(new_code.co_consts[0], f.__globals__)
-
-    @wraps(f)
-    def new_new_f(*args, **kwargs):
-        result = new_f(*args, **kwargs)
-        instructions = FlowChart().node
-        FlowChart().reset()
+        ])
+
+
+def _file_digest(file_name: str) -> str | None:
+    try:
+        with open(file_name, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+# editing the transforms below changes this, which throws away everything cached with the old ones
+TRANSFORMER_VERSION = _file_digest(__file__)
+
+
+def cache_dir_for(file_name: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(file_name)), CACHE_DIR)
+
+
+def transformed_code(f, make_transformer, transform: str, flags) -> types.CodeType:
+    """The code object for f after running make_transformer() over its source, from the code
+    cache if this exact source was transformed the same way before."""
+    file_name = f.__code__.co_filename
+    cache_file = None
+    if CODE_CACHE:
+        # the whole file goes into the key; that's cheaper than asking inspect for just f's
+        # source, and errs on the side of re-transforming
+        source_digest = _file_digest(file_name)
+        if source_digest is not None:
+            key = repr((source_digest, TRANSFORMER_VERSION, transform, flags, f.__qualname__,
+                        f.__code__.co_firstlineno, sys.implementation.cache_tag))
+            cache_file = os.path.join(cache_dir_for(file_name), hashlib.sha256(key.encode()).hexdigest())
+            try:
+                with open(cache_file, "rb") as cached:
+                    return marshal.load(cached)
+            except (OSError, EOFError, ValueError, TypeError):
+                pass
+
+    tree = ast.parse(inspect.getsource(f))
+    new_ast = ast.fix_missing_locations(make_transformer().visit(tree))
+    if DEBUG:
+        print(ast.unparse(new_ast))
+    new_code = compile(new_ast, file_name, "exec")
+    # the decorator's own arguments (sink="count", ...) can come before the function's code
+    function_code = next(x for x in new_code.co_consts
+                         if isinstance(x, types.CodeType) and x.co_name == f.__name__)
+
+    if cache_file is not None:
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            partial = f"{cache_file}.{os.getpid()}.{threading.get_ident()}"
+            with open(partial, "wb") as out:
+                marshal.dump(function_code, out)
+            os.replace(partial, cache_file)
+        except OSError:
+            pass # a read-only checkout just doesn't get cached
+    return function_code
+
+
+def fedt_experiment(f=None, *, sink: Literal["tree", "stream", "count"] = "tree", symbolic=False, snapshot=False,
+                    incremental=False, processes=1, trace=False, journal: bool | str = False, concurrent=False,
+                    replay: str | None = None, console: bool | int = False, metrics: bool | str = False):
+    """Decorate an experiment so that calling it in Evaluate mode records its flowchart.
+
+    sink: "tree" writes the XML at the end, "stream" writes it as it goes, "count" only
+        tallies (into last_sink). Either way, last_index has counts per device, measurement,
+        loop and object.
+    symbolic: runs a loop body that doesn't branch on its variable once and multiplies it out.
+    snapshot: also saves a binary .fedt snapshot next to the XML (flowchart_snapshot.py).
+    incremental: replays unchanged top-level loops from .fedt_cache (incremental.py).
+    processes: spreads top-level Parallel loops over N forked processes, 0 for every core
+        (parallel.py).
+    trace: writes a .trace.json of loops, iterations and device calls, kept in last_trace
+        (tracing.py).
+    journal: records an Execute run to fedt-<experiment>.journal (or the file named) and
+        resumes it from there after a crash (journal.py, timers.py).
+    replay: executes from a recorded journal, with nobody there (journal.py).
+    concurrent: runs Parallel iterations side by side in Execute mode (engine.py).
+    console: serves Execute mode's prompts as tasks on localhost, on CONSOLE_PORT or the
+        port given (console.py).
+    metrics: writes an Execute run's timings to fedt-<experiment>.metrics.prom (or the file
+        named), kept in last_metrics (metrics.py).
+
+    In Simulate mode, executing the experiment is simulated too, and the reports are kept in
+    last_simulation (simulation.py)."""
+    if f is None:
+        return lambda f: fedt_experiment(f, sink=sink, symbolic=symbolic, snapshot=snapshot,
+                                         incremental=incremental, processes=processes, trace=trace,
+                                         journal=journal, concurrent=concurrent, replay=replay, console=console,
+                                         metrics=metrics)
+    if processes == 0:
+        processes = os.cpu_count() or 1
+    if symbolic and sink == "stream":
+        raise ValueError("symbolic evaluation needs the loop body around to repeat it; use sink=\"tree\" or \"count\"")
+    if journal and replay is not None:
+        raise ValueError("journal= records a run and replay= plays one back; use one of them")
+    if snapshot and sink != "tree":
+        raise ValueError("snapshots are taken from the flowchart tree; use sink=\"tree\"")
+
+    cache_dir = cache_dir_for(f.__code__.co_filename) if incremental else None
+    # metrics time device calls the way tracing does
+    timed = trace or bool(metrics)
+    devices = frozenset(name for name, value in f.__globals__.items() if device_class(value)) if timed else frozenset()
+    new_f = types.FunctionType(
+        transformed_code(f, lambda: FixLoops(symbolic, cache_dir, processes, timed, concurrent, devices),
+                         "FixLoops", (symbolic, incremental, processes, timed, concurrent, tuple(sorted(devices)))),
+        f.__globals__)
+
+    @contextmanager
+    def evaluated():
         date_and_time = datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
         file_name = f"{date_and_time}-fedt-{f.__name__}.xml"
+        out_file = None
+        tracer = Tracer() if trace else None
+        opened_journal = None
+        opened_timers = None
+        opened_console = None
+        kept_metrics = None
+        simulation = None
+        # each call gets its own flowchart, so experiments can be evaluated in several threads
+        # or asyncio tasks at once
+        with experiment_context() as context:
+            if symbolic and isinstance(context.mode, Simulate):
+                raise ValueError("simulating needs every iteration evaluated; use symbolic=False in Simulate mode")
+            outer_engine = context.engine
+            if tracer is not None:
+                context.tracer = tracer
+            if replay is not None and isinstance(context.mode, Execute):
+                opened_journal = Journal(replay, live=False)
+                context.journal = opened_journal
+            if journal and isinstance(context.mode, Execute):
+                opened_journal = Journal(journal if isinstance(journal, str) else f"fedt-{f.__name__}.journal")
+                context.journal = opened_journal
+            if isinstance(context.mode, Execute):
+                # the clocks are only kept on disk alongside a journal, and picked up again
+                # only by a run that's replaying that journal (see timers.py)
+                if opened_journal is not None and opened_journal.live:
+                    opened_timers = TimerQueue(f"fedt-{f.__name__}.timers", resume=bool(opened_journal.pending))
+                else:
+                    opened_timers = TimerQueue()
+                context.timers = opened_timers
+            if console and replay is None and context.console is None and isinstance(context.mode, Execute):
+                opened_console = OperatorConsole(CONSOLE_PORT if console is True else console)
+                context.console = opened_console
+            if metrics and isinstance(context.mode, Execute):
+                kept_metrics = context.metrics = Metrics()
+            match sink:
+                case "stream":
+                    out_file = open(file_name, "w")
+                    FlowChart().use_sink(XMLStreamSink(out_file))
+                case "count":
+                    FlowChart().use_sink(CountingSink())
+            if isinstance(context.mode, Simulate):
+                simulation = FlowChart().simulation = Simulation()
+                staffing = context.mode.operators
+            try:
+                with trace_span(f.__name__, "experiment"):
+                    yield
+                if opened_timers is not None:
+                    opened_timers.finish()
+            finally:
+                used_sink = FlowChart().sink
+                used_index = FlowChart().index
+                used_sink.close()
+                if out_file is not None:
+                    out_file.close()
+                if context.engine is not outer_engine:
+                    context.engine.close()
+                if opened_journal is not None:
+                    opened_journal.close()
+                if opened_console is not None:
+                    opened_console.close()
+                if kept_metrics is not None:
+                    metrics_name = metrics if isinstance(metrics, str) else f"fedt-{f.__name__}.metrics.prom"
+                    kept_metrics.write(metrics_name)
+                    new_new_f.last_metrics = kept_metrics
+                    print(f"Metrics written to {metrics_name}")
+        new_new_f.last_sink = used_sink
+        new_new_f.last_index = used_index
+        if tracer is not None:
+            new_new_f.last_trace = tracer
+            trace_name = file_name.replace(".xml", ".trace.json")
+            tracer.write(trace_name)
+            print(f"Trace written to {trace_name}")
+        if simulation is not None:
+            new_new_f.last_simulation = [simulation.run(x) for x in staffing]
+            for result in new_new_f.last_simulation:
+                print(result.report())
+        if sink == "count":
+            print(f"Flowchart counts: {used_sink}")
+            return
+        if sink == "tree":
+            with open(file_name, "w") as out_file:
+                used_sink.node.writeXML(out_file)
+            if snapshot:
+                from flowchart_snapshot import save_snapshot
+                snapshot_name = file_name.replace(".xml", ".fedt")
+                save_snapshot(used_sink.node, snapshot_name)
+                print(f"Flowchart snapshot saved to {snapshot_name}")
         print(f"Flowchart XML printed to {file_name}")
-        with open(file_name, "w") as out_file:
-            out_file.writelines(instructions.toXML())
-        return result
+
+    if inspect.iscoroutinefunction(f):
+        @wraps(f)
+        async def new_new_f(*args, **kwargs):
+            with evaluated():
+                return await new_f(*args, **kwargs)
+    else:
+        @wraps(f)
+        def new_new_f(*args, **kwargs):
+            with evaluated():
+                return new_f(*args, **kwargs)
 
     return new_new_f
 
@@ -175,13 +890,9 @@ class AddModeBranch(ast.NodeTransformer):
 def fedt_fabricate(instruction):
 
     def inner(f):
-        source = inspect.getsource(f)
-        tree = ast.parse(source)
-        new_ast = ast.fix_missing_locations(
-            AddModeBranch(instruction).visit(tree))
-        print(ast.unparse(new_ast))
-        new_code = compile(new_ast, f.__code__.co_filename, "exec")
-        new_f = types.FunctionType(new_code.co_consts[2], f.__globals__)
+        new_f = types.FunctionType(
+            transformed_code(f, lambda: AddModeBranch(instruction), "AddModeBranch", instruction),
+            f.__globals__)
 
         return new_f
 
@@ -191,12 +902,8 @@ def fedt_fabricate(instruction):
 def fedt_measure():
 
     def inner(f):
-        source = inspect.getsource(f)
-        tree = ast.parse(source)
-        new_ast = ast.fix_missing_locations(AddModeBranch().visit(tree))
-        print(ast.unparse(new_ast))
-        new_code = compile(new_ast, f.__code__.co_filename, "exec")
-        new_f = types.FunctionType(new_code.co_consts[2], f.__globals__)
+        new_f = types.FunctionType(transformed_code(f, AddModeBranch, "AddModeBranch", None),
+                                   f.__globals__)
 
         return new_f
 
@@ -2,12 +2,20 @@ import abc
 import copy
 from dataclasses import dataclass
 from typing import Callable, Type
+from context import current_context
 from control import MODE, Execute
 from instruction import instruction, note
 
-CURRENT_UID = 0
 VERSIONS = 'versions'
 
+
+def __getattr__(name):
+    # the next uid is kept per experiment context; this is for code that still reads it here
+    if name == "CURRENT_UID":
+        return current_context().virtual_uids.peek()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 @dataclass
 class VirtualWorldObject:
     uid: int
@@ -16,15 +24,13 @@ class VirtualWorldObject:
     file_location: str
 
     def __init__(self, file_location: str,  metadata: dict[str, object]|None = None):
-        global CURRENT_UID
-        self.uid = CURRENT_UID
-        CURRENT_UID += 1
+        self.uid = current_context().virtual_uids.next()
         self.file_location = file_location
         if metadata is None:
             metadata = dict()
         self.metadata = metadata
         self.version = 0
-        note("this creates virtual object #{}{}".format(self.uid, " at {}".format(self.file_location) if self.file_location else ''))
+        note("this creates virtual object #{}{}", args=(self.uid, " at {}".format(self.file_location) if self.file_location else ''))
 
     def __hash__(self):
         return self.uid
@@ -45,7 +51,7 @@ class VirtualWorldObject:
         else:
             self.metadata[newkey] = newval
         self.metadata.update({VERSIONS: versions})
-        note("(this creates a new version of #{}: {}v{})".format(self.uid, self.uid, self.version))
+        note("(this creates a new version of #{}: {}v{})", args=(self.uid, self.uid, self.version))
 
 @dataclass
 class GeometryFile(VirtualWorldObject):
@@ -0,0 +1,392 @@
+import asyncio
+import base64
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, wait
+from dataclasses import replace
+from datetime import date, datetime
+
+import control
+from context import current_context, experiment_context
+from metrics import machine_timed, prompt_timed
+
+# concurrent execution: with @fedt_experiment(concurrent=True), the iterations of a Parallel loop
+# run side by side in Execute mode, so one printer's 30-minute job doesn't hold up the others.
+#
+# each iteration (a branch) runs in its own thread, but only one branch runs experiment code at a
+# time: a branch gives up its turn while it waits on the outside world (an operator prompt, a
+# machine's software, a wait), and those waits are awaited on the engine's asyncio loop. so
+# branches only ever switch at those points, like asyncio tasks switch at awaits, and the rest
+# of the experiment doesn't have to be thread safe. prompts are asked one at a time, labelled
+# with the branch they come from.
+#
+# prompts wait until every branch is waiting on something, so they come in batches: one from
+# each branch that got to one. a step the operator only confirms (an instruction, "Press enter
+# when done") that several branches are waiting on with the same text is asked once for all
+# of them, e.g. "[branches 0.0, 0.1, 0.2] ensure visicut is open", after giving branches still
+# running machine software a few seconds to get there too. questions, and steps that differ
+# per object, are still asked one by one.
+#
+# FixLoops turns the body of each loop that can run this way into a function of the loop
+# value (see FixLoops.concurrent_shared). the experiment's variables it assigns come back from
+# the last iteration, as they would from a plain loop; the ones it only adds to (results += ...)
+# are shared between branches. objects get their uids in the order they're really made, and a
+# journal (see journal.py) keeps each branch's steps apart, so a restart replays each branch on
+# its own. the flowchart kept in Execute mode doesn't keep the branches apart.
+#
+# async def experiments work the same way: their Parallel loops run each iteration's coroutine
+# in a branch, and ask(), run_command() and wait_until() here can be awaited instead of
+# blocking; library code that calls input() or subprocess directly still blocks its branch.
+
+POLL_SECONDS = 60 # the longest a wait sleeps before looking at the clock again (it may have been changed)
+GATHER_SECONDS = 5 # how long a prompt waits for branches still running machine software to catch up
+
+
+class Engine:
+    """The asyncio loop (in its own thread) that the branches of one experiment wait on."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="fedt-engine", daemon=True)
+        self.thread.start()
+        self.turn = threading.Lock() # held by the branch that is running experiment code
+        self.runnable = 0 # branches running experiment code or waiting for their turn to
+        self.runnable_lock = threading.Lock()
+        self.prompts: list[tuple[str, str, bool, asyncio.Future, float]] = [] # (text, branch, shared, answer, when)
+        self.asking = False
+        self.commands = 0 # branches waiting on machine software
+        self.local = threading.local() # .branch is set in branch threads
+        self.loops_started: dict[str, int] = {} # per branch, so branch labels are the same every run
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    # waiting: a branch gives up its turn while it waits, and takes it back after. it counts as
+    # runnable again as soon as what it waited on is done, before it gets its turn, so no prompt
+    # is asked in between
+
+    def give_up_turn(self, command=False):
+        with self.runnable_lock:
+            self.runnable -= 1
+            self.commands += command
+        self.turn.release()
+        self.loop.call_soon_threadsafe(self._ask_next)
+
+    def resume(self, command=False):
+        with self.runnable_lock:
+            self.runnable += 1
+            self.commands -= command
+
+    def blocking(self, wait):
+        if not getattr(self.local, "branch", False):
+            return wait()
+        self.give_up_turn()
+        try:
+            return wait()
+        finally:
+            self.resume()
+            self.turn.acquire()
+
+    def _submit(self, coroutine, command: bool):
+        branch = getattr(self.local, "branch", False)
+        future = asyncio.run_coroutine_threadsafe(self._waited(coroutine, branch, command), self.loop)
+        if branch:
+            self.give_up_turn(command)
+        return branch, future
+
+    async def _waited(self, coroutine, branch: bool, command: bool):
+        try:
+            return await _caught(coroutine)
+        finally:
+            if branch:
+                self.resume(command)
+
+    def call(self, coroutine, command=False):
+        branch, future = self._submit(coroutine, command)
+        try:
+            result, stopped = future.result()
+        finally:
+            if branch:
+                self.turn.acquire()
+        if stopped is not None:
+            raise stopped
+        return result
+
+    async def call_async(self, coroutine, command=False):
+        branch, future = self._submit(coroutine, command)
+        try:
+            result, stopped = await asyncio.wrap_future(future)
+        finally:
+            if branch:
+                self.turn.acquire()
+        if stopped is not None:
+            raise stopped
+        return result
+
+    # the outside world, on the engine's loop
+
+    async def prompt(self, text: str, branch: str, shared: bool = False) -> str:
+        # shared: the same answer does for every branch asking this (it's only a confirmation)
+        answer = self.loop.create_future()
+        self.prompts.append((text, branch, shared, answer, self.loop.time()))
+        self._ask_next()
+        return await answer
+
+    def _ask_next(self):
+        # on the engine's loop: the next prompt, once no branch is still on its way to one
+        if self.asking or self.runnable or not self.prompts:
+            return
+        text, _, shared, _, when = self.prompts[0]
+        batch = [x for x in self.prompts if x[0] == text and x[2]] if shared else self.prompts[:1]
+        if len(batch) > 1 and self.commands and self.loop.time() < when + GATHER_SECONDS:
+            # branches running machine software may be on their way to this one too
+            self.loop.call_at(when + GATHER_SECONDS, self._ask_next)
+            return
+        self.prompts = [x for x in self.prompts if x not in batch]
+        branches = [x[1].rstrip("/") for x in batch if x[1]]
+        if len(branches) > 1:
+            text = f"[branches {', '.join(branches)}] {text}"
+        elif branches:
+            text = f"[branch {branches[0]}] {text}"
+        self.asking = True
+
+        def answered(result=None, error=None):
+            self.asking = False
+            for _, _, _, answer, _ in batch:
+                if error is not None:
+                    answer.set_exception(error)
+                else:
+                    answer.set_result(result)
+            self.loop.call_soon(self._ask_next) # after the branches asking have resumed
+
+        # in a thread of its own, so a prompt still waiting for the operator doesn't keep the
+        # process alive once the experiment has stopped
+        def read():
+            try:
+                result = input(text)
+            except BaseException as e:
+                self.loop.call_soon_threadsafe(lambda error=e: answered(error=error))
+            else:
+                self.loop.call_soon_threadsafe(lambda: answered(result))
+        threading.Thread(target=read, name="fedt-prompt", daemon=True).start()
+
+    async def answered(self, answer: Future) -> str:
+        # a task on the operator console (see console.py) being done
+        return await asyncio.wrap_future(answer)
+
+    async def command(self, command: list[str], **kwargs) -> bytes:
+        process = await asyncio.create_subprocess_exec(*(str(x) for x in command), stdout=subprocess.PIPE,
+                                                       stderr=kwargs.get("stderr"))
+        output, _ = await process.communicate()
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command, output)
+        return output
+
+    async def sleep_until(self, when: date):
+        while (left := _seconds_until(when)) > 0:
+            await asyncio.sleep(min(left, POLL_SECONDS))
+
+    # branches
+
+    def start(self, values: list, body, is_async: bool) -> list[Future]:
+        context = current_context()
+        number = self.loops_started.get(context.branch, 0)
+        self.loops_started[context.branch] = number + 1
+        futures = []
+        with self.runnable_lock:
+            self.runnable += len(values)
+        for i, value in enumerate(values):
+            future = Future()
+            branch = replace(context, branch=f"{context.branch}{number}.{i}/")
+            threading.Thread(target=self._branch, args=(branch, body, value, is_async, future),
+                             name=f"fedt-branch-{branch.branch}", daemon=True).start()
+            futures.append(future)
+        return futures
+
+    def _branch(self, context, body, value, is_async: bool, future: Future):
+        self.local.branch = True
+        self.turn.acquire()
+        # the turn is given up before the outcome is out, or the experiment could finish and
+        # close the engine while this branch is still telling it it's done
+        try:
+            with experiment_context(context):
+                result = asyncio.run(body(value)) if is_async else body(value)
+        except BaseException as e:
+            self.give_up_turn()
+            future.set_exception(e)
+        else:
+            self.give_up_turn()
+            future.set_result(result)
+
+
+async def _caught(coroutine):
+    # (result, None), or (None, the KeyboardInterrupt or SystemExit that stopped it), which
+    # would otherwise stop the engine's loop instead of the branch that was waiting
+    try:
+        return await coroutine, None
+    except (KeyboardInterrupt, SystemExit) as e:
+        return None, e
+
+
+def _merged(futures: list[Future]) -> dict:
+    # each name as the last iteration that set it left it; if an iteration failed, the first
+    # one to fail (once they've all finished)
+    merged = {}
+    for x in futures:
+        merged.update(x.result())
+    return merged
+
+
+def _engine_for(iterable):
+    # the engine to run this loop's iterations on, or None to run them one by one here
+    context = current_context()
+    if not isinstance(context.mode, control.Execute) or iterable.kind() != "parallel":
+        return None
+    if context.engine is None:
+        context.engine = Engine()
+    return context.engine
+
+
+def iterate(iterable, body) -> dict:
+    """Runs body(value) for every value of a loop FixLoops made concurrent, and returns the
+    variables it sets."""
+    engine = _engine_for(iterable)
+    if engine is None:
+        merged = {}
+        for value in iterable:
+            merged.update(body(value))
+        return merged
+    futures = engine.start(list(iterable), body, False)
+    engine.blocking(lambda: wait(futures))
+    return _merged(futures)
+
+
+async def iterate_async(iterable, body) -> dict:
+    engine = _engine_for(iterable)
+    if engine is None:
+        merged = {}
+        for value in iterable:
+            merged.update(await body(value))
+        return merged
+    futures = engine.start(list(iterable), body, True)
+    waiting = asyncio.gather(*(asyncio.wrap_future(x) for x in futures), return_exceptions=True)
+    if getattr(engine.local, "branch", False):
+        engine.give_up_turn()
+        try:
+            await waiting
+        finally:
+            engine.resume()
+            engine.turn.acquire()
+    else:
+        await waiting
+    return _merged(futures)
+
+
+# what journal.ask, journal.run_command and Environment's waits do: in a branch they wait on
+# the engine, otherwise they're the usual blocking calls. with a simulated backend in use (see
+# backends.py), it answers instead, and with an operator console (see console.py), prompts are
+# tasks on it rather than input(); about says what a prompt is for, e.g. ("file", ".stl")
+
+def _waiting(context) -> int:
+    # prompts already waiting for an operator (for metrics.py)
+    if context.console is not None:
+        return len(context.console.tasks)
+    return len(context.engine.prompts) if context.engine is not None else 0
+
+
+def blocking_input(prompt: str, shared: bool = False, about: tuple | None = None) -> str:
+    context = current_context()
+    with prompt_timed(about, shared, _waiting(context)):
+        if context.backend is not None:
+            return context.backend.ask(prompt, about)
+        if context.console is not None:
+            answer = context.console.post(prompt, context.branch, shared, about)
+            if context.engine is None:
+                return answer.result()
+            return context.engine.call(context.engine.answered(answer))
+        if context.engine is None:
+            return input(prompt)
+        return context.engine.call(context.engine.prompt(prompt, context.branch, shared))
+
+
+def blocking_check_output(command: list[str], device: type | None = None, **kwargs) -> bytes:
+    # device: the machine the command runs, for metrics.py
+    context = current_context()
+    with machine_timed(command, device):
+        if context.backend is not None:
+            return context.backend.run(command)
+        if context.engine is None:
+            return subprocess.check_output(command, **kwargs)
+        return context.engine.call(context.engine.command(command, **kwargs), command=True)
+
+
+def _seconds_until(when: date) -> float:
+    # a date means its midnight
+    if not isinstance(when, datetime):
+        when = datetime.combine(when, datetime.min.time())
+    return (when - datetime.now()).total_seconds()
+
+
+def blocking_wait_until(when: date):
+    engine = current_context().engine
+    if engine is None:
+        while (left := _seconds_until(when)) > 0:
+            time.sleep(min(left, POLL_SECONDS))
+    else:
+        engine.call(engine.sleep_until(when))
+
+
+# awaitable versions, for async def experiments
+
+async def _remembered(kind: str, key: str, do):
+    context = current_context()
+    journal = context.journal
+    if journal is not None:
+        found, value = journal.replay(kind, key, context.branch)
+        if found:
+            return value
+    value = await do(context)
+    if journal is not None:
+        journal.record(kind, key, value, context.branch)
+    return value
+
+
+async def ask(prompt: str, shared: bool = False, about: tuple | None = None) -> str:
+    async def do(context):
+        with prompt_timed(about, shared, _waiting(context)):
+            if context.backend is not None:
+                return context.backend.ask(prompt, about)
+            if context.console is not None:
+                answer = context.console.post(prompt, context.branch, shared, about)
+                if context.engine is None:
+                    return await asyncio.wrap_future(answer)
+                return await context.engine.call_async(context.engine.answered(answer))
+            if context.engine is None:
+                return await asyncio.to_thread(input, prompt)
+            return await context.engine.call_async(context.engine.prompt(prompt, context.branch, shared))
+    return await _remembered("ask", prompt, do)
+
+
+async def run_command(command: list[str], device: type | None = None, **kwargs) -> bytes:
+    async def do(context):
+        with machine_timed(command, device):
+            if context.backend is not None:
+                output = context.backend.run(command)
+            elif context.engine is None:
+                output = await asyncio.to_thread(subprocess.check_output, command, **kwargs)
+            else:
+                output = await context.engine.call_async(context.engine.command(command, **kwargs), command=True)
+        return base64.b64encode(output).decode("ascii")
+    return base64.b64decode(await _remembered("run", " ".join(str(x) for x in command), do))
+
+
+async def wait_until(when: date):
+    engine = current_context().engine
+    if engine is None:
+        while (left := _seconds_until(when)) > 0:
+            await asyncio.sleep(min(left, POLL_SECONDS))
+    else:
+        await engine.call_async(engine.sleep_until(when))
@@ -2,27 +2,36 @@ import abc
 import copy
 from dataclasses import dataclass
 from typing import Callable
+from context import current_context
 from control import MODE, Execute
 from instruction import instruction, note
+from journal import physical_uid
 from decorator import explicit_checker
 from design import GeometryFile, ConfigurationFile, CAMFile
 
-CURRENT_UID = 0
 VERSIONS = 'versions'
 
+
+def __getattr__(name):
+    # the next uid is kept per experiment context; this is for code that still reads it here
+    if name == "CURRENT_UID":
+        return current_context().physical_uids.peek()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 @dataclass
 class RealWorldObject:
     uid: int
     version: int
     metadata: dict[str, object]
 
-    def __init__(self, metadata: dict[str, object] = {}):
-        global CURRENT_UID
-        self.uid = CURRENT_UID
-        CURRENT_UID += 1
+    def __init__(self, metadata: dict[str, object] = {}, device=None):
+        self.uid = physical_uid()
         self.metadata = metadata
         self.version = 0
-        note("this creates physical object #{}".format(self.uid))
+        # minutes=: how long the machine takes, if the experiment said (see simulation.py)
+        note("this creates physical object #{}", args=(self.uid,), fabbing=True, device=device, uids=(self.uid,),
+             minutes=metadata.get("minutes") if isinstance(metadata, dict) else None)
 
     def __hash__(self):
         return self.uid
@@ -32,7 +41,7 @@ class RealWorldObject:
 
     def updateVersion(self, newkey: str, newval: object, instr: str | None = None):
         if instr:
-            instruction(instr)
+            instruction(instr, uids=(self.uid,))
         versions = []
         if VERSIONS in self.metadata:
             versions = self.metadata[VERSIONS]
@@ -43,14 +52,16 @@ class RealWorldObject:
         else:
             self.metadata[newkey] = newval
         self.metadata.update({VERSIONS: versions})
-        note("(this creates a new version of #{}: {}v{})".format(self.uid, self.uid, self.version))
+        note("(this creates a new version of #{}: {}v{})", args=(self.uid, self.uid, self.version), uids=(self.uid,))
 
 def fabricate(metadata: dict[str, object],
-              instr: str | None = None) -> RealWorldObject:
+              instr: str | None = None,
+              args: tuple = (),
+              device=None) -> RealWorldObject:
     if instr:
-        instruction(instr)
+        instruction(instr, args=args, device=device)
 
-    obj = RealWorldObject(metadata)
+    obj = RealWorldObject(metadata, device)
 
     return obj
 
@@ -1,7 +1,10 @@
-from dataclasses import dataclass, field
-from difflib import SequenceMatcher
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field, fields
 import inspect
-from typing import Literal, Union
+import math
+import numbers
+import sys
+from typing import Iterable, Iterator, Literal, Sequence, Union
 from xml.sax.saxutils import escape
 
 LATEX_DETAILS = 'latex_details'
@@ -12,6 +15,8 @@ SETTINGS = 'settings'
 FABBED_SOMETHING = 'fabricated'
 
 class Node:
+    __slots__ = ()
+
     def toXML(self) -> str:
         ...
 
@@ -21,6 +26,93 @@ class Node:
     def FindFabbedCount(self) -> int:
         ...
 
+    def digest(self) -> int:
+        # structural hash: two nodes that would serialize the same way have the same digest
+        return hash((type(self).__name__, self.toXML()))
+
+    def same_as(self, other: "Node") -> bool:
+        return type(self) is type(other) and _state(self) == _state(other)
+
+
+def _state(node: Node) -> tuple:
+    return tuple(getattr(node, f.name) for f in fields(node))
+
+
+class Container(Node):
+    __slots__ = ('_digest',)
+
+    # containers don't serialize themselves recursively; they hand out their pieces (strings
+    # and child nodes) and iter_xml/iter_latex below walk them with an explicit stack, so
+    # a body with 100k instructions doesn't turn into 100k Python frames.
+
+    def xml_parts(self) -> Iterator[Union[str, Node]]:
+        ...
+
+    def latex_parts(self) -> Iterator[Union[str, Node]]:
+        ...
+
+    def toXML(self) -> str:
+        return ''.join(iter_xml(self))
+
+    def toLatex(self) -> str:
+        return ''.join(iter_latex(self))
+
+    def children(self) -> tuple[Node, ...]:
+        ...
+
+    def own_key(self) -> tuple:
+        # whatever, besides the children, makes two containers different
+        return ()
+
+    def digest(self) -> int:
+        # merkle-style: built from the children's digests, which are cached on anything the
+        # TreeSink has interned, so this only walks the parts of the tree that are still open
+        if getattr(self, '_digest', None) is not None:
+            return self._digest
+        return hash((type(self).__name__, self.own_key(), tuple(x.digest() for x in self.children())))
+
+    def same_as(self, other: Node) -> bool:
+        # only meaningful for interned children, which are shared rather than copied
+        if type(self) is not type(other) or self.own_key() != other.own_key():
+            return False
+        mine, theirs = self.children(), other.children()
+        return len(mine) == len(theirs) and all(a is b for a, b in zip(mine, theirs))
+
+    def writeXML(self, out_file, chunk_size=4096):
+        chunk = []
+        for part in iter_xml(self):
+            chunk.append(part)
+            if len(chunk) >= chunk_size:
+                out_file.write(''.join(chunk))
+                chunk = []
+        out_file.write(''.join(chunk))
+
+
+def _walk(root: Node, parts, leaf) -> Iterator[str]:
+    if not isinstance(root, Container):
+        yield leaf(root)
+        return
+    stack = [iter(parts(root))]
+    while stack:
+        for part in stack[-1]:
+            if isinstance(part, str):
+                yield part
+            elif isinstance(part, Container):
+                stack.append(iter(parts(part)))
+                break
+            else:
+                yield leaf(part)
+        else:
+            stack.pop()
+
+
+def iter_xml(root: Node) -> Iterator[str]:
+    return _walk(root, lambda x: x.xml_parts(), lambda x: x.toXML())
+
+
+def iter_latex(root: Node) -> Iterator[str]:
+    return _walk(root, lambda x: x.latex_parts(), lambda x: x.toLatex())
+
 
 @dataclass
 class Empty(Node):
@@ -34,59 +126,217 @@ class Empty(Node):
 
 
 @dataclass
-class Seq(Node):
+class Seq(Container):
     prev: Node
     next: Node
 
-    def toXML(self) -> str:
-        return self.prev.toXML() + "\n" + self.next.toXML()
+    def children(self):
+        return (self.prev, self.next)
 
-    def toLatex(self) -> str:
-        return self.prev.toLatex() + "\n" + self.next.toLatex()
+    def xml_parts(self):
+        return (self.prev, "\n", self.next)
+
+    def latex_parts(self):
+        return (self.prev, "\n", self.next)
+
+
+@dataclass(slots=True)
+class Block(Container):
+    nodes: list[Node] = field(default_factory=list)
+
+    def children(self):
+        return tuple(self.nodes)
+
+    def xml_parts(self):
+        for node in self.nodes:
+            yield "\n"
+            yield node
+
+    def latex_parts(self):
+        for node in self.nodes:
+            yield "\n"
+            yield node
+
+
+def _joined(nodes: Iterable[Node], sep: str):
+    for i, node in enumerate(nodes):
+        if i:
+            yield sep
+        yield node
+
+
+@dataclass(slots=True)
+class Bound(Container):
+    # one loop iteration: its "Loop for X" header, and the rest of its body, which is shared
+    # with every other iteration that did exactly the same thing
+    header: "Header"
+    body: Block
+
+    def children(self):
+        return (self.header, self.body)
+
+    def xml_parts(self):
+        return ("\n", self.header, self.body)
+
+    def latex_parts(self):
+        return ("\n", self.header, self.body)
 
 
 @dataclass
-class Instr(Node):
-    instr: str
+class Repeated(Container):
+    # the iterations a symbolically evaluated loop didn't actually run: the body of the one it
+    # did run, once for each of the remaining values. only expanded when serializing.
+    body: Block
+    name: str
+    values: Sequence
+
+    def children(self):
+        return (self.body,)
+
+    def own_key(self) -> tuple:
+        # the values can be huge (or arrays), so these are never considered equal to each other
+        return (self.name, id(self))
+
+    def expand(self) -> Iterator[Bound]:
+        for value in self.values:
+            yield Bound(Header(f"Loop for {value}", (self.name, value)), self.body)
+
+    def xml_parts(self):
+        for x in self.expand():
+            yield x
+
+    def latex_parts(self):
+        return self.xml_parts()
+
+
+# instruction text is kept as a template and its arguments, and only formatted when the
+# flowchart is written out. the arguments are frozen when the instruction is given (call sites
+# go on to mutate their settings dicts), and FlowChart interns them, so a sweep that repeats
+# the same settings thousands of times stores them once.
+PRIMITIVES = (str, int, float, bool, type(None))
+
+
+class _Repr(str):
+    # an argument we had to turn into text up front; prints as that text
+    __slots__ = ()
+
+    def __repr__(self) -> str:
+        return str.__str__(self)
+
+
+class _Settings(tuple):
+    # a dict frozen into (key, value) pairs, which prints the way the dict did
+    __slots__ = ()
+
+    def __repr__(self) -> str:
+        return "{" + ", ".join(f"{k!r}: {v!r}" for k, v in self) + "}"
+
+    __str__ = __repr__
+
+
+def freeze(value, nested=False) -> tuple[object, object]:
+    # returns the frozen value and a key for interning it; the key tells apart values that
+    # compare equal but print differently (1 and True, 0.0 and -0.0, ...)
+    if type(value) is str or type(value) is int:
+        return value, value
+    if isinstance(value, PRIMITIVES) or isinstance(value, numbers.Number):
+        return value, (type(value), repr(value))
+    if type(value) is _Settings:
+        # already frozen (a loop played back by incremental.py)
+        return value, (_Settings, value)
+    if isinstance(value, dict):
+        items, keys = [], [_Settings]
+        for k, v in value.items():
+            (fk, kk), (fv, kv) = freeze(k, True), freeze(v, True)
+            items.append((fk, fv))
+            keys += (kk, kv)
+        return _Settings(items), tuple(keys)
+    text = repr(value) if nested else str(value)
+    return _Repr(text), (_Repr, text)
+
+
+def _latexable(kwargs) -> dict | None:
+    if LATEX_DETAILS not in kwargs:
+        return None
+    latexable = kwargs[LATEX_DETAILS]
+    if SUBJECT in latexable and inspect.isclass(latexable[SUBJECT]):
+        latexable[SUBJECT] = latexable[SUBJECT].describe()
+    return latexable
 
-    def __init__(self, instr, **kwargs):
-        self.instr = instr
-        if LATEX_DETAILS in kwargs:
-            self.latexable = kwargs[LATEX_DETAILS]
-            if SUBJECT in self.latexable and inspect.isclass(self.latexable[SUBJECT]):
-                self.latexable[SUBJECT] = self.latexable[SUBJECT].describe()
+
+class Text(Node):
+    # shared by the leaves that carry (template, args) text
+    __slots__ = ()
+
+    def text(self) -> str:
+        return self.template.format(*self.args) if self.args else self.template
+
+    def digest(self) -> int:
+        return hash((type(self).__name__, self.template, self.args))
+
+    def same_as(self, other: Node) -> bool:
+        # args are interned by FlowChart, and == on them can't tell 1 from True
+        return type(self) is type(other) and self.args is other.args and _state(self) == _state(other)
+
+
+@dataclass(slots=True)
+class Instr(Text):
+    template: str
+    args: tuple = ()
+    latexable: dict | None = None
+
+    def __init__(self, instr, args=(), **kwargs):
+        self.template = instr
+        self.args = args
+        self.latexable = _latexable(kwargs)
+
+    @property
+    def instr(self) -> str:
+        return self.text()
 
     def toXML(self) -> str:
         return f"<instruction>{escape(self.instr)}</instruction>"
 
     def toLatex(self) -> str:
-        if hasattr(self,"latexable"):
+        if self.latexable is not None:
+            if OBJECT not in self.latexable:
+                return f"{self.latexable[SUBJECT]} did {self.latexable[VERB]} with additional settings {self.latexable[SETTINGS]}"
             return f"{self.latexable[SUBJECT]} did {self.latexable[VERB]} to {self.latexable[OBJECT]} with additional settings {self.latexable[SETTINGS]}"
         return ''
 
-@dataclass
-class Note(Node):
-    instr: str
+@dataclass(slots=True)
+class Note(Text):
+    template: str
+    args: tuple = ()
+    latexable: dict | None = None
 
-    def __init__(self, instr, **kwargs):
-        self.instr = instr
-        if LATEX_DETAILS in kwargs:
-            self.latexable = kwargs[LATEX_DETAILS]
-            if SUBJECT in self.latexable and inspect.isclass(self.latexable[SUBJECT]):
-                self.latexable[SUBJECT] = self.latexable[SUBJECT].describe()
+    def __init__(self, instr, args=(), **kwargs):
+        self.template = instr
+        self.args = args
+        self.latexable = _latexable(kwargs)
+
+    @property
+    def instr(self) -> str:
+        return self.text()
 
     def toXML(self) -> str:
         return f"<note>{escape(self.instr)}</note>"
 
     def toLatex(self) -> str:
-        if hasattr(self,"latexable"):
+        if self.latexable is not None:
             return f"{self.latexable[SUBJECT]} did {self.latexable[VERB]} with settings {self.latexable[SETTINGS]}"
         return ''
 
 
-@dataclass
-class Header(Node):
-    header: str
+@dataclass(slots=True)
+class Header(Text):
+    template: str
+    binding: tuple[str, object] | None = None # (loop variable, value) for loop headers
+    args: tuple = ()
+
+    @property
+    def header(self) -> str:
+        return self.text()
 
     def toXML(self) -> str:
         return f"<header>{escape(self.header)}</header>"
@@ -97,104 +347,626 @@ class Header(Node):
     def FindFabbedCount(self) -> int:
         return 0
 
+def _settings_in(body: Node) -> dict:
+    # the settings dicts handed to the instructions directly in a body
+    found = {}
+    for node in getattr(body, 'nodes', ()):
+        for arg in getattr(node, 'args', ()):
+            if isinstance(arg, _Settings):
+                for key, value in arg:
+                    found.setdefault(str(key), value)
+    return found
+
+
+def _body_latex(body: Node) -> str:
+    nodes = getattr(body, 'nodes', None)
+    if nodes is not None and not any(isinstance(x, Container) for x in nodes):
+        # just instructions; skip the walk, and usually all of them, since few have LaTeX
+        if all(getattr(x, 'latexable', None) is None for x in nodes):
+            return ''
+        return ''.join(["\n" + x.toLatex() for x in nodes]).strip()
+    return body.toLatex().strip()
+
+
+def _number(x: float) -> str:
+    return str(int(x)) if x.is_integer() else repr(round(x, 10))
+
+
+def _is_number(value) -> bool:
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, numbers.Real):
+        return True
+    try:
+        float(value)
+        return isinstance(value, str)
+    except (TypeError, ValueError):
+        return False
+
+
+def _same_column(a: list, b: list) -> bool:
+    try:
+        return a == b
+    except ValueError: # arrays don't have a single truth value
+        return False
+
+
+def describe_column(name: str, values: list) -> str | None:
+    # None if everything in the column is the same
+    try:
+        distinct = list(dict.fromkeys(values))
+    except TypeError:
+        distinct = list(dict.fromkeys(map(repr, values)))
+    if len(distinct) < 2:
+        return None
+    shown = [x for x in distinct if x is not None]
+    if len(shown) > 2 and all(_is_number(x) for x in shown):
+        nums = sorted(float(x) for x in shown)
+        step = nums[1] - nums[0]
+        if step and all(math.isclose(b - a, step, rel_tol=1e-9) for a, b in zip(nums, nums[1:])):
+            return f"{name} in {_number(nums[0])}..{_number(nums[-1])} step {_number(step)}"
+        return f"{name} in {_number(nums[0])}..{_number(nums[-1])} ({len(nums)} values)"
+    if len(shown) > 6:
+        return f"{name} in {{{', '.join(map(str, shown[:5]))}, ...}} ({len(shown)} values)"
+    return f"{name} in {{{', '.join(map(str, shown))}}}"
+
+
+class Loop(Container):
+    # what the loop looks like from the outside; the streaming sink writes these same pieces
+    # as the loop is being evaluated, so both must stay in sync with xml_parts below.
+    tag: str
+    item_tag: str
+    latex_intro: str
+    nodes: list[Node]
+    summarized = False # whether the LaTeX describes what varies instead of every iteration
+
+    def xml_head(self) -> str:
+        ...
+
+    def xml_tail(self) -> str:
+        ...
+
+    def children(self):
+        return tuple(self.nodes)
+
+    def iterations(self) -> Iterator[Node]:
+        for x in self.nodes:
+            if isinstance(x, Repeated):
+                yield from x.expand()
+            else:
+                yield x
+
+    def xml_parts(self):
+        yield self.xml_head()
+        for x in self.iterations():
+            yield f"<{self.item_tag}>"
+            yield x
+            yield f"</{self.item_tag}>"
+        yield self.xml_tail()
+
+    def find_differences_in_children(self) -> list[tuple[str, str]]:
+        # one column per loop variable or setting, with an entry per iteration, so what varies
+        # is found by going down each column once instead of comparing iterations pairwise.
+        # iterations whose bodies come out as the same LaTeX are described together; returns
+        # (what varies, that LaTeX) for each such group.
+        groups: dict[str, tuple[list[int], dict[str, list]]] = {}
+        seen: dict[int, tuple[str, dict]] = {}
+        for x in self.nodes:
+            name, values = None, [None]
+            if isinstance(x, Repeated):
+                body, name, values = x.body, x.name, list(x.values)
+            elif isinstance(x, Bound):
+                body = x.body
+                if x.header.binding is not None:
+                    name, values = x.header.binding[0], [x.header.binding[1]]
+            elif isinstance(x, Block) and not x.nodes:
+                continue # the body that was still open when the loop ended
+            else:
+                body = x
+            if id(body) not in seen:
+                seen[id(body)] = (_body_latex(body), _settings_in(body))
+            latex, settings = seen[id(body)]
+            count, columns = groups.setdefault(latex, ([0], {}))
+            n = len(values)
+            row = [(name, values)] if name is not None else []
+            row += [(key, [value] * n) for key, value in settings.items() if key != name]
+            for key, cells in row:
+                column = columns.get(key)
+                if column is None:
+                    column = columns[key] = [None] * count[0] # absent from earlier iterations
+                elif len(column) < count[0]:
+                    column.extend([None] * (count[0] - len(column)))
+                column.extend(cells)
+            count[0] += n
+
+        out = []
+        for latex, (count, columns) in groups.items():
+            for column in columns.values():
+                column.extend([None] * (count[0] - len(column)))
+            described, varying = [], []
+            for name, values in columns.items():
+                if any(_same_column(values, other) for other in varying):
+                    continue # e.g. a loop variable that is just passed on as a setting
+                description = describe_column(name, values)
+                if description is not None:
+                    described.append(description)
+                    varying.append(values)
+            what = f"for {' × '.join(described)}" if described else f"the same thing {count[0]} times"
+            out.append((what, latex))
+        return out
+
+    def latex_parts(self):
+        yield self.latex_intro
+        if not self.summarized:
+            yield from _joined(self.iterations(), ' ')
+            return
+        summary = '; '.join(f"{what}: {latex}" if latex else what for what, latex in self.find_differences_in_children())
+        yield summary if summary.endswith('.') else summary + '.'
+
+
 @dataclass
-class Par(Node):
+class Par(Loop):
     nodes: list[Node]
 
-    def toXML(self) -> str:
-        return f"<in-parallel>{''.join(map(lambda x: f'<par-item>{x.toXML()}</par-item>', self.nodes))}</in-parallel>"
+    tag = "in-parallel"
+    summarized = True
+    item_tag = "par-item"
+    latex_intro = "In no particular order, we tested "
 
-    def find_differences_in_children(self) -> str:
-        base_case = self.nodes[0]
-        # ok, do something painful like evaluate all the values :sob:
-        if not hasattr(base_case, "other"):
-            # hmmm... we are a bit in trouble.
-            pass
+    def xml_head(self) -> str:
+        return f"<{self.tag}>"
 
-    def toLatex(self) -> str:
-        return f"In no particular order, we tested {' '.join([x.toLatex() for x in self.nodes])}"
+    def xml_tail(self) -> str:
+        return f"</{self.tag}>"
 
 
 @dataclass
-class Series(Node):
+class Series(Loop):
     nodes: list[Node]
 
-    def toXML(self) -> str:
-        return f"<in-series>{''.join(map(lambda x: f'<series-item>{x.toXML()}</series-item>', self.nodes))}</in-series>"
+    tag = "in-series"
+    summarized = True
+    item_tag = "series-item"
+    latex_intro = "In sequence, we tested "
 
-    def toLatex(self) -> str:
-        return f"In sequence, we tested {' '.join([x.toLatex() for x in self.nodes])}"
+    def xml_head(self) -> str:
+        return f"<{self.tag}>"
+
+    def xml_tail(self) -> str:
+        return f"</{self.tag}>"
 
 @dataclass
-class Infinite(Node):
+class Infinite(Loop):
     cond: str
     nodes: list[Node]
 
-    def toXML(self) -> str:
-        return f"<loop condition=\"{escape(self.cond)}\">{''.join(map(lambda x: f'<loop-item>{x.toXML()}</loop-item>', self.nodes))}</loop>"
+    tag = "loop"
+    item_tag = "loop-item"
+    latex_intro = "Until the condition was met, we tested "
 
-    def toLatex(self) -> str:
-        return f"Until the condition was met, we tested {' '.join([x.toLatex() for x in self.nodes])}"
+    def own_key(self) -> tuple:
+        return (self.cond,)
 
+    def xml_head(self) -> str:
+        return f"<{self.tag} condition=\"{escape(self.cond)}\">"
 
-class FlowChart:
+    def xml_tail(self) -> str:
+        return f"</{self.tag}>"
 
-    def __new__(cls):
-        if not hasattr(cls, 'instance'):
-            cls.instance = super(FlowChart, cls).__new__(cls)
-        return cls.instance
 
-    node: Node = Empty()
-    in_loop: list[Node] = []
+class FlowChartSink:
+    # where the FlowChart puts things as the experiment is evaluated. the loop passed to
+    # enter_loop comes with one open, empty body; end_body closes it and opens the next.
 
-    fabbed_objects: int = 0
+    def append(self, node: Node, fabbing=False):
+        ...
 
-    def reset(self):
-        self.node = Empty()
-        self.in_loop = []
-        self.fabbed_objects = 0
+    def enter_loop(self, loop: Loop):
+        ...
 
-    def _append_node(self, node):
+    def end_body(self):
+        ...
+
+    def exit_loop(self):
+        ...
+
+    def repeat_body(self, values: Sequence, name: str):
+        # the body that just ended stands in for one more iteration per value (symbolic mode)
+        raise NotImplementedError(f"{type(self).__name__} can't repeat loop bodies")
+
+    def close(self):
+        pass
+
+
+class TreeSink(FlowChartSink):
+    """Keeps the whole experiment in memory as a tree of nodes.
+
+    Finished subtrees are hash-consed: an instruction, loop body or loop that is structurally
+    the same as one we already have is stored once and shared, so the tree is really a DAG
+    whose size follows the number of distinct bodies rather than the number of iterations.
+    Loop iterations keep their own header (and its loop variable binding) in a Bound."""
+
+    def __init__(self):
+        self.node = Block()
+        self.in_loop: list[Loop] = []
+        # almost every digest belongs to a single node; a list only shows up on collisions
+        self.interned: dict[int, Node | list[Node]] = {}
+
+    def intern(self, node: Node) -> Node:
+        key = node.digest()
+        found = self.interned.get(key)
+        candidates = found if isinstance(found, list) else [] if found is None else [found]
+        for other in candidates:
+            if node.same_as(other):
+                return other
+        if isinstance(node, Container):
+            node._digest = key
+        self.interned[key] = node if found is None else candidates + [node]
+        return node
+
+    def distinct_nodes(self) -> int:
+        return sum(len(x) if isinstance(x, list) else 1 for x in self.interned.values())
+
+    def append(self, node: Node, fabbing=False):
+        if not isinstance(node, Header) or node.binding is None:
+            node = self.intern(node)
         if len(self.in_loop) > 0:
-            self.in_loop[-1].nodes[-1] = Seq(self.in_loop[-1].nodes[-1], # type: ignore
-                                 node)
-            # (Safe because in_loop always has loops)
+            self.in_loop[-1].nodes[-1].nodes.append(node) # type: ignore
+            # (Safe because in_loop always has loops, and their last body is always an open Block)
+        else:
+            self.node.nodes.append(node)
+
+    def _close_body(self):
+        bodies = self.in_loop[-1].nodes
+        body = bodies[-1]
+        first = body.nodes[0] if body.nodes else None
+        if isinstance(first, Header) and first.binding is not None:
+            bodies[-1] = Bound(first, self.intern(Block(body.nodes[1:])))
+        else:
+            bodies[-1] = self.intern(body)
+
+    def enter_loop(self, loop: Loop):
+        self.in_loop.append(loop)
+
+    def end_body(self):
+        self._close_body()
+        self.in_loop[-1].nodes.append(Block())
+        # (Safe because in_loop always has loops, and in_loop must have at least one element since
+        # we're in a body)
+
+    def exit_loop(self):
+        self._close_body()
+        loop = self.in_loop.pop()
+        self.append(loop)
+
+    def repeat_body(self, values: Sequence, name: str):
+        bodies = self.in_loop[-1].nodes
+        if len(values) == 0 or len(bodies) < 2 or not isinstance(bodies[-2], Bound):
+            return
+        bodies.insert(len(bodies) - 1, Repeated(bodies[-2].body, name, values))
+
+
+class XMLStreamSink(FlowChartSink):
+    """Writes the experiment XML as it is produced. Only the stack of open loops is kept,
+    so memory doesn't grow with the number of instructions. The file ends up identical to
+    what TreeSink().node.writeXML would have written."""
+
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.in_loop: list[Loop] = []
+
+    def append(self, node: Node, fabbing=False):
+        self.out_file.write("\n")
+        if isinstance(node, Container):
+            node.writeXML(self.out_file)
         else:
-            self.node = Seq(self.node, node)
+            self.out_file.write(node.toXML())
 
+    def enter_loop(self, loop: Loop):
+        self.in_loop.append(loop)
+        self.out_file.write(f"\n{loop.xml_head()}<{loop.item_tag}>")
+
+    def end_body(self):
+        item_tag = self.in_loop[-1].item_tag
+        self.out_file.write(f"</{item_tag}><{item_tag}>")
 
-    def add_instruction(self, x: str, header=False, fabbing=False, **kwargs):
-        self._append_node(Instr(x, **kwargs) if not header else Header(x))
+    def exit_loop(self):
+        loop = self.in_loop.pop()
+        self.out_file.write(f"</{loop.item_tag}>{loop.xml_tail()}")
+
+    def close(self):
+        self.out_file.flush()
+
+
+class CountingSink(FlowChartSink):
+    """Only keeps totals, for sizing an experiment without keeping any of it around."""
+
+    FIELDS = ("instructions", "notes", "headers", "fabrications", "loops", "iterations")
+
+    def __init__(self):
+        self.instructions = 0
+        self.notes = 0
+        self.headers = 0
+        self.fabrications = 0
+        self.loops = 0
+        self.iterations = 0
+        # totals at the start of the current body of each open loop, and what the last
+        # finished body added, so that symbolic mode can multiply it out
+        self.body_start: list[tuple[int, ...]] = []
+        self.last_body: tuple[int, ...] = ()
+
+    def append(self, node: Node, fabbing=False):
+        if isinstance(node, Header):
+            self.headers += 1
+        elif isinstance(node, Note):
+            self.notes += 1
+        elif isinstance(node, Instr):
+            self.instructions += 1
         if fabbing:
-            self.fabbed_objects += 1
+            self.fabrications += 1
+
+    def enter_loop(self, loop: Loop):
+        self.loops += 1
+        self.body_start.append(self._totals())
+
+    def end_body(self):
+        self.iterations += 1
+        now = self._totals()
+        self.last_body = tuple(n - s for n, s in zip(now, self.body_start[-1]))
+        self.body_start[-1] = now
 
-    def add_note(self, x: str, fabbing=False, **kwargs):
-        self._append_node(Note(x, **kwargs))
+    def exit_loop(self):
+        self.body_start.pop()
+
+    def repeat_body(self, values: Sequence, name: str):
+        times = len(values)
+        for field, delta in zip(self.FIELDS, self.last_body):
+            setattr(self, field, getattr(self, field) + delta * times)
+        self.body_start[-1] = self._totals()
+
+    def _totals(self) -> tuple[int, ...]:
+        return tuple(getattr(self, field) for field in self.FIELDS)
+
+    def counts(self) -> dict[str, int]:
+        return dict(zip(self.FIELDS, self._totals()))
+
+    def __repr__(self) -> str:
+        return ', '.join(f"{count} {what}" for what, count in self.counts().items())
+
+
+# what the index counts, each keyed by name: kinds of node ("instructions", "fabrications",
+# "loops", ...), device classes, devices that fabricated something, measurement names, object uids
+INDEX_FIELDS = ("kinds", "devices", "fabricated_by", "measurements", "objects")
+
+
+def _counts() -> dict[str, Counter]:
+    return {field: Counter() for field in INDEX_FIELDS}
+
+
+def _add_counts(into: dict[str, Counter], counts: dict[str, Counter], times=1, skip=()):
+    for field, counter in counts.items():
+        if field in skip:
+            continue
+        into[field].update(counter if times == 1 else {k: v * times for k, v in counter.items()})
+
+
+@dataclass
+class LoopStats:
+    kind: str
+    depth: int
+    name: str | None = None # the loop variable, once an iteration header has told us
+    iterations: int = 0
+    counts: dict[str, Counter] = field(default_factory=_counts)
+
+
+class FlowChartIndex:
+    """Counts kept up to date while the experiment is evaluated, so questions like "how many
+    objects does the laser cut" or "what happens to object #12" don't need the XML.
+
+    Whatever adds an instruction can tag it with device= (a class, or its name),
+    measurement= (a Measurement, or its name) and uids= (the objects it touches)."""
+
+    def __init__(self):
+        self.counts = _counts()
+        self.loops: list[LoopStats] = []
+        self.touching: dict[int, list[Node]] = defaultdict(list)
+        # one entry per open loop: its stats and what its current body has added so far
+        self.open: list[LoopStats] = []
+        self.bodies: list[dict[str, Counter]] = []
+        self.last_body: dict[str, Counter] = _counts()
+
+    def _bump(self, field: str, key):
+        self.counts[field][key] += 1
+        if self.bodies:
+            self.bodies[-1][field][key] += 1
+
+    def append(self, node: Node, fabbing=False, device=None, measurement=None, uids=()):
+        if isinstance(node, Header):
+            self._bump("kinds", "headers")
+            if node.binding is not None and self.open and self.open[-1].name is None:
+                self.open[-1].name = node.binding[0]
+        else:
+            self._bump("kinds", "notes" if isinstance(node, Note) else "instructions")
+        device = getattr(device, "__name__", device)
+        if device is not None:
+            self._bump("devices", device)
         if fabbing:
-            self.fabbed_objects += 1
+            self._bump("kinds", "fabrications")
+            if device is not None:
+                self._bump("fabricated_by", device)
+        if measurement is not None:
+            self._bump("measurements", getattr(measurement, "name", measurement))
+        for uid in uids:
+            self._bump("objects", uid)
+            self.touching[uid].append(node)
+
+    def enter_loop(self, kind: str):
+        self._bump("kinds", "loops")
+        stats = LoopStats(kind, len(self.open))
+        self.loops.append(stats)
+        self.open.append(stats)
+        self.bodies.append(_counts())
+
+    def _fold_body(self) -> dict[str, Counter]:
+        body = self.bodies.pop()
+        _add_counts(self.open[-1].counts, body)
+        if self.bodies:
+            _add_counts(self.bodies[-1], body)
+        return body
+
+    def end_body(self):
+        self.last_body = self._fold_body()
+        self.open[-1].iterations += 1
+        self.bodies.append(_counts())
+        if len(self.bodies) > 1:
+            self.bodies[-2]["kinds"]["iterations"] += 1
+        self.counts["kinds"]["iterations"] += 1
+
+    def exit_loop(self):
+        # normally empty, unless the loop was broken out of partway through a body
+        self._fold_body()
+        self.open.pop()
+
+    def repeat_body(self, values: Sequence, name: str):
+        # the objects in the repeated bodies were never made, so there are no uids to count
+        times = len(values)
+        self.open[-1].iterations += times
+        self.open[-1].name = self.open[-1].name or name
+        _add_counts(self.open[-1].counts, self.last_body, times, skip=("objects",))
+        _add_counts(self.counts, self.last_body, times, skip=("objects",))
+        if len(self.bodies) > 1:
+            _add_counts(self.bodies[-2], self.last_body, times, skip=("objects",))
+        self.counts["kinds"]["iterations"] += times
+        if len(self.bodies) > 1:
+            self.bodies[-2]["kinds"]["iterations"] += times
+
+    def count(self, field: str, key) -> int:
+        return self.counts[field][key]
+
+    def fabrications(self, device=None) -> int:
+        if device is None:
+            return self.counts["kinds"]["fabrications"]
+        return self.counts["fabricated_by"][getattr(device, "__name__", device)]
+
+    def device(self, device) -> int:
+        return self.counts["devices"][getattr(device, "__name__", device)]
+
+    def measurement(self, measurement) -> int:
+        return self.counts["measurements"][getattr(measurement, "name", measurement)]
+
+    def nodes_for(self, uid: int) -> list[Node]:
+        return self.touching.get(uid, [])
+
+    def summary(self) -> dict[str, dict]:
+        return {field: dict(counter) for field, counter in self.counts.items() if field != "objects"}
+
+
+class FlowChart:
+    # one per experiment context (see context.py), so FlowChart() is the flowchart of
+    # whichever experiment is being evaluated in this thread or task
+
+    def __new__(cls):
+        from context import current_context
+        context = current_context()
+        if context.flowchart is None:
+            context.flowchart = super(FlowChart, cls).__new__(cls)
+            context.flowchart.reset()
+        return context.flowchart
+
+    sink: FlowChartSink
+    index: FlowChartIndex
+
+    def reset(self):
+        self.sink = TreeSink()
+        self.index = FlowChartIndex()
+        self.interned_args = {}
+        self.recording = None # see incremental.py
+        self.simulation = None # see simulation.py
+
+    @property
+    def fabbed_objects(self) -> int:
+        return self.index.fabrications()
+
+    def use_sink(self, sink: FlowChartSink):
+        self.sink = sink
+
+    @property
+    def node(self) -> Block | None:
+        # only there if we are keeping the tree around
+        return getattr(self.sink, "node", None)
+
+    def intern(self, template: str, args: tuple) -> tuple[str, tuple]:
+        if not args:
+            return sys.intern(template), ()
+        frozen, keys = zip(*(freeze(x) for x in args))
+        if frozen == keys and all(type(x) in (str, int) for x in frozen):
+            keys = frozen
+        return sys.intern(template), self.interned_args.setdefault(keys, frozen)
+
+    def add_instruction(self, x: str, header=False, fabbing=False, args=(),
+                        device=None, measurement=None, uids=(), **kwargs):
+        x, args = self.intern(x, args)
+        if self.recording is not None:
+            self.recording.append(("add_instruction", (x, header, fabbing, args, device, measurement, uids), kwargs))
+        node = Instr(x, args, **kwargs) if not header else Header(x, kwargs.get('binding'), args)
+        self.sink.append(node, fabbing)
+        self.index.append(node, fabbing, device, measurement, uids)
+        if self.simulation is not None:
+            self.simulation.add_instruction(x, args, header, fabbing, device, measurement, uids, kwargs)
+
+    def add_note(self, x: str, fabbing=False, args=(), device=None, measurement=None, uids=(), **kwargs):
+        x, args = self.intern(x, args)
+        if self.recording is not None:
+            self.recording.append(("add_note", (x, fabbing, args, device, measurement, uids), kwargs))
+        node = Note(x, args, **kwargs)
+        self.sink.append(node, fabbing)
+        self.index.append(node, fabbing, device, measurement, uids)
+        if self.simulation is not None:
+            self.simulation.add_instruction(x, args, False, fabbing, device, measurement, uids,
+                                            dict(kwargs, attended=False))
 
     def enter_loop(self, kind: Union[Literal["series"], Literal["parallel"], str]):
+        if self.recording is not None:
+            self.recording.append(("enter_loop", (kind,), {}))
         match kind:
             case "series":
-                loop = Series([Empty()])
+                loop = Series([Block()])
             case "parallel":
-                loop = Par([Empty()])
+                loop = Par([Block()])
             case cond:
                 if isinstance(cond, str):
-                    loop = Infinite(cond, [Empty()])
+                    loop = Infinite(cond, [Block()])
 
-        self.in_loop.append(loop)
+        self.sink.enter_loop(loop)
+        self.index.enter_loop(kind)
+        if self.simulation is not None:
+            self.simulation.enter_loop(kind)
 
     def end_body(self):
-        self.in_loop[-1].nodes.append(Empty()) # type: ignore
-        # (Safe because in_loop always has loops, and in_loop must have at least one element since
-        # we're in a body)
+        if self.recording is not None:
+            self.recording.append(("end_body", (), {}))
+        self.sink.end_body()
+        self.index.end_body()
+        if self.simulation is not None:
+            self.simulation.end_body()
 
     def exit_loop(self):
-        loop = self.in_loop[-1]
-        self.in_loop = self.in_loop[:-1]
-        self._append_node(loop)
+        if self.recording is not None:
+            self.recording.append(("exit_loop", (), {}))
+        self.sink.exit_loop()
+        self.index.exit_loop()
+        if self.simulation is not None:
+            self.simulation.exit_loop()
+
+    def repeat_body(self, values: Sequence, name: str):
+        if self.recording is not None:
+            self.recording.append(("repeat_body", (values, name), {}))
+        self.sink.repeat_body(values, name)
+        self.index.repeat_body(values, name)
 
     def to_latex(self):
+        if self.node is None:
+            raise ValueError(f"LaTeX is written from the flowchart tree, which a {type(self.sink).__name__} "
+                             f"doesn't keep; use sink=\"tree\"")
         print(f"We fabricated {self.fabbed_objects} objects in total.")
-        return self.node.toLatex()
\ No newline at end of file
+        return self.node.toLatex()
@@ -0,0 +1,278 @@
+import sys
+import xml.etree.ElementTree as ET
+from collections import Counter
+from dataclasses import dataclass, field
+
+from flowchart import Bound, Container, FlowChart, Header, Infinite, Instr, Loop, Node, Note
+
+# compares two flowcharts in the shape their XML has: a sequence of instructions, notes,
+# headers and loops, where each loop has a sequence per iteration. every entry carries a
+# digest of everything under it, so identical regions (most of a protocol, usually) are
+# matched by comparing one hash, and we only walk down into the parts that differ.
+
+FAB_PREFIX = "this creates physical object"
+
+
+@dataclass(slots=True)
+class Entry:
+    kind: str # instruction/note/header, or the loop's tag
+    text: str # the text, or the loop condition
+    items: list[list["Entry"]] | None = None # one sequence per loop iteration
+    digest: int = 0
+
+
+def _seq_digest(entries: list[Entry]) -> int:
+    return hash(tuple(e.digest for e in entries))
+
+
+def _leaf(kind: str, text: str) -> Entry:
+    return Entry(kind, text, None, hash((kind, text)))
+
+
+def _loop(kind: str, text: str, items: list[list[Entry]]) -> Entry:
+    # every loop ends with an empty body (the one that was open when it exited); it's not an iteration
+    items = [x for x in items if x]
+    return Entry(kind, text, items, hash((kind, text, tuple(_seq_digest(x) for x in items))))
+
+
+class _FromNodes:
+    # shared subtrees (interned bodies, the body a Repeated stands in for) are converted once
+
+    def __init__(self):
+        self.memo: dict[int, list[Entry]] = {}
+
+    def entries(self, node: Node) -> list[Entry]:
+        if isinstance(node, Bound):
+            return self.entries(node.header) + self.entries(node.body)
+        if isinstance(node, Header):
+            # Repeated makes these on the fly, so they can't be memoized by id
+            return [_leaf("header", node.header)]
+        if id(node) in self.memo:
+            return self.memo[id(node)]
+        if isinstance(node, Instr):
+            out = [_leaf("instruction", node.instr)]
+        elif isinstance(node, Note):
+            out = [_leaf("note", node.instr)]
+        elif isinstance(node, Loop):
+            out = [_loop(node.tag, node.cond if isinstance(node, Infinite) else '',
+                         [self.entries(x) for x in node.iterations()])]
+        elif isinstance(node, Container):
+            out = [e for x in node.children() for e in self.entries(x)]
+        else:
+            out = []
+        self.memo[id(node)] = out
+        return out
+
+
+def _from_xml(element) -> list[Entry]:
+    out = []
+    for x in element:
+        if x.tag in ("instruction", "note", "header"):
+            out.append(_leaf(x.tag, x.text or ''))
+        else:
+            out.append(_loop(x.tag, x.get("condition", ''), [_from_xml(item) for item in x]))
+    return out
+
+
+def flowchart_entries(source) -> list[Entry]:
+    """source is a FlowChart, a flowchart node, or the path of a snapshot (.fedt) or XML file."""
+    if isinstance(source, FlowChart):
+        source = source.node
+    if isinstance(source, str):
+        if source.endswith(".fedt"):
+            from flowchart_snapshot import load_snapshot
+            source = load_snapshot(source)
+        else:
+            with open(source) as f:
+                return _from_xml(ET.fromstring(f"<data>{f.read()}</data>"))
+    return _FromNodes().entries(source)
+
+
+@dataclass
+class Change:
+    what: str # inserted, removed or changed
+    where: str
+    kind: str
+    old: str | None = None
+    new: str | None = None
+
+    def __str__(self) -> str:
+        where = self.where or "top level"
+        match self.what:
+            case "inserted":
+                return f"+ {where}: {self.kind} {self.new!r}"
+            case "removed":
+                return f"- {where}: {self.kind} {self.old!r}"
+        return f"~ {where}: {self.kind} {self.old!r} -> {self.new!r}"
+
+
+@dataclass
+class LoopChange:
+    where: str
+    kind: str
+    old_iterations: int
+    new_iterations: int
+    removed: list[str] = field(default_factory=list) # iteration headers only in the old one
+    added: list[str] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        out = f"@ {self.where}: {self.kind} went from {self.old_iterations} to {self.new_iterations} iterations"
+        if self.removed:
+            out += f"; dropped {', '.join(self.removed)}"
+        if self.added:
+            out += f"; added {', '.join(self.added)}"
+        return out
+
+
+@dataclass
+class FlowChartDiff:
+    changes: list[Change] = field(default_factory=list)
+    loops: list[LoopChange] = field(default_factory=list)
+    old_fabricated: int = 0
+    new_fabricated: int = 0
+
+    @property
+    def fabricated_delta(self) -> int:
+        return self.new_fabricated - self.old_fabricated
+
+    def counts(self) -> dict[str, int]:
+        return dict(Counter(c.what for c in self.changes))
+
+    def __bool__(self) -> bool:
+        return bool(self.changes or self.loops)
+
+    def __str__(self) -> str:
+        lines = [str(x) for x in self.loops] + [str(x) for x in self.changes]
+        summary = ', '.join(f"{n} {what}" for what, n in self.counts().items()) or "no changes"
+        lines.append(f"{summary}; fabricated objects {self.old_fabricated} -> {self.new_fabricated} "
+                     f"({self.fabricated_delta:+d})")
+        return '\n'.join(lines)
+
+
+def _fabricated(entries: list[Entry], memo: dict[int, int]) -> int:
+    digest = _seq_digest(entries)
+    if digest not in memo:
+        total = 0
+        for e in entries:
+            if e.items is not None:
+                total += sum(_fabricated(x, memo) for x in e.items)
+            elif e.text.startswith(FAB_PREFIX):
+                total += 1
+        memo[digest] = total
+    return memo[digest]
+
+
+def _iteration_label(entries: list[Entry], i: int) -> str:
+    if entries and entries[0].kind == "header":
+        return entries[0].text
+    return f"iteration {i}"
+
+
+def _describe(e: Entry) -> str:
+    if e.items is None:
+        return e.text
+    return f"{e.text} ({len(e.items)} iterations)".strip()
+
+
+def _anchors(a: list[Entry], b: list[Entry]) -> list[tuple[int, int]]:
+    # entries that occur exactly once on each side, kept while they stay in order
+    once_a = Counter(e.digest for e in a)
+    once_b = Counter(e.digest for e in b)
+    where_b = {e.digest: j for j, e in enumerate(b) if once_b[e.digest] == 1}
+    out, last = [], -1
+    for i, e in enumerate(a):
+        j = where_b.get(e.digest)
+        if j is not None and once_a[e.digest] == 1 and j > last:
+            out.append((i, j))
+            last = j
+    return out
+
+
+class _Differ:
+
+    def __init__(self):
+        self.diff = FlowChartDiff()
+
+    def sequence(self, a: list[Entry], b: list[Entry], where: str):
+        start = 0
+        while start < len(a) and start < len(b) and a[start].digest == b[start].digest:
+            start += 1
+        end_a, end_b = len(a), len(b)
+        while end_a > start and end_b > start and a[end_a - 1].digest == b[end_b - 1].digest:
+            end_a -= 1
+            end_b -= 1
+        a, b = a[start:end_a], b[start:end_b]
+        i = j = 0
+        for ai, bj in _anchors(a, b) + [(len(a), len(b))]:
+            self.gap(a[i:ai], b[j:bj], where)
+            i, j = ai + 1, bj + 1
+
+    def gap(self, a: list[Entry], b: list[Entry], where: str):
+        # what's left has no exact matches, so pair things up by kind, in order
+        i = j = 0
+        left_in_b = Counter(y.kind for y in b)
+        while i < len(a) and j < len(b):
+            x, y = a[i], b[j]
+            if x.kind == y.kind:
+                left_in_b[y.kind] -= 1
+                if x.items is None:
+                    self.diff.changes.append(Change("changed", where, x.kind, x.text, y.text))
+                else:
+                    self.loop(x, y, where)
+                i += 1
+                j += 1
+            elif left_in_b[x.kind] > 0:
+                left_in_b[y.kind] -= 1
+                self.inserted(y, where)
+                j += 1
+            else:
+                self.removed(x, where)
+                i += 1
+        for x in a[i:]:
+            self.removed(x, where)
+        for y in b[j:]:
+            self.inserted(y, where)
+
+    def inserted(self, e: Entry, where: str):
+        self.diff.changes.append(Change("inserted", where, e.kind, new=_describe(e)))
+
+    def removed(self, e: Entry, where: str):
+        self.diff.changes.append(Change("removed", where, e.kind, old=_describe(e)))
+
+    def loop(self, x: Entry, y: Entry, where: str):
+        where = f"{where}/{x.kind}" if where else x.kind
+        if x.text != y.text:
+            self.diff.changes.append(Change("changed", where, "condition", x.text, y.text))
+        old = {}
+        for i, items in enumerate(x.items):
+            old.setdefault(_iteration_label(items, i), items)
+        new = {}
+        for i, items in enumerate(y.items):
+            new.setdefault(_iteration_label(items, i), items)
+        removed = [label for label in old if label not in new]
+        added = [label for label in new if label not in old]
+        if removed or added or len(x.items) != len(y.items):
+            self.diff.loops.append(LoopChange(where, x.kind, len(x.items), len(y.items), removed, added))
+        for label, items in old.items():
+            if label in new:
+                self.sequence(items, new[label], f"{where}[{label}]")
+
+
+def diff_flowcharts(old, new) -> FlowChartDiff:
+    """Compares two flowcharts; each can be a FlowChart, a flowchart node, or the path of a
+    snapshot (.fedt) or XML file."""
+    a, b = flowchart_entries(old), flowchart_entries(new)
+    differ = _Differ()
+    differ.sequence(a, b, '')
+    differ.diff.old_fabricated = _fabricated(a, {})
+    differ.diff.new_fabricated = _fabricated(b, {})
+    return differ.diff
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: python flowchart_diff.py OLD NEW  (each a .xml or .fedt file)")
+        sys.exit(2)
+    result = diff_flowcharts(sys.argv[1], sys.argv[2])
+    print(result)
+    sys.exit(1 if result else 0)
@@ -258,9 +258,13 @@ def render_flowchart(capture_function, pdf=False, remove=True, pare_down=True):
     # Build the flowchart
     flowchart = build_flowchart(xml_root, pare_down=pare_down)
 
+    show_flowchart(flowchart, capture_function.__name__, pdf=pdf)
+
+
+def show_flowchart(flowchart, name, pdf=False):
     # Save the flowchart
     if pdf:
-        fname = f'expt_flowcharts/{capture_function.__name__}_flowchart'
+        fname = f'expt_flowcharts/{name}_flowchart'
         flowchart.render(fname, format='pdf', cleanup=True)
 
         from pdf2image import convert_from_path
@@ -268,9 +272,39 @@ def render_flowchart(capture_function, pdf=False, remove=True, pare_down=True):
         im=convert_from_path(fname + '.pdf')[0]
         im.show()
     else:
-        fname = f'expt_flowcharts/{capture_function.__name__}_flowchart'
+        fname = f'expt_flowcharts/{name}_flowchart'
         flowchart.render(fname, format='png', cleanup=True)
 
         # Display the flowchart
         im=Image.open(fname + '.png')
-        im.show()
\ No newline at end of file
+        im.show()
+
+
+def node_to_element(node, parent):
+    # builds the same elements the XML file would have parsed into, straight from the nodes
+    from flowchart import Container, Header, Infinite, Instr, Loop, Note
+    if isinstance(node, Instr):
+        ET.SubElement(parent, 'instruction').text = node.instr
+    elif isinstance(node, Note):
+        ET.SubElement(parent, 'note').text = node.instr
+    elif isinstance(node, Header):
+        ET.SubElement(parent, 'header').text = node.header
+    elif isinstance(node, Loop):
+        loop = ET.SubElement(parent, node.tag, {'condition': node.cond} if isinstance(node, Infinite) else {})
+        for x in node.iterations():
+            node_to_element(x, ET.SubElement(loop, node.item_tag))
+    elif isinstance(node, Container):
+        for x in node.children():
+            node_to_element(x, parent)
+
+
+def render_snapshot(snapshot_location, pdf=False, pare_down=True):
+    from flowchart_snapshot import load_snapshot
+
+    xml_root = ET.Element('data')
+    node_to_element(load_snapshot(snapshot_location), xml_root)
+
+    flowchart = build_flowchart(xml_root, pare_down=pare_down)
+
+    name = os.path.basename(snapshot_location).rsplit('.', 1)[0]
+    show_flowchart(flowchart, name, pdf=pdf)
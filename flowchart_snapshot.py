@@ -0,0 +1,204 @@
+import mmap
+import struct
+import sys
+from array import array
+from typing import BinaryIO
+
+from flowchart import (Block, Bound, Empty, Header, Infinite, Instr, Node, Note, Par, Repeated, Seq, Series,
+                       LATEX_DETAILS, OBJECT, SETTINGS, SUBJECT, VERB)
+
+# a snapshot is a flowchart written out as tables, so it can be reopened (for rendering, LaTeX
+# or diffing) without running the experiment again or parsing its XML:
+#
+#   header      MAGIC, number of strings, nodes and edges, index of the root node
+#   offsets     uint32 per string (plus one), byte offsets into the string blob
+#   nodes       one fixed-size record per distinct node: kind, three string slots (a, b, c),
+#               and a range in the edge array
+#   edges       uint32s; child node indices for containers, string indices for leaves
+#   blob        all the strings, utf-8
+#
+# nodes are written children first, so every edge points at a lower index, and shared
+# subtrees (see TreeSink.intern) are written once. everything before the blob is 4-byte
+# aligned so the tables can be used straight out of the mmap.
+#
+# what goes in each record:
+#   Instr/Note  a=text, edges=subject, verb, object, settings (only if it has latex details)
+#   Header      a=text, b/c=loop variable and its value, if it has a binding
+#   Infinite    a=condition, edges=iterations
+#   Repeated    a=loop variable, b=body node, edges=text of each value
+#   the rest    edges=children
+
+MAGIC = b"FEDTSNP1"
+HEADER = struct.Struct("<8sIIII")
+RECORD = struct.Struct("<B3xIIIII")
+NONE = 0xFFFFFFFF
+
+KINDS = [Empty, Block, Seq, Bound, Repeated, Par, Series, Infinite, Instr, Note, Header]
+CODES = {kind: code for code, kind in enumerate(KINDS)}
+LATEX_KEYS = (SUBJECT, VERB, OBJECT, SETTINGS)
+
+
+def _children(node: Node) -> tuple[Node, ...]:
+    if isinstance(node, Repeated):
+        return (node.body,)
+    if isinstance(node, Bound):
+        return (node.header, node.body)
+    if isinstance(node, (Block, Seq, Par, Series, Infinite)):
+        return node.children()
+    return ()
+
+
+def _postorder(root: Node) -> list[Node]:
+    seen: set[int] = set()
+    order = []
+    stack = [(root, False)]
+    while stack:
+        node, done = stack.pop()
+        if id(node) in seen:
+            continue
+        if done:
+            seen.add(id(node))
+            order.append(node)
+            continue
+        stack.append((node, True))
+        for child in reversed(_children(node)):
+            if id(child) not in seen:
+                stack.append((child, False))
+    return order
+
+
+def save_snapshot(root: Node, out_file: BinaryIO | str):
+    if isinstance(out_file, str):
+        with open(out_file, "wb") as f:
+            return save_snapshot(root, f)
+
+    strings: dict[str, int] = {}
+    def string(s) -> int:
+        if s is None:
+            return NONE
+        return strings.setdefault(str(s), len(strings))
+
+    order = _postorder(root)
+    index = {id(node): i for i, node in enumerate(order)}
+    records = bytearray()
+    edges = array('I')
+    for node in order:
+        a = b = c = NONE
+        first = len(edges)
+        match node:
+            case Instr() | Note():
+                a = string(node.instr)
+                if node.latexable is not None:
+                    edges.extend(string(node.latexable.get(key)) for key in LATEX_KEYS)
+            case Header():
+                a = string(node.header)
+                if node.binding is not None:
+                    b, c = string(node.binding[0]), string(node.binding[1])
+            case Repeated():
+                a, b = string(node.name), index[id(node.body)]
+                edges.extend(string(value) for value in node.values)
+            case Infinite():
+                a = string(node.cond)
+                edges.extend(index[id(x)] for x in node.nodes)
+            case _:
+                edges.extend(index[id(x)] for x in _children(node))
+        records += RECORD.pack(CODES[type(node)], a, b, c, first, len(edges) - first)
+
+    blob = bytearray()
+    offsets = array('I', [0])
+    for s in strings:
+        blob += s.encode()
+        offsets.append(len(blob))
+    if sys.byteorder != "little":
+        offsets.byteswap()
+        edges.byteswap()
+
+    out_file.write(HEADER.pack(MAGIC, len(strings), len(order), len(edges), len(order) - 1))
+    out_file.write(offsets.tobytes())
+    out_file.write(records)
+    out_file.write(edges.tobytes())
+    out_file.write(blob)
+
+
+class Snapshot:
+    """A snapshot file, mapped into memory. Strings are only decoded, and nodes only built,
+    when something asks for them; root() builds the whole flowchart."""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mm)
+        magic, self.n_strings, self.n_nodes, self.n_edges, self.root_index = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            view.release()
+            self.mm.close()
+            raise ValueError(f"{path} is not a flowchart snapshot")
+        at = HEADER.size
+        self.offsets = self._uints(view, at, self.n_strings + 1)
+        at += 4 * (self.n_strings + 1)
+        self.records = view[at:at + RECORD.size * self.n_nodes]
+        at += RECORD.size * self.n_nodes
+        self.edges = self._uints(view, at, self.n_edges)
+        at += 4 * self.n_edges
+        self.blob = view[at:]
+        self.view = view
+        self._strings: dict[int, str] = {}
+
+    @staticmethod
+    def _uints(view: memoryview, at: int, n: int):
+        if sys.byteorder == "little":
+            return view[at:at + 4 * n].cast('I')
+        swapped = array('I', view[at:at + 4 * n])
+        swapped.byteswap()
+        return swapped
+
+    def string(self, i: int) -> str | None:
+        if i == NONE:
+            return None
+        if i not in self._strings:
+            self._strings[i] = str(self.blob[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+        return self._strings[i]
+
+    def root(self) -> Node:
+        nodes: list[Node] = []
+        edges, string = self.edges, self.string
+        for code, a, b, c, first, count in RECORD.iter_unpack(self.records):
+            kind = KINDS[code]
+            out = edges[first:first + count]
+            if kind is Instr or kind is Note:
+                if count:
+                    latex = {key: string(i) for key, i in zip(LATEX_KEYS, out) if i != NONE}
+                    node = kind(string(a), **{LATEX_DETAILS: latex})
+                else:
+                    node = kind(string(a))
+            elif kind is Header:
+                node = Header(string(a), (string(b), string(c)) if b != NONE else None)
+            elif kind is Repeated:
+                node = Repeated(nodes[b], string(a), [string(i) for i in out])
+            elif kind is Infinite:
+                node = Infinite(string(a), [nodes[i] for i in out])
+            elif kind is Bound or kind is Seq:
+                node = kind(nodes[out[0]], nodes[out[1]])
+            elif kind is Empty:
+                node = Empty()
+            else:
+                node = kind([nodes[i] for i in out])
+            nodes.append(node)
+        return nodes[self.root_index]
+
+    def close(self):
+        for view in (self.offsets, self.records, self.edges, self.blob, self.view):
+            if isinstance(view, memoryview):
+                view.release()
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_snapshot(path: str) -> Node:
+    with Snapshot(path) as snapshot:
+        return snapshot.root()
@@ -0,0 +1,200 @@
+import hashlib
+import inspect
+import marshal
+import os
+import pickle
+import random
+import sys
+import types
+
+import control
+from context import current_context
+from flowchart import FlowChart
+
+# incremental evaluation: with @fedt_experiment(incremental=True), each top-level loop of the
+# experiment that can be skipped safely (see FixLoops.loop_outputs) is keyed on its own code, the
+# values it loops over, the values of everything else it reads, and where the uid counters
+# stood. the first time round, everything the loop told the flowchart is recorded; next time
+# the same key comes up, the recording is played back instead of running the loop, so after
+# an edit only the loops that changed (or whose inputs did) are evaluated again.
+#
+# helpers the loop calls are compared by their own code only, not by what they call in turn;
+# after editing library code, call clear_loop_cache() (or delete the .fedt_cache directory).
+# the loop's outputs (see FixLoops.loop_outputs) come back as pickled copies, so only loops
+# that change nothing else can be replayed: FixLoops leaves out loops that assign through
+# anything but the experiment's own variables or go through a set, and here a loop isn't
+# cached if it goes over a set, if its outputs' sets would come back in another order, or if
+# its run changed any of its inputs other than its outputs (say, the objects in a list it
+# post-processes, or a list it appends to) or the lists, dicts and sets on the classes it
+# uses. the state of random is part of the key, and left as the loop left it.
+# measurements keep their objects in dicts (see BatchMeasurements), so loops that collect
+# them come back in the same order; a replayed set that later code adds to can still list in
+# another order.
+
+LOOP_CACHE_DIR = "loops"
+MEMORY: dict[str, bytes] = {} # key -> pickled (calls, physical uids, virtual uids, random state, outputs)
+
+
+class Uncacheable(Exception):
+    pass
+
+
+def _fingerprint(value) -> str:
+    if isinstance(value, (types.FunctionType, types.MethodType)):
+        code = inspect.unwrap(value).__code__
+        return f"{value.__qualname__}:{hashlib.sha256(marshal.dumps(code)).hexdigest()}"
+    if isinstance(value, (type, types.ModuleType, types.BuiltinFunctionType)):
+        return f"{getattr(value, '__module__', '')}.{getattr(value, '__qualname__', value.__name__)}"
+    text = repr(value)
+    if " at 0x" in text or " object at " in text:
+        # default reprs are different every run, and could even match the wrong object
+        raise Uncacheable(text)
+    return text
+
+
+def _loop_values(iterable) -> list:
+    source = getattr(iterable, "source", None)
+    if source is None or isinstance(source, (set, frozenset)):
+        raise Uncacheable(repr(iterable))
+    if iter(source) is source:
+        # a generator or other one-shot iterator: read it out now, and loop over the copy
+        source = list(iterable.iterator)
+        iterable.source = source
+        iterable.iterator = iter(source)
+    return source
+
+
+def _shared_state(inputs: dict, unchanged: tuple[str, ...]) -> bytes:
+    # what a loop could change that replaying it wouldn't: the inputs that aren't also its
+    # outputs (objects it changes in place, a global list it appends to), and the mutable class
+    # attributes of the classes it uses (and of the objects it uses)
+    classes = {x if isinstance(x, type) else type(x) for x in inputs.values()}
+    state = [("", "", name, inputs[name]) for name in unchanged if name in inputs and not isinstance(
+        inputs[name], (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType))]
+    for cls in classes:
+        for klass in cls.__mro__:
+            if klass.__module__ != "builtins":
+                state += [(klass.__module__, klass.__qualname__, name, x) for name, x in vars(klass).items()
+                          if isinstance(x, (list, dict, set)) and not name.startswith("__")]
+    return pickle.dumps(sorted(state, key=lambda x: x[:3]))
+
+
+def _same_order(ran, replayed, seen: set | None = None) -> bool:
+    # does the unpickled copy of an output go through its sets in the order the original does,
+    # and will it once more is added to them? a set built up one item at a time can come back
+    # from pickle in another order, or with a table of another size
+    seen = set() if seen is None else seen
+    if id(ran) in seen:
+        return True
+    seen.add(id(ran))
+    if isinstance(ran, (set, frozenset)):
+        if sys.getsizeof(ran) != sys.getsizeof(replayed):
+            return False
+        ran, replayed = list(ran), list(replayed)
+        if [hash(x) for x in ran] != [hash(x) for x in replayed]:
+            return False
+    if isinstance(ran, dict):
+        return _same_order(list(ran.items()), list(replayed.items()), seen)
+    if isinstance(ran, (list, tuple)):
+        return all(_same_order(a, b, seen) for a, b in zip(ran, replayed))
+    if hasattr(ran, "__dict__") and not isinstance(ran, type):
+        return _same_order(vars(ran), vars(replayed), seen)
+    return True
+
+
+class LoopCache:
+    """One top-level loop of an experiment evaluated with incremental=True."""
+
+    def __init__(self, cache_dir: str, loop_digest: str, iterable, read_names, unchanged: tuple[str, ...] = ()):
+        self.key = None
+        self.cache_file = None
+        self.calls = None
+        flowchart = FlowChart()
+        context = current_context()
+        # a replayed loop doesn't call fab(), so a rehearsal (DevicePool.plan) wouldn't see its jobs
+        if isinstance(control.MODE, control.Execute) or flowchart.recording is not None or context.rehearsing:
+            return
+        try:
+            values = _loop_values(iterable)
+            inputs = sorted((name, _fingerprint(value)) for name, value in read_names().items())
+            randomness = hashlib.sha256(repr(random.getstate()).encode()).hexdigest()
+            key = repr((loop_digest, iterable.kind(), _fingerprint(values), inputs,
+                        context.physical_uids.peek(), context.virtual_uids.peek(), randomness,
+                        sys.implementation.cache_tag))
+        except (Uncacheable, NameError, RecursionError):
+            return
+        self.key = hashlib.sha256(key.encode()).hexdigest()
+        self.cache_file = os.path.join(cache_dir, LOOP_CACHE_DIR, self.key)
+        self.read_names = read_names
+        self.unchanged = unchanged
+
+    def _load(self) -> bytes | None:
+        if self.key not in MEMORY:
+            try:
+                with open(self.cache_file, "rb") as f:
+                    MEMORY[self.key] = f.read()
+            except OSError:
+                return None
+        return MEMORY[self.key]
+
+    def replay(self) -> bool:
+        """Plays the loop back from the cache if it's there (setting self.outputs to the
+        variables it left behind); otherwise starts recording it."""
+        if self.key is None:
+            return False
+        cached = self._load()
+        flowchart = FlowChart()
+        try:
+            # unpickled every time, so the outputs are fresh copies to be changed as usual
+            calls, physical_uids, virtual_uids, random_state, self.outputs = pickle.loads(cached)
+        except (TypeError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, RecursionError):
+            try:
+                self.before = _shared_state(self.read_names(), self.unchanged)
+            except (NameError, pickle.PicklingError, TypeError, AttributeError, RecursionError):
+                return False # can't tell what it changes: just run it
+            self.calls = flowchart.recording = []
+            return False
+        for method, args, kwargs in calls:
+            getattr(flowchart, method)(*args, **kwargs)
+        context = current_context()
+        context.physical_uids.value = physical_uids
+        context.virtual_uids.value = virtual_uids
+        random.setstate(random_state)
+        return True
+
+    def save(self, outputs):
+        if self.calls is None:
+            return
+        context = current_context()
+        try:
+            if _shared_state(self.read_names(), self.unchanged) != self.before:
+                return # it changed something replaying it wouldn't
+            values = outputs()
+            data = pickle.dumps((self.calls, context.physical_uids.peek(), context.virtual_uids.peek(),
+                                 random.getstate(), values))
+            if not _same_order(values, pickle.loads(data)[-1]):
+                return # its replayed outputs would list their sets in another order
+        except (NameError, pickle.PicklingError, TypeError, AttributeError, RecursionError):
+            return # an output was never set, or can't be saved: this loop just isn't cached
+        MEMORY[self.key] = data
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            partial = f"{self.cache_file}.{os.getpid()}"
+            with open(partial, "wb") as f:
+                f.write(data)
+            os.replace(partial, self.cache_file)
+        except OSError:
+            pass # still cached for this process
+
+    def stop(self):
+        if self.calls is not None:
+            FlowChart().recording = None
+
+
+def clear_loop_cache(cache_dir: str | None = None):
+    """Forgets cached loops, in this process and (given the .fedt_cache directory) on disk."""
+    MEMORY.clear()
+    if cache_dir is not None:
+        loops = os.path.join(cache_dir, LOOP_CACHE_DIR)
+        for name in os.listdir(loops) if os.path.isdir(loops) else []:
+            os.remove(os.path.join(loops, name))
@@ -1,21 +1,29 @@
 from control import MODE, Evaluate, Execute
 from flowchart import FlowChart
+from journal import ask, mark, replaying
 
 
-def instruction(s: str, header=False, **kwargs):
+def instruction(s: str, header=False, args=(), **kwargs):
+    # s can be a template with {} for each of args; the flowchart formats it only when it's
+    # written out, so pass settings dicts in args rather than baking them into an f-string
     from control import MODE
     if isinstance(MODE, Evaluate):
-        FlowChart().add_instruction(s, header, **kwargs)
+        FlowChart().add_instruction(s, header, args=args, **kwargs)
     elif isinstance(MODE, Execute):
+        s = s.format(*args) if args else s
         if header:
-            print(s)
+            # the start of a loop iteration or a measurement; a journal keeps track of these
+            mark("header", s)
+            if not replaying():
+                print(s)
         else:
-            input(f"{s}. Press enter when done.")
+            ask(f"{s}. Press enter when done.", shared=True, about=("instruction", kwargs.get("device")))
 
 
-def note(s: str, header=False, **kwargs):
+def note(s: str, header=False, args=(), **kwargs):
     from control import MODE
     if isinstance(MODE, Evaluate):
-        FlowChart().add_instruction(s, header, **kwargs)
-    elif isinstance(MODE, Execute):
-        print(s)
\ No newline at end of file
+        # attended=False: there's nothing for the operator to do (simulation.py counts no time)
+        FlowChart().add_instruction(s, header, args=args, attended=False, **kwargs)
+    elif isinstance(MODE, Execute) and not replaying():
+        print(s.format(*args) if args else s)
@@ -1,18 +1,28 @@
 import random
-from typing import Iterator, TypeVar
+from typing import Iterator, Sequence, TypeVar
 import control
 from instruction import note
+from planner import in_plan_order
 
 include_last = 0.0001
 
 class Parallel:
 
     def __init__(self, iterator):
+        self.source = iterator
         self.iterator = iter(iterator)
+        self.planned = False
 
     def __iter__(self):
+        # the iterations can be done in any order, so a changeover plan may pick one
+        if not self.planned:
+            self.planned = True
+            self.iterator = in_plan_order(self)
         return self
 
+    def __len__(self):
+        return len(self.source)
+
     def __next__(self):
         return next(self.iterator)
 
@@ -23,11 +33,15 @@ class Parallel:
 class Series:
 
     def __init__(self, iterator):
+        self.source = iterator
         self.iterator = iter(iterator)
 
     def __iter__(self):
         return self
 
+    def __len__(self):
+        return len(self.source)
+
     def __next__(self):
         return next(self.iterator)
 
@@ -50,6 +64,18 @@ class Infinite:
         return "infinite"
 
 
+def split_first(iterable) -> tuple[list, Sequence]:
+    """For symbolic evaluation: the first value, which the loop body really runs for, and the
+    rest, which only get counted. Ranges and arrays are sliced rather than listed out, so a
+    million-value sweep costs nothing here."""
+    source = getattr(iterable, "source", iterable)
+    try:
+        return list(source[:1]), source[1:]
+    except (TypeError, KeyError):
+        values = list(iterable)
+        return values[:1], values[1:]
+
+
 A = TypeVar("A")
 
 
@@ -0,0 +1,180 @@
+import base64
+import gzip
+import json
+import os
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Callable
+
+from context import current_context
+from engine import blocking_check_output, blocking_input
+
+# checkpointing for Execute mode: with @fedt_experiment(journal=True), everything the experiment
+# does to the outside world goes through here (asking the operator something, running a
+# machine's software, waiting for time to pass) and is appended to a journal file as soon as
+# it's done, along with the start of every step and every physical object made.
+#
+# when the experiment is started again with the same journal (after a crash, say), it runs from
+# the top as usual, but each of those steps is looked up in the journal instead of being done:
+# the operator isn't asked again, machines aren't run again, and the answers come back as they
+# were. once it gets past the end of the journal, it carries on live. if the experiment asks
+# for something other than what the journal has next, it has changed since the journal was
+# written, and JournalMismatch says where.
+#
+# library code should use ask() and run_command() instead of input() and subprocess, so they
+# take part; outside a journaled experiment they do just what those do. when Parallel
+# iterations run side by side (see engine.py), each one's steps are kept apart by its branch
+# label, and a restart replays each branch from its own steps.
+#
+# a journal whose name ends in .gz is gzip-compressed, which keeps the recording of a long
+# study small. @fedt_experiment(replay=...) plays one back without a human or any machines:
+# nothing is written, waits are skipped, and a step the recording doesn't have raises
+# JournalMismatch instead of being done live, so the Execute path of a weeks-long study can be
+# regression-tested or profiled in seconds.
+
+
+class JournalMismatch(Exception):
+    pass
+
+
+class Journal:
+    """An append-only file of JSON lines, one per completed step, and how far it's been replayed.
+    With live=False, it's only replayed: steps past its end aren't done."""
+
+    def __init__(self, path: str, live: bool = True):
+        self.path = path
+        self.live = live
+        self.pending: dict[str, deque[dict]] = {} # per branch, the steps not replayed yet
+        self.replayed: dict[str, int] = {}
+        self.next_uid = 0 # the first physical uid the journal hasn't handed out
+        self.lock = threading.Lock()
+        compressed = path.endswith(".gz")
+        lines = []
+        damaged = False
+        if os.path.exists(path):
+            with (gzip.open if compressed else open)(path, "rb") as f:
+                try:
+                    for line in f:
+                        entry = json.loads(line)
+                        lines.append(line)
+                        self.pending.setdefault(entry.get("branch", ""), deque()).append(entry)
+                        if entry["kind"] == "fabricated":
+                            self.next_uid = max(self.next_uid, entry["value"] + 1)
+                except (ValueError, EOFError, gzip.BadGzipFile):
+                    damaged = True # the process died halfway through writing one
+        self.file = None
+        if not live:
+            return
+        if damaged and compressed:
+            with gzip.open(path, "wb") as f:
+                f.writelines(lines)
+        elif damaged:
+            with open(path, "r+b") as f:
+                f.truncate(sum(len(x) for x in lines))
+        self.file = gzip.open(path, "at") if compressed else open(path, "a")
+
+    def replaying(self, branch: str = "") -> bool:
+        return bool(self.pending.get(branch))
+
+    def replay(self, kind: str, key: str, branch: str = "") -> tuple[bool, object]:
+        """(True, the value recorded for this step) if it was done before, else (False, None)."""
+        queue = self.pending.get(branch)
+        where = f" in branch {branch.rstrip('/')}" if branch else ""
+        if not queue:
+            if not self.live:
+                raise JournalMismatch(f"{self.path} has no step {self.replayed.get(branch, 0) + 1}{where}, "
+                                      f"but the experiment now does {kind} {key!r}")
+            return False, None
+        entry = queue[0]
+        if entry["kind"] != kind or entry["key"] != key:
+            raise JournalMismatch(
+                f"step {self.replayed.get(branch, 0) + 1}{where} of {self.path} was {entry['kind']} "
+                f"{entry['key']!r}, but the experiment now does {kind} {key!r}; move the journal aside to start over")
+        queue.popleft()
+        self.replayed[branch] = self.replayed.get(branch, 0) + 1
+        return True, entry.get("value")
+
+    def record(self, kind: str, key: str, value=None, branch: str = ""):
+        entry = {"kind": kind, "key": key, "time": datetime.now().isoformat(timespec="seconds")}
+        if branch:
+            entry["branch"] = branch
+        if value is not None:
+            entry["value"] = value
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def step(self, kind: str, key: str, do: Callable[[], object] | None = None, branch: str = ""):
+        """The value recorded for this step if we're replaying, otherwise do() (if any),
+        recorded."""
+        found, value = self.replay(kind, key, branch)
+        if found:
+            return value
+        value = do() if do is not None else None
+        self.record(kind, key, value, branch)
+        return value
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def replaying() -> bool:
+    """Are we fast-forwarding through steps that were done before?"""
+    context = current_context()
+    return context.journal is not None and context.journal.replaying(context.branch)
+
+
+def live() -> bool:
+    """Is the experiment really being done, rather than played back from a recording or
+    simulated (see backends.py)?"""
+    context = current_context()
+    return context.backend is None and (context.journal is None or context.journal.live)
+
+
+def remember(kind: str, key: str, do: Callable[[], object]):
+    # do() once, ever, for a journaled experiment; its result has to be JSON
+    context = current_context()
+    if context.journal is None:
+        return do()
+    return context.journal.step(kind, key, do, context.branch)
+
+
+def mark(kind: str, key: str):
+    # a step with nothing to redo, like a header; replaying checks it happens in the same place
+    context = current_context()
+    if context.journal is not None:
+        context.journal.step(kind, key, branch=context.branch)
+
+
+def physical_uid() -> int:
+    """The uid for a new RealWorldObject: the one it had last time, if we're replaying."""
+    context = current_context()
+    journal = context.journal
+    if journal is None:
+        return context.physical_uids.next()
+
+    def fresh():
+        # past every uid in the journal, which a branch that hasn't been replayed yet may still hand out
+        if context.physical_uids.peek() < journal.next_uid:
+            context.physical_uids.value = journal.next_uid
+        return context.physical_uids.next()
+    return journal.step("fabricated", "physical object", fresh, context.branch)
+
+
+def ask(prompt: str, shared: bool = False, about: tuple | None = None) -> str:
+    """input(prompt), answered from the journal if it's been answered before. shared prompts
+    only ask for a confirmation, so Parallel iterations waiting on the same one at once can
+    share an answer (see engine.py); about says what's being asked for, so a simulated backend
+    can answer it (see backends.py)."""
+    return remember("ask", prompt, lambda: blocking_input(prompt, shared, about))
+
+
+def run_command(command: list[str], device: type | None = None, **kwargs) -> bytes:
+    """subprocess.check_output(command), not run again if it already has been. device is the
+    machine it runs, which metrics are kept by (see metrics.py)."""
+    def run():
+        return base64.b64encode(blocking_check_output(command, device, **kwargs)).decode("ascii")
+    return base64.b64decode(remember("run", " ".join(str(x) for x in command), run))
@@ -1,4 +1,5 @@
 import copy
+from dataclasses import dataclass, field
 from datetime import date
 from typing import List
 import datetime
@@ -11,13 +12,18 @@ import subprocess
 import traceback
 from zipfile import ZipFile
 
-from flowchart import SUBJECT, VERB, OBJECT, SETTINGS, FABBED_SOMETHING
+from context import current_context, experiment_context
+from flowchart import FlowChart, SUBJECT, VERB, OBJECT, SETTINGS, FABBED_SOMETHING
 from instruction import instruction, note
 from measurement import Measurement, BatchMeasurements
 from fabricate import fabricate, RealWorldObject, FabricationDevice, CURRENT_UID
 from design import design, GeometryFile, ConfigurationFile, CAMFile, DesignSoftware, \
                     ConfigSoftware, ToolpathSoftware, NotApplicableInThisWorkflowException
 from decorator import explicit_checker
+from journal import ask, live, remember, run_command
+from planner import setup_used
+from backends import machine_job
+from timers import timer_queue
 
 from config import *
 
@@ -35,6 +41,174 @@ POST_PROCESS = 'post-process'
 INTERACTION = 'interaction'
 TIME = 'time'
 
+# device pools: Printer, Laser and KnittingMachine stand for one machine each unless more are
+# declared, e.g. for a print farm
+#
+#     DevicePool.declare(Printer, "mk4-1", material=["PLA", "PETG"], nozzle="0.4mm")
+#     DevicePool.declare(Printer, "mk4-2", material="PLA", speed=1.5)
+#
+# capabilities are compared to the settings of each job (a single value has to match, a list
+# or set has to contain the setting, a function has to return True for it), and speed divides
+# the job's minutes. before executing, DevicePool.plan(experiment) evaluates it once to
+# collect its fabrication jobs, spreads each Parallel loop's jobs over the machines that can
+# do them (longest first, each to whichever machine would finish it soonest), and prints how
+# busy each machine will be. executing the experiment then says which machine to use for
+# each job.
+
+class NoCapableDevice(Exception):
+    pass
+
+@dataclass
+class DeviceInstance:
+    device: type
+    name: str
+    capabilities: dict[str, object]
+    speed: float = 1.
+
+    def can_run(self, settings: dict) -> bool:
+        for key, have in self.capabilities.items():
+            if key not in settings:
+                continue
+            want = settings[key]
+            if callable(have):
+                ok = have(want)
+            elif isinstance(have, (list, tuple, set, frozenset)):
+                ok = want in have
+            else:
+                ok = have == want
+            if not ok:
+                return False
+        return True
+
+@dataclass
+class FabJob:
+    device: type
+    settings: dict
+    minutes: float
+    phase: object # jobs in the same phase (an iteration-independent Parallel loop) can run side by side
+    instance: DeviceInstance | None = None
+    start: float = 0.
+    claimed: bool = False
+
+    def key(self) -> tuple:
+        # what the experiment's run has to match this job on
+        return DevicePool.job_key(self.device, self.settings)
+
+@dataclass
+class DeviceSchedule:
+    jobs: list[FabJob] = field(default_factory=list)
+    collecting: bool = True
+    makespan: float = 0.
+
+    def assign(self):
+        """Spreads the jobs over the declared instances, phase by phase: longest jobs first,
+        each on the capable instance that would finish it soonest."""
+        phases = {}
+        for job in self.jobs:
+            phases.setdefault(job.phase, []).append(job)
+        start = 0.
+        for jobs in phases.values():
+            free = {}
+            for job in sorted(jobs, key=lambda x: -x.minutes):
+                capable = [x for x in DevicePool.instances.get(job.device, []) if x.can_run(job.settings)]
+                if not capable:
+                    raise NoCapableDevice(f"no {job.device.__name__} that was declared can do a job with {job.settings}")
+                best = min(capable, key=lambda x: free.get(x.name, start) + job.minutes / x.speed)
+                job.instance, job.start = best, free.get(best.name, start)
+                free[best.name] = job.start + job.minutes / best.speed
+            start = max(free.values())
+        self.makespan = start
+        self.collecting = False
+
+    def busy_minutes(self) -> dict[str, float]:
+        busy = {x.name: 0. for instances in DevicePool.instances.values() for x in instances}
+        for job in self.jobs:
+            busy[job.instance.name] += job.minutes / job.instance.speed
+        return busy
+
+    def report(self) -> str:
+        lines = [f"projected makespan {self.makespan:.0f} minutes for {len(self.jobs)} fabrication jobs"]
+        for instances in DevicePool.instances.values():
+            for x in instances:
+                busy = self.busy_minutes()[x.name]
+                utilization = busy / self.makespan if self.makespan else 0.
+                lines.append(f"  {x.name} ({x.device.__name__}): {busy:.0f} minutes busy, {utilization:.0%} utilized")
+        return "\n".join(lines)
+
+    def claim(self, device: type, settings: dict) -> DeviceInstance | None:
+        # the planned instance for the next unclaimed job like this one
+        key = DevicePool.job_key(device, settings)
+        for job in self.jobs:
+            if not job.claimed and job.device is device and job.key() == key:
+                job.claimed = True
+                return job.instance
+        return None
+
+class DevicePool:
+    instances: dict[type, list[DeviceInstance]] = {}
+    # how long a job takes on a speed 1 machine when fab() isn't given minutes=
+    minutes = {}
+
+    @staticmethod
+    def declare(device: type, name: str, speed: float = 1., **capabilities) -> DeviceInstance:
+        instance = DeviceInstance(device, name, capabilities, speed)
+        DevicePool.instances.setdefault(device, []).append(instance)
+        return instance
+
+    @staticmethod
+    def clear():
+        DevicePool.instances.clear()
+        current_context().devices = None
+
+    @staticmethod
+    def job_key(device: type, settings: dict) -> tuple:
+        names = sorted({k for x in DevicePool.instances.get(device, []) for k in x.capabilities})
+        return tuple(repr(settings.get(k)) for k in names)
+
+    @staticmethod
+    def job(device: type, settings: dict) -> DeviceInstance | None:
+        """Called by each fab(): while planning, records the job; while executing a planned
+        experiment, tells the operator which machine to use and returns it."""
+        setup_used(device, settings)
+        if device not in DevicePool.instances:
+            return None
+        context = current_context()
+        schedule = context.devices
+        if schedule is None:
+            return None
+        if schedule.collecting:
+            # the outermost Parallel loop around the job, in this iteration of the loops around that
+            open_loops = FlowChart().index.open
+            parallel = next((i for i, x in enumerate(open_loops) if x.kind == "parallel"), None)
+            if parallel is None:
+                phase = object()
+            else:
+                phase = tuple((id(x), x.iterations) for x in open_loops[:parallel]) + (id(open_loops[parallel]),)
+            minutes = settings.get("minutes", DevicePool.minutes.get(device, 60))
+            schedule.jobs.append(FabJob(device, dict(settings), float(minutes), phase))
+            return None
+        from control import Execute
+        if not isinstance(context.mode, Execute):
+            return None
+        instance = schedule.claim(device, settings)
+        if instance is not None:
+            note("use {} for this job", args=(instance.name,), device=device)
+        return instance
+
+    @staticmethod
+    def plan(experiment, *args, **kwargs) -> DeviceSchedule:
+        """Evaluates experiment(*args, **kwargs) to find its fabrication jobs, assigns them
+        to the declared machines, prints the projected utilization, and keeps the schedule
+        for the next run of the experiment."""
+        context = current_context()
+        schedule = DeviceSchedule()
+        with experiment_context(context.rehearsal(devices=schedule)):
+            experiment(*args, **kwargs)
+        schedule.assign()
+        print(schedule.report())
+        context.devices = schedule
+        return schedule
+
 class Laser(ConfigSoftware, ToolpathSoftware, FabricationDevice):
     CUT_POWER = "cut_power"
     CUT_SPEED = "cut_speed"
@@ -243,7 +417,7 @@ class Laser(ConfigSoftware, ToolpathSoftware, FabricationDevice):
                     '--execute',
                     os.path.join(os.getcwd(), temp_plf)]
         try:
-            results = subprocess.check_output(cut_command, stderr=subprocess.STDOUT)
+            results = run_command(cut_command, device=Laser, stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as exc:
             # it probably didn't work! incredible. that's likely because we didn't get visicut in here right, or we're running offline.
             print("was not able to call visicut properly")
@@ -283,8 +457,9 @@ class Laser(ConfigSoftware, ToolpathSoftware, FabricationDevice):
         all_settings = dict(Laser.default_laser_settings)
         all_settings.update(default_settings)
         all_settings.update(dict(user_chosen_settings))
+        DevicePool.job(Laser, all_settings)
 
-        instruction(f"Ensure {all_settings['material']} is in the bed.")
+        instruction("Ensure {} is in the bed.", args=(all_settings['material'],), device=Laser)
 
         stored_values = {"line_file": line_file}
         stored_values.update(explicit_args)
@@ -302,14 +477,15 @@ class Laser(ConfigSoftware, ToolpathSoftware, FabricationDevice):
                                                                                         default_settings['frequency'] if 'frequency' in default_settings else frequency)]
                 colors_to_mappings[color_to_setting] = desired_setting
             # actually call the laser
-            Laser.do_fab(line_file,
-                            mapping_file=all_settings['mapping_file'] if 'mapping_file' in all_settings else None,
-                            focal_height_mm=all_settings[Laser.FOCAL_HEIGHT_MM])
+            machine_job(Laser, all_settings,
+                        lambda: Laser.do_fab(line_file,
+                                             mapping_file=all_settings['mapping_file'] if 'mapping_file' in all_settings else None,
+                                             focal_height_mm=all_settings[Laser.FOCAL_HEIGHT_MM]))
         else:
             data = None
             if "setting_names" in user_chosen_settings:
                 data = user_chosen_settings.pop("setting_names")
-            instruction(f"Run the laser cutter and cut file {line_file.file_location} with settings {user_chosen_settings}")
+            instruction("Run the laser cutter and cut file {} with settings {}", args=(line_file.file_location, user_chosen_settings), device=Laser)
             if data is not None:
                 user_chosen_settings["setting_names"] = data
 
@@ -321,7 +497,7 @@ class Laser(ConfigSoftware, ToolpathSoftware, FabricationDevice):
         #                                 OBJECT: line_file,
         #                                 SETTINGS: all_settings,
         #                                 FABBED_SOMETHING: True})
-        fabbed = fabricate(stored_values)
+        fabbed = fabricate(stored_values, device=Laser)
 
         if isinstance(MODE, Execute):
             print(f"object number {fabbed.uid} has been fabricated!")
@@ -363,7 +539,7 @@ class SvgEditor(DesignSoftware):
         location = "...."
         from control import MODE, Execute
         if isinstance(MODE, Execute):
-            location = input("where is the svg?")
+            location = ask("where is the svg?", about=("file", ".svg"))
         designed = GeometryFile(location)
         designed.metadata.update(vars)
         if specification:
@@ -451,7 +627,7 @@ class SvgEditor(DesignSoftware):
         if isinstance(MODE, Execute):
             print(f"svg has been generated, and is available at {svg_fullpath}")
         else:
-            instruction(f"generate svg file with function {geometry_function.__name__} {CAD_vars} {kwargs}",
+            instruction("generate svg file with function {} {} {}", args=(geometry_function.__name__, CAD_vars, kwargs),
                             latex_details = {SUBJECT: SvgEditor,
                                                 VERB: 'generated a line file',
                                                 SETTINGS: stored_values})
@@ -492,7 +668,7 @@ class Slicer(ToolpathSoftware):
                         **kwargs) -> CAMFile:
         
         if config is not None:
-            instruction(f"slice {design.file_location} in the slicing software with configuration {config.file_location}")
+            instruction("slice {} in the slicing software with configuration {}", args=(design.file_location, config.file_location), device=Slicer)
                     # fabbing = True,
                     # latex_details = {SUBJECT: Slicer,
                     #                     VERB: 'sliced',
@@ -500,11 +676,11 @@ class Slicer(ToolpathSoftware):
                     #                     SETTINGS: kwargs,
                     #                     FABBED_SOMETHING: False})
         else:
-            instruction(f"slice {design.file_location} in the slicing software with settings {kwargs}")
+            instruction("slice {} in the slicing software with settings {}", args=(design.file_location, kwargs), device=Slicer)
         from control import MODE, Execute
         gcode_location = ''
         if isinstance(MODE, Execute):
-            gcode_location = input("where is the sliced file located? ")
+            gcode_location = ask("where is the sliced file located? ", about=("file", ".gcode"))
         
         kwargs.update({'config_file':config})
         gcode_file = CAMFile(gcode_location, kwargs)
@@ -546,7 +722,7 @@ class PrusaSlicer(Slicer):
             slice_command.extend(['--export-gcode', volume_file.file_location])
             slice_command.extend(['--output-filename-format', 'FEDT_[timestamp]_[input_filename_base].gcode'])
             print(slice_command)
-            results = subprocess.check_output(slice_command)
+            results = run_command(slice_command, device=PrusaSlicer)
         
             # the last line from Prusa Slicer is "Slicing result exported to ..."
             last_line = results.decode('utf-8').strip().split("\n")[-1]
@@ -596,7 +772,7 @@ class JankyBambuSlicer(Slicer):
             slice_command.extend(['--export-gcode', volume_file.file_location])
             slice_command.extend(['--output-filename-format', 'FEDT_[timestamp]_[input_filename_base].gcode'])
             print(slice_command)
-            results = subprocess.check_output(slice_command)
+            results = run_command(slice_command, device=JankyBambuSlicer)
         
             # the last line from Prusa Slicer is "Slicing result exported to ..."
             last_line = results.decode('utf-8').strip().split("\n")[-1]
@@ -654,7 +830,7 @@ class BambuSlicer(Slicer):
                             '--export-3mf', 'output.3mf',
                             volume_file.file_location]
             print(' '.join(slice_command))
-            gcode_location = subprocess.check_output(slice_command)
+            gcode_location = run_command(slice_command, device=BambuSlicer)
 
         design_bake = {'slicer': 'BambuSlicer'}
         design_bake.update(argdict)
@@ -700,7 +876,7 @@ class JankyUltimakerSlicer(Slicer):
             slice_command.extend(['--export-gcode', volume_file.file_location])
             slice_command.extend(['--output-filename-format', 'FEDT_[timestamp]_[input_filename_base].gcode'])
             print(slice_command)
-            results = subprocess.check_output(slice_command)
+            results = run_command(slice_command, device=JankyUltimakerSlicer)
         
             # the last line from Prusa Slicer is "Slicing result exported to ..."
             last_line = results.decode('utf-8').strip().split("\n")[-1]
@@ -730,7 +906,7 @@ class Printer(FabricationDevice):
 
     @staticmethod
     def print(gcode: CAMFile) -> RealWorldObject:
-        input(f"load {gcode.file_location} onto the printer and hit print. enter when finished.")
+        ask(f"load {gcode.file_location} onto the printer and hit print. enter when finished.", about=("instruction", Printer))
     
     @staticmethod
     @explicit_checker
@@ -766,6 +942,7 @@ class Printer(FabricationDevice):
         all_values.update(Printer.default_printer_settings)
         all_values.update(defaults)
         all_values.update(stored_values)
+        DevicePool.job(Printer, all_values)
 
         # if volume_file.file_location == '':
         #     instruction("Slice the file.",
@@ -786,9 +963,10 @@ class Printer(FabricationDevice):
                                                 wall_thickness=all_values['wall_thickness'],
                                                 material=all_values['material'])
 
-        fabbed = fabricate(stored_values, "Run the printer")
+        fabbed = fabricate(stored_values, "Run the printer", device=Printer)
         if isinstance(MODE, Execute):
             Printer.print(toolpath)
+            machine_job(Printer, all_values)
         # else:
         #     instruction(f"Run the printer, creating object #{fabbed.uid}",
         #             fabbing = True,
@@ -827,7 +1005,7 @@ class StlEditor(DesignSoftware):
 
         from control import MODE, Execute
         if isinstance(MODE, Execute):
-            file_location = input("where is the stl file?")
+            file_location = ask("where is the stl file?", about=("file", ".stl"))
         
         return design(file_location, GeometryFile, features)
     
@@ -839,7 +1017,7 @@ class StlEditor(DesignSoftware):
 
         from control import MODE, Execute
         if isinstance(MODE, Execute):
-            file_location = input(f"What is the location of the modified stl?")
+            file_location = ask(f"What is the location of the modified stl?", about=("file", ".stl"))
             stl.file_location = file_location
 
         return stl
@@ -862,7 +1040,7 @@ class StlEditor(DesignSoftware):
         from control import MODE, Execute
         svg_location = ''
         if isinstance(MODE, Execute):
-            svg_location = input("what is the location of the svg profile?")
+            svg_location = ask("what is the location of the svg profile?", about=("file", ".svg"))
         return design(svg_location,GeometryFile,{'profile extracted from': volume_file})
     
     @staticmethod
@@ -871,7 +1049,7 @@ class StlEditor(DesignSoftware):
         instruction(f"Rotate {volume_file.file_location} {angle} degrees")
         from control import MODE, Execute
         if isinstance(MODE, Execute):
-            file_location = input(f"What is the location of the modified stl?")
+            file_location = ask(f"What is the location of the modified stl?", about=("file", ".stl"))
             volume_file.file_location = file_location
         
         volume_file.updateVersion("rotated by", angle)
@@ -915,11 +1093,14 @@ class KnittingMachine(FabricationDevice):
         all_values.update(KnittingMachine.default_knitting_settings)
         all_values.update(defaults)
         all_values.update(stored_values)
+        DevicePool.job(KnittingMachine, all_values)
 
-        instruction(f'cast on the number of stitches required for {knitfile.file_location}')
-        instruction(f'set up the machine carriages')
+        instruction('cast on the number of stitches required for {}', args=(knitfile.file_location,), device=KnittingMachine)
+        instruction(f'set up the machine carriages', device=KnittingMachine)
+        machine_job(KnittingMachine, all_values)
 
-        return fabricate(all_values, f'load up {knitfile.file_location} and start the knitting machine with settings {all_values}')
+        return fabricate(all_values, 'load up {} and start the knitting machine with settings {}', args=(knitfile.file_location, all_values),
+                         device=KnittingMachine)
     
     @staticmethod  
     def describe():
@@ -944,7 +1125,7 @@ class KnitCompiler(DesignSoftware, ConfigSoftware):
 
         from control import MODE, Execute
         if isinstance(MODE, Execute):
-            file_location = input("where is the knitting file?")
+            file_location = ask("where is the knitting file?", about=("file", ".k"))
         
         designed = GeometryFile(file_location)
         designed.metadata.update({"specification":specification})
@@ -956,7 +1137,7 @@ class KnitCompiler(DesignSoftware, ConfigSoftware):
         file_location = knitfile.file_location
         from control import MODE, Execute
         if isinstance(MODE, Execute):
-            file_location = input(f"What is the location of the modified knitfile?")
+            file_location = ask(f"What is the location of the modified knitfile?", about=("file", ".k"))
         
         knitfile.updateVersion('hand-edit', specification)
         knitfile.file_location = file_location
@@ -997,14 +1178,14 @@ class Multimeter:
 
     @staticmethod
     def measure_resistance(obj: RealWorldObject) -> BatchMeasurements:
-        instruction(f"Measure object #{obj.uid}.", header=True)
-        instruction(Multimeter.resistance.procedure)
+        instruction("Measure object #{}.", header=True, args=(obj.uid,), uids=(obj.uid,))
+        instruction(Multimeter.resistance.procedure, device=Multimeter, measurement=Multimeter.resistance, uids=(obj.uid,))
         return BatchMeasurements.single(obj, Multimeter.resistance)
     
     @staticmethod
     def measure_current(obj: RealWorldObject) -> BatchMeasurements:
-        instruction(f"Measure object #{obj.uid}.", header=True)
-        instruction(Multimeter.current.procedure)
+        instruction("Measure object #{}.", header=True, args=(obj.uid,), uids=(obj.uid,))
+        instruction(Multimeter.current.procedure, device=Multimeter, measurement=Multimeter.current, uids=(obj.uid,))
         return BatchMeasurements.single(obj, Multimeter.current)
 
     @staticmethod
@@ -1023,8 +1204,8 @@ class Stopwatch:
 
     @staticmethod
     def measure_time(obj: RealWorldObject, instr: str) -> BatchMeasurements:
-        instruction(f"Measure object #{obj.uid}.", header=True)
-        instruction(Stopwatch.elapsed_time.procedure.format(instr))
+        instruction("Measure object #{}.", header=True, args=(obj.uid,), uids=(obj.uid,))
+        instruction(Stopwatch.elapsed_time.procedure, args=(instr,), device=Stopwatch, measurement=Stopwatch.elapsed_time, uids=(obj.uid,))
         return BatchMeasurements.single(obj, Stopwatch.elapsed_time.set_feature(instr))
 
 class Timestamper:
@@ -1039,8 +1220,8 @@ class Timestamper:
 
     @staticmethod
     def get_ts(obj: RealWorldObject) -> BatchMeasurements:
-        instruction(f"Measure object #{obj.uid}.", header=True)
-        instruction(Timestamper.timestamp.procedure)
+        instruction("Measure object #{}.", header=True, args=(obj.uid,), uids=(obj.uid,))
+        instruction(Timestamper.timestamp.procedure, device=Timestamper, measurement=Timestamper.timestamp, uids=(obj.uid,))
         return BatchMeasurements.single(obj, Timestamper.timestamp)
 
 class TrueFalser:
@@ -1055,8 +1236,8 @@ class TrueFalser:
 
     @staticmethod
     def decide_truefalse(obj: RealWorldObject, feature: str=truefalse.procedure) -> BatchMeasurements:
-        instruction(f"Measure object #{obj.uid}.", header=True)
-        instruction(TrueFalser.truefalse.procedure.format(feature))
+        instruction("Measure object #{}.", header=True, args=(obj.uid,), uids=(obj.uid,))
+        instruction(TrueFalser.truefalse.procedure, args=(feature,), device=TrueFalser, measurement=TrueFalser.truefalse, uids=(obj.uid,))
         return BatchMeasurements.single(obj, TrueFalser.truefalse.set_feature(feature))
 
 class Calipers:
@@ -1073,8 +1254,8 @@ class Calipers:
     @staticmethod
     def measure_size(obj: RealWorldObject,
                      dimension: str=length.feature) -> BatchMeasurements:
-        instruction(f"Measure object #{obj.uid}.", header=True)
-        instruction(Calipers.length.procedure.format(dimension))
+        instruction("Measure object #{}.", header=True, args=(obj.uid,), uids=(obj.uid,))
+        instruction(Calipers.length.procedure, args=(dimension,), device=Calipers, measurement=Calipers.length, uids=(obj.uid,))
         return BatchMeasurements.single(obj, Calipers.length.set_feature(dimension))
     
 class Protractor:
@@ -1091,8 +1272,8 @@ class Protractor:
     @staticmethod
     def measure_angle(obj: RealWorldObject,
                       dimension: str=angle.feature) -> BatchMeasurements:
-        instruction(f"Measure object #{obj.uid}.", header=True)
-        instruction(Protractor.angle.procedure.format(dimension))
+        instruction("Measure object #{}.", header=True, args=(obj.uid,), uids=(obj.uid,))
+        instruction(Protractor.angle.procedure, args=(dimension,), device=Protractor, measurement=Protractor.angle, uids=(obj.uid,))
         return BatchMeasurements.single(obj, Protractor.angle.set_feature(dimension))
 
 class Scanner:
@@ -1109,8 +1290,8 @@ class Scanner:
 
     @staticmethod
     def scan(obj: RealWorldObject) -> BatchMeasurements:
-        instruction(f"Scan object #{obj.uid}.", header=True)
-        instruction(Scanner.geometry_scan.procedure)
+        instruction("Scan object #{}.", header=True, args=(obj.uid,), uids=(obj.uid,))
+        instruction(Scanner.geometry_scan.procedure, device=Scanner, measurement=Scanner.geometry_scan, uids=(obj.uid,))
         return BatchMeasurements.single(obj, Scanner.geometry_scan)
 
 class ForceGauge:
@@ -1126,8 +1307,8 @@ class ForceGauge:
 
     @staticmethod
     def measure_force(obj: RealWorldObject, feature: str=force.feature) -> BatchMeasurements:
-        instruction(f"Measure object #{obj.uid}.", header=True)
-        instruction(ForceGauge.force.procedure)
+        instruction("Measure object #{}.", header=True, args=(obj.uid,), uids=(obj.uid,))
+        instruction(ForceGauge.force.procedure, device=ForceGauge, measurement=ForceGauge.force, uids=(obj.uid,))
         return BatchMeasurements.single(obj, ForceGauge.force)
     
 class Anemometer:
@@ -1142,8 +1323,8 @@ class Anemometer:
 
     @staticmethod
     def measure_airflow(obj: RealWorldObject, feature: str=airflow.feature) -> BatchMeasurements:
-        instruction(f"Measure object #{obj.uid}.", header=True)
-        instruction(Anemometer.airflow.procedure)
+        instruction("Measure object #{}.", header=True, args=(obj.uid,), uids=(obj.uid,))
+        instruction(Anemometer.airflow.procedure, device=Anemometer, measurement=Anemometer.airflow, uids=(obj.uid,))
         return BatchMeasurements.single(obj, Anemometer.airflow.set_feature(feature))
 
 class Camera:
@@ -1158,8 +1339,8 @@ class Camera:
 
     @staticmethod
     def take_picture(obj: RealWorldObject, feature: str=image.feature) -> BatchMeasurements:
-        instruction(f"Measure object #{obj.uid}.", header=True)
-        instruction(Camera.image.procedure.format(feature))
+        instruction("Measure object #{}.", header=True, args=(obj.uid,), uids=(obj.uid,))
+        instruction(Camera.image.procedure, args=(feature,), device=Camera, measurement=Camera.image, uids=(obj.uid,))
         return BatchMeasurements.single(obj, Camera.image.set_feature(feature))
 
 class PressureSensor:
@@ -1174,8 +1355,8 @@ class PressureSensor:
 
     @staticmethod
     def measure_pressure(obj: RealWorldObject, feature: str=pressure.feature) -> BatchMeasurements:
-        instruction(f"Measure object #{obj.uid}.", header=True)
-        instruction(PressureSensor.pressure.procedure)
+        instruction("Measure object #{}.", header=True, args=(obj.uid,), uids=(obj.uid,))
+        instruction(PressureSensor.pressure.procedure, device=PressureSensor, measurement=PressureSensor.pressure, uids=(obj.uid,))
         return BatchMeasurements.single(obj, PressureSensor.pressure.set_feature(feature))
 
 class Scale:
@@ -1190,8 +1371,8 @@ class Scale:
 
     @staticmethod
     def measure_weight(obj: RealWorldObject, feature: str=weight.feature) -> BatchMeasurements:
-        instruction(f"Measure object #{obj.uid}.", header=True)
-        instruction(Scale.weight.procedure)
+        instruction("Measure object #{}.", header=True, args=(obj.uid,), uids=(obj.uid,))
+        instruction(Scale.weight.procedure, device=Scale, measurement=Scale.weight, uids=(obj.uid,))
         return BatchMeasurements.single(obj, Scale.weight.set_feature(feature))
 
 class Human:
@@ -1207,8 +1388,8 @@ class Human:
     
     @staticmethod
     def judge_something(obj: RealWorldObject, feature: str=judgement.feature) -> BatchMeasurements:
-        instruction(f"Measure object #{obj.uid}.", header=True)
-        instruction(Human.judgement.procedure + " : " + feature)
+        instruction("Measure object #{}.", header=True, args=(obj.uid,), uids=(obj.uid,))
+        instruction(Human.judgement.procedure + " : " + feature, device=Human, measurement=Human.judgement, uids=(obj.uid,))
         return BatchMeasurements.single(obj, Human.judgement.set_feature(feature))
 
     @staticmethod
@@ -1217,7 +1398,7 @@ class Human:
         instruction(instr)
         from control import MODE, Execute
         if isinstance(MODE, Execute):
-            response = input(question)
+            response = ask(question)
             return response
         return question
 
@@ -1244,7 +1425,7 @@ class User:
     @staticmethod
     def do(obj: RealWorldObject, instr: str, user_id: int):
         instr = f"User #{user_id} does {instr}"
-        instruction(instr, who=Human)
+        instruction(instr, who=Human, uids=(obj.uid,))
         USER_DID = f"user did"
         if USER_DID in obj.metadata:
             instr = obj.metadata[USER_DID] + ", then " + instr
@@ -1266,16 +1447,16 @@ class Environment:
                                     num_weeks: int=0,
                                     num_months: int=0):
 
-        instruction(f"begin a {num_days} day, {num_weeks} week, {num_months} month count from {Environment.begin_time}")
+        instruction(f"begin a {num_days} day, {num_weeks} week, {num_months} month count from {Environment.begin_time}",
+                    uids=tuple(obj.uid for obj in fabbed_objects),
+                    wait_minutes=Environment._minutes(num_days, num_weeks, num_months))
         from control import MODE, Execute
         if isinstance(MODE, Execute):
-            while date.today() < (Environment.begin_time + relativedelta(days=num_days, weeks=num_weeks, months=num_months)):
-                pass
-            input("Enough time has passed; let's get on with it!")
+            Environment._wait([obj.uid for obj in fabbed_objects], num_days, num_weeks, num_months)
         instruction(f"a total of {num_days} days, {num_weeks} weeks, {num_months} months has passed!")
         TIME = "time passed"
         for obj in fabbed_objects:
-            obj.metadata.update({TIME : date.today() - Environment.begin_time})
+            obj.metadata.update({TIME : Environment._time_passed(obj)})
         return fabbed_objects
     
     @staticmethod
@@ -1284,18 +1465,46 @@ class Environment:
                                 num_weeks: int=0,
                                 num_months: int=0):
 
-        instruction(f"begin a {num_days} day, {num_weeks} week, {num_months} month count from {Environment.begin_time}")
+        instruction(f"begin a {num_days} day, {num_weeks} week, {num_months} month count from {Environment.begin_time}",
+                    uids=(fabbed_object.uid,), wait_minutes=Environment._minutes(num_days, num_weeks, num_months))
         from control import MODE, Execute
         if isinstance(MODE, Execute):
-            while date.today() < (Environment.begin_time + relativedelta(days=num_days, weeks=num_weeks, months=num_months)):
-                pass
-            input("Enough time has passed; let's get on with it!")
+            Environment._wait([fabbed_object.uid], num_days, num_weeks, num_months)
         instruction(f"a total of {num_days} days, {num_weeks} weeks, {num_months} months has passed!")
         TIME = "time passed"
-        fabbed_object.metadata.update({TIME : date.today() - Environment.begin_time})
+        fabbed_object.metadata.update({TIME : Environment._time_passed(fabbed_object)})
         return fabbed_object
 
+    @staticmethod
+    def _wait(uids: List[int], num_days: int, num_weeks: int, num_months: int):
+        # each object's clock starts the first time it's waited on (see timers.py); the due
+        # time is journaled before waiting, so a restarted experiment waits for the same moment
+        # (and one played back from a recording doesn't wait at all)
+        timers = timer_queue()
+        label = f"the {num_days} day, {num_weeks} week, {num_months} month wait"
+        until = remember("wait", f"{num_days} days, {num_weeks} weeks, {num_months} months",
+                         lambda: timers.schedule(uids, relativedelta(days=num_days, weeks=num_weeks, months=num_months),
+                                                 label).isoformat())
+        if live():
+            timers.wait(datetime.datetime.fromisoformat(until))
+        ask("Enough time has passed; let's get on with it!")
+
+    @staticmethod
+    def _minutes(num_days: int, num_weeks: int, num_months: int) -> int:
+        # how long the wait is, for simulation.py
+        until = Environment.begin_time + relativedelta(days=num_days, weeks=num_weeks, months=num_months)
+        return (until - Environment.begin_time).days * 24 * 60
+
+    @staticmethod
+    def _time_passed(fabbed_object: RealWorldObject):
+        from control import MODE, Execute
+        if isinstance(MODE, Execute):
+            return timer_queue().age(fabbed_object.uid)
+        return date.today() - Environment.begin_time
+
     @staticmethod
     def describe():
         setup = '''We allowed nature to take its course.'''
-        return setup
\ No newline at end of file
+        return setup
+
+DevicePool.minutes.update({Printer: 120, Laser: 15, KnittingMachine: 45})
@@ -1,10 +1,13 @@
-import csv, os, time
+import csv, io, os, time
 
 from design import VirtualWorldObject
 from fabricate import RealWorldObject
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Callable
 from flowchart import FlowChart
+from journal import ask, live, remember, replaying
+from context import current_context
+from engine import blocking_input
 
 from control import MODE, Execute
 
@@ -36,26 +39,29 @@ class Measurement:
          )
 
 
+# objects and measurements are kept in dicts (with None values) rather than sets, so they list
+# in the order they were added: the same in every run, and the same in a copy (like the ones
+# incremental.py replays), which a set built up one item at a time needn't be
 @dataclass
 class BatchMeasurements:
-    objects: set[RealWorldObject]
-    measurements: set[Measurement]
+    objects: dict[RealWorldObject, None]
+    measurements: dict[Measurement, None]
 
     @staticmethod
     def single(obj: RealWorldObject, meas: Measurement) -> "BatchMeasurements":
-        return BatchMeasurements(set([obj]), set([meas]))
+        return BatchMeasurements({obj: None}, {meas: None})
     
     @staticmethod
     def multiple(obj: RealWorldObject, meases: set[Measurement]) -> "BatchMeasurements":
-        return BatchMeasurements(set([obj]), meases)
+        return BatchMeasurements({obj: None}, dict.fromkeys(meases))
 
     @staticmethod
     def empty() -> "BatchMeasurements":
-        return BatchMeasurements(set(), set())
+        return BatchMeasurements({}, {})
 
     def __add__(self, other: "BatchMeasurements") -> "BatchMeasurements":
-        return BatchMeasurements(self.objects.union(other.objects),
-                            self.measurements.union(other.measurements))
+        return BatchMeasurements(self.objects | other.objects,
+                            self.measurements | other.measurements)
 
     def instruction(self):
         return f"Fill out the csv for {len(list(self.objects))} objects ({list(self.objects)}) and {len(list(self.measurements))} measurements ({list(self.measurements)}) ({self.how_many()} datapoints)."
@@ -64,7 +70,12 @@ class BatchMeasurements:
         from control import MODE, Execute
         if isinstance(MODE, Execute):
             print("now it's time to get data!")
-            experiment_csv = os.path.join("expt_csvs","experiment-{}.csv".format(time.strftime("%Y%m%d-%H%M%S")))
+            # a restarted experiment reads the sheet that was filled in the first time, and never
+            # starts it over: only a sheet that isn't there yet is written out blank
+            restarted = replaying()
+            experiment_csv = remember("file", "measurement sheet",
+                                      lambda: os.path.join("expt_csvs","experiment-{}.csv".format(time.strftime("%Y%m%d-%H%M%S"))))
+            filling_in = live() or not restarted
 
             csv_to_obj = {}
             csv_to_meas = {}
@@ -76,11 +87,12 @@ class BatchMeasurements:
             rows = [f"{obj.uid}" for obj in self.objects]
             csv_to_obj = dict((str(obj.uid),obj) for obj in self.objects)
 
-            with open(experiment_csv, 'w') as csvfile:
-                spamwriter = csv.writer(csvfile)
-                spamwriter.writerow(columns)
-                for obj in rows:
-                    spamwriter.writerow([obj] + ['']*(len(columns)-1))
+            if filling_in and not os.path.exists(experiment_csv):
+                with open(experiment_csv, 'w') as csvfile:
+                    spamwriter = csv.writer(csvfile)
+                    spamwriter.writerow(columns)
+                    for obj in rows:
+                        spamwriter.writerow([obj] + ['']*(len(columns)-1))
 
             def walk_metadata(obj: RealWorldObject | VirtualWorldObject, ret_val=False):
                 variables = []
@@ -109,28 +121,43 @@ class BatchMeasurements:
             object_variables = walk_metadata(list(self.objects)[-1]) # TODO : deal with what happens if they don't have the same # of vars?
 
             key_csv = experiment_csv.replace('.csv','_key.csv')
-            with open(key_csv, 'w') as csvfile:
-                spamwriter = csv.writer(csvfile,delimiter=',')
-                spamwriter.writerow(['Label'] + list(object_variables))
-                for obj in self.objects:
-                    spamwriter.writerow([obj.uid] + walk_metadata(obj, ret_val=True))
+            if filling_in and not os.path.exists(key_csv):
+                with open(key_csv, 'w') as csvfile:
+                    spamwriter = csv.writer(csvfile,delimiter=',')
+                    spamwriter.writerow(['Label'] + list(object_variables))
+                    for obj in self.objects:
+                        spamwriter.writerow([obj.uid] + walk_metadata(obj, ret_val=True))
 
             # now we have to ask them somehow to actually fill these in?
-            input(f"Add the data in {experiment_csv}. The key, if needed, is in {key_csv}. Enter when finished.")
-            
+            def fill_in():
+                backend = current_context().backend
+                if backend is None:
+                    blocking_input(f"Add the data in {experiment_csv}. The key, if needed, is in {key_csv}. Enter when finished.",
+                                   about=("sheet", experiment_csv))
+                else:
+                    # a simulated backend fills the sheet in itself
+                    with open(experiment_csv, 'w') as csvfile:
+                        spamwriter = csv.writer(csvfile)
+                        spamwriter.writerow(columns)
+                        for label in rows:
+                            spamwriter.writerow([label] + [backend.measure(csv_to_meas[col], csv_to_obj[label])
+                                                           for col in columns[1:]])
+                with open(experiment_csv, 'r') as csvfile:
+                    return csvfile.read()
+            filled_in = remember("measured", experiment_csv, fill_in)
+
             # now we need to strip all the answers back _out_ LOL
             recorded_values = {} # dict tuple[Measurement, RealWorldObject], float|str
-            with open(experiment_csv, 'r') as csvfile:
-                spamreader = csv.DictReader(csvfile, delimiter=',')
-                for row in spamreader:
-                    for col in row:
-                        mobj = None
-                        if col == 'Label':
-                            mobj = csv_to_obj[row[col]]
-                        else:
-                            meas = csv_to_meas[col]
-                            value = row[col]
-                            recorded_values[(mobj,meas)] = value
+            spamreader = csv.DictReader(io.StringIO(filled_in), delimiter=',')
+            for row in spamreader:
+                for col in row:
+                    mobj = None
+                    if col == 'Label':
+                        mobj = csv_to_obj[row[col]]
+                    else:
+                        meas = csv_to_meas[col]
+                        value = row[col]
+                        recorded_values[(mobj,meas)] = value
             return recorded_values
         else:
             FlowChart().add_instruction(self.instruction())
@@ -139,11 +166,14 @@ class BatchMeasurements:
     def how_many(self) -> int:
         return len(self.objects) * len(self.measurements)
 
+# eq=False keeps identity equality; each instance gets its own rows and cols,
+# so separate experiments (and threads) don't write into each other's data
+@dataclass(eq=False)
 class ImmediateMeasurements:
-    objects: list[RealWorldObject] = [] # rows
-    measurements: list[Measurement] = [] # cols
+    objects: list[RealWorldObject] = field(default_factory=list) # rows
+    measurements: list[Measurement] = field(default_factory=list) # cols
     csv: str = None
-    data_points: dict[RealWorldObject,dict[Measurement,float|str]] = {}
+    data_points: dict[RealWorldObject,dict[Measurement,float|str]] = field(default_factory=dict)
 
     @staticmethod
     def empty() -> "ImmediateMeasurements":
@@ -207,14 +237,15 @@ class ImmediateMeasurements:
         measured = ''
         from control import MODE, Execute
         if isinstance(MODE, Execute):
-            measured = input(f"what is the value of {meas} for object #{obj.uid}?")
+            measured = ask(f"what is the value of {meas} for object #{obj.uid}?", about=("measure", meas, obj))
             self.data_points[obj][meas] = measured
         else:
-            FlowChart().add_instruction(f"measure {meas} for object #{obj.uid}")
+            # the instrument's procedure instruction already counts as the measurement
+            FlowChart().add_instruction("measure {} for object #{}", args=(meas, obj.uid), uids=(obj.uid,))
         return measured
 
     def __add__(self, other: "BatchMeasurements") -> "ImmediateMeasurements":
-        self.do_measure(other.objects.pop(), other.measurements.pop()) # TODO I.... don't like this :joy:
+        self.do_measure(other.objects.popitem()[0], other.measurements.popitem()[0]) # TODO I.... don't like this :joy:
         return self
 
     def get_all_data(self) -> dict[tuple[Measurement, RealWorldObject], float|str]:
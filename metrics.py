@@ -0,0 +1,176 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from console import classify
+from context import current_context
+
+# runtime metrics: with @fedt_experiment(metrics=True), an Execute run keeps histograms of
+# where its time goes, and writes them to fedt-<experiment>.metrics.prom (Prometheus' text
+# format, for a node exporter's textfile collector or just reading) or, for metrics="x.json",
+# as JSON. they're written when the run ends, however it ends.
+#
+#   fedt_operator_wait_seconds{kind, device}      from a prompt being asked to its answer, by what
+#                                                 it's about, as console.classify sorts it
+#                                                 (an instruction for the Laser, a file...)
+#   fedt_measurement_entry_seconds{measurement}   from asking for a measurement to getting it
+#   fedt_machine_seconds{device, program}         machine software (visicut, PrusaSlicer) running
+#   fedt_device_call_seconds{call, device}        each call the experiment makes on a device or
+#                                                 instrument class (Laser.fab, Scale.measure_weight)
+#   fedt_prompt_queue_depth                       how many prompts were already waiting when one was asked
+#   fedt_machine_failures_total{device, program}  machine software that exited with an error
+#
+# prompts and machine runs replayed from a journal take no time and aren't counted. with
+# concurrent=True, a prompt's wait includes the time it spent queued behind other prompts.
+
+SECONDS_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 4 * 3600, 24 * 3600)
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+HELP = {
+    "fedt_operator_wait_seconds": "Time from asking the operator something to their answer.",
+    "fedt_measurement_entry_seconds": "Time from asking for a measurement to its value being entered.",
+    "fedt_machine_seconds": "Time machine software took to run.",
+    "fedt_device_call_seconds": "Time each call on a device or instrument class took.",
+    "fedt_prompt_queue_depth": "Prompts already waiting for an operator when one was asked.",
+    "fedt_machine_failures_total": "Machine software runs that exited with an error.",
+}
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets) # cumulative, like Prometheus: observations <= each bound
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels: tuple[tuple[str, str], ...], **more) -> str:
+    pairs = list(labels) + list(more.items())
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _bound(bound: float) -> str:
+    return "+Inf" if math.isinf(bound) else f"{bound:g}"
+
+
+class Metrics:
+    """The counters and histograms of one Execute run."""
+
+    def __init__(self):
+        self.histograms: dict[str, dict[tuple, _Histogram]] = {}
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name: str, value: float, buckets: tuple = SECONDS_BUCKETS, **labels):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = _Histogram(buckets)
+            series[key].observe(value)
+
+    def count(self, name: str, amount: float = 1, **labels):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def totals(self, name: str) -> dict[str, float]:
+        """Total seconds (or whatever name measures) per series of one histogram, biggest first."""
+        with self.lock:
+            out = {_labels(k) or name: x.sum for k, x in self.histograms.get(name, {}).items()}
+        return dict(sorted(out.items(), key=lambda x: -x[1]))
+
+    def prometheus(self) -> str:
+        lines = []
+        with self.lock:
+            for name, series in self.histograms.items():
+                lines += [f"# HELP {name} {HELP.get(name, name)}", f"# TYPE {name} histogram"]
+                for key, x in series.items():
+                    for bound, count in zip(x.buckets + (math.inf,), x.counts + [x.count]):
+                        lines.append(f"{name}_bucket{_labels(key, le=_bound(bound))} {count}")
+                    lines.append(f"{name}_sum{_labels(key)} {x.sum:.6g}")
+                    lines.append(f"{name}_count{_labels(key)} {x.count}")
+            for name, series in self.counters.items():
+                lines += [f"# HELP {name} {HELP.get(name, name)}", f"# TYPE {name} counter"]
+                for key, value in series.items():
+                    lines.append(f"{name}{_labels(key)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def as_json(self) -> dict:
+        with self.lock:
+            out = {}
+            for name, series in self.histograms.items():
+                out[name] = {"type": "histogram", "help": HELP.get(name, name), "series": [
+                    {"labels": dict(key), "sum": x.sum, "count": x.count,
+                     "buckets": {_bound(b): c for b, c in zip(x.buckets + (math.inf,), x.counts + [x.count])}}
+                    for key, x in series.items()]}
+            for name, series in self.counters.items():
+                out[name] = {"type": "counter", "help": HELP.get(name, name),
+                             "series": [{"labels": dict(key), "value": value} for key, value in series.items()]}
+        return out
+
+    def write(self, file_name: str):
+        # written to the side and moved into place, so a collector never reads half a file
+        partial = file_name + ".partial"
+        with open(partial, "w") as f:
+            if file_name.endswith(".json"):
+                json.dump(self.as_json(), f, indent=1)
+            else:
+                f.write(self.prometheus())
+        os.replace(partial, file_name)
+
+
+def _about(about: tuple | None, shared: bool) -> tuple[str, dict]:
+    # which histogram a prompt's wait goes in, and its labels, from how the console sorts it
+    _, kind, device = classify(about, shared)
+    if kind == "measurement":
+        return "fedt_measurement_entry_seconds", {"measurement": about[1].name if about[0] == "measure" else "sheet"}
+    return "fedt_operator_wait_seconds", {"kind": kind, "device": device}
+
+
+@contextmanager
+def prompt_timed(about: tuple | None, shared: bool, waiting: int):
+    # around asking the operator something; waiting is how many prompts are already queued
+    metrics = current_context().metrics
+    if metrics is None:
+        yield
+        return
+    metrics.observe("fedt_prompt_queue_depth", waiting, DEPTH_BUCKETS)
+    name, labels = _about(about, shared)
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        metrics.observe(name, time.monotonic() - start, **labels)
+
+
+@contextmanager
+def machine_timed(command: list, device: type | None):
+    # around running machine software
+    metrics = current_context().metrics
+    if metrics is None:
+        yield
+        return
+    labels = {"device": getattr(device, "__name__", ""), "program": os.path.basename(str(command[0])) if command else ""}
+    start = time.monotonic()
+    try:
+        yield
+    except Exception:
+        metrics.count("fedt_machine_failures_total", **labels)
+        raise
+    finally:
+        metrics.observe("fedt_machine_seconds", time.monotonic() - start, **labels)
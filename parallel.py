@@ -0,0 +1,217 @@
+import os
+import pickle
+import random
+import sys
+import threading
+
+import control
+from context import current_context
+from flowchart import FlowChart, FlowChartSink
+
+# process-parallel evaluation: with @fedt_experiment(processes=N), a top-level Parallel loop
+# runs its first iteration as usual, then forks N workers that each run a contiguous chunk of
+# the remaining iterations from there. a worker records what it tells the flowchart (like
+# incremental.py does) and sends that back with the loop's outputs; the parent plays the
+# recordings back in iteration order, so the flowchart comes out the same as evaluating the
+# loop in one process.
+#
+# uids: every worker is started where its uids would be in a sequential run, assuming each
+# iteration uses as many as the first one did. if any iteration doesn't (or a worker fails, or
+# the outputs can't be merged), the workers' results are thrown away and the parent runs the
+# rest of the loop itself. the same happens if a worker changes any of the experiment's
+# variables the loop reads (other than its outputs), or draws random numbers: then the
+# iterations weren't independent, e.g. each one made a new version of the same object.
+#
+# outputs are the experiment's variables the loop uses that are used again after it. one that
+# the loop assigns to keeps the last worker's value; otherwise lists, sets, dicts and numbers
+# are added up from what each worker added, types in MERGERS are combined with their function,
+# and anything else must come back unchanged. changes to module or class level state in a
+# worker are lost.
+
+IN_WORKER = False
+
+
+class _DiscardSink(FlowChartSink):
+    # what a worker's flowchart writes to: it starts in the middle of the loop, and the parent's
+    # sink may be writing to a file, so everything goes in the recording only
+
+    def repeat_body(self, values, name: str):
+        pass
+
+
+def _shared_state(inputs) -> bytes:
+    # what a worker mustn't change: the loop's inputs, and the random number generators
+    numpy = sys.modules.get("numpy")
+    return pickle.dumps((inputs(), random.getstate(), numpy.random.get_state() if numpy else None))
+
+
+def _merge_list(before, after):
+    merged = list(before)
+    for x in after:
+        if pickle.dumps(x[:len(before)]) != pickle.dumps(before):
+            raise ValueError("a worker changed items that were in the list before the loop")
+        merged += x[len(before):]
+    return merged
+
+
+def _merge_set(before, after):
+    return set(before).union(*after)
+
+
+def _merge_dict(before, after):
+    merged = dict(before)
+    for x in after:
+        merged.update(x)
+    return merged
+
+
+def _merge_number(before, after):
+    return before + sum(x - before for x in after)
+
+
+def _merge_measurements(before, after):
+    merged = before
+    for x in after:
+        merged = merged + x
+    return merged
+
+
+def _mergers():
+    from measurement import BatchMeasurements
+    return {list: _merge_list, set: _merge_set, dict: _merge_dict, int: _merge_number,
+            float: _merge_number, BatchMeasurements: _merge_measurements}
+
+
+MERGERS = None # type -> function(value before the workers, [value from each worker])
+
+
+def _merge(before, after):
+    global MERGERS
+    if MERGERS is None:
+        MERGERS = _mergers()
+    merge = MERGERS.get(type(before))
+    if merge is not None and all(type(x) is type(before) for x in after):
+        return merge(before, after)
+    unchanged = pickle.dumps(before)
+    if all(pickle.dumps(x) == unchanged for x in after):
+        return before
+    raise ValueError(f"can't merge {type(before).__name__} values from workers")
+
+
+class ParallelLoop:
+
+    def __init__(self, processes: int, outputs, inputs, assigned: frozenset[str]):
+        self.processes = processes
+        self.outputs_now = outputs # lambda: {name: value} for the loop's outputs
+        self.inputs_now = inputs # and for the other variables it reads
+        self.assigned = assigned
+        self.forked = False
+        self.outputs = None
+        self.random_state = None
+
+    def iterations(self, iterable):
+        """The values this process should run the loop body for."""
+        # (a rehearsal, like DevicePool.plan, has to see every fab() call in this process)
+        if IN_WORKER or self.processes < 2 or not hasattr(os, "fork") or iterable.kind() != "parallel" \
+                or isinstance(control.MODE, control.Execute) or current_context().rehearsing:
+            yield from iterable
+            return
+        values = list(iterable)
+        if len(values) < 3:
+            yield from values
+            return
+
+        context = current_context()
+        start = (context.physical_uids.peek(), context.virtual_uids.peek())
+        yield values[0]
+        after_first = (context.physical_uids.peek(), context.virtual_uids.peek())
+        per_iteration = (after_first[0] - start[0], after_first[1] - start[1])
+        try:
+            before = self.outputs_now()
+            pickle.dumps(before)
+            shared = _shared_state(self.inputs_now)
+        except (NameError, pickle.PicklingError, TypeError, AttributeError, RecursionError):
+            yield from values[1:]
+            return
+
+        self.random_state = random.getstate()
+        rest = values[1:]
+        size = -(-len(rest) // self.processes)
+        chunks = [(i, rest[i:i + size]) for i in range(0, len(rest), size)]
+        workers = []
+        for first, chunk in chunks:
+            read_end, write_end = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_end)
+                yield from self._work(first + 1, chunk, after_first, per_iteration, shared, write_end)
+                return # not reached; _work exits the process
+            os.close(write_end)
+            workers.append((pid, read_end))
+
+        results = []
+        for pid, read_end in workers:
+            with os.fdopen(read_end, "rb") as pipe:
+                try:
+                    results.append(pickle.load(pipe))
+                except (EOFError, pickle.UnpicklingError):
+                    results.append(None)
+            os.waitpid(pid, 0)
+
+        try:
+            if any(x is None for x in results):
+                raise ValueError("a worker failed")
+            outputs = {}
+            for name, value in before.items():
+                after = [x[1][name] for x in results]
+                outputs[name] = after[-1] if name in self.assigned else _merge(value, after)
+        except (ValueError, TypeError, KeyError, RecursionError):
+            yield from rest
+            return
+
+        flowchart = FlowChart()
+        for calls, _, spans in results:
+            for method, args, kwargs in calls:
+                getattr(flowchart, method)(*args, **kwargs)
+            if context.tracer is not None:
+                context.tracer.events += spans
+        context.physical_uids.value = after_first[0] + per_iteration[0] * len(rest)
+        context.virtual_uids.value = after_first[1] + per_iteration[1] * len(rest)
+        self.outputs = outputs
+        self.forked = True
+
+    def _work(self, index: int, chunk: list, after_first: tuple, per_iteration: tuple, shared: bytes,
+              write_end: int):
+        global IN_WORKER
+        IN_WORKER = True
+        random.setstate(self.random_state) # which fork reseeds
+        context = current_context()
+        for counter in (context.physical_uids, context.virtual_uids):
+            counter.lock = threading.Lock()
+        physical = after_first[0] + per_iteration[0] * (index - 1)
+        virtual = after_first[1] + per_iteration[1] * (index - 1)
+        context.physical_uids.value, context.virtual_uids.value = physical, virtual
+        flowchart = FlowChart()
+        flowchart.recording = calls = []
+        flowchart.use_sink(_DiscardSink())
+        spans = len(context.tracer.events) if context.tracer is not None else 0
+        result = None
+        try:
+            for value in chunk:
+                yield value
+                physical += per_iteration[0]
+                virtual += per_iteration[1]
+                if (context.physical_uids.peek(), context.virtual_uids.peek()) != (physical, virtual):
+                    break
+            else:
+                if _shared_state(self.inputs_now) == shared:
+                    result = (calls, self.outputs_now(),
+                              context.tracer.events[spans:] if context.tracer is not None else [])
+        finally:
+            # also reached when the loop body raises, so a worker never runs on past the loop
+            try:
+                with os.fdopen(write_end, "wb") as pipe:
+                    pickle.dump(result, pipe)
+            except Exception:
+                pass
+            os._exit(0)
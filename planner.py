@@ -0,0 +1,203 @@
+from dataclasses import dataclass, field
+
+from context import current_context, experiment_context
+from instruction import note
+
+# changeover planning: Parallel iterations can be done in any order, so before executing a
+# sweep, plan_changeovers(experiment) evaluates it once and notes what each iteration sets up
+# on which machine (the material in the laser, the filament in the printer, the focal
+# height, ...). each Parallel loop's iterations are then put in an order that keeps those
+# changes down: starting from how the machines were left, always the iteration that is
+# cheapest to change over to next, counting its inner loops in the order they'd be planned
+# from there. executing the experiment afterwards runs every Parallel loop in its planned
+# order.
+#
+# what a change costs is looked up in CHANGEOVER_MINUTES by device and setting; settings that
+# aren't in there are free to change. loops are matched to the plan by where they are in the
+# experiment and what they loop over, so a loop whose values come out differently when
+# executed runs in its written order. loops inside iterations that engine.py runs side by
+# side keep their written order too.
+
+CHANGEOVER_MINUTES: dict[str, dict[str, float]] = {
+    "Laser": {"material": 10, "thickness": 5, "focal_height_mm": 5},
+    "Printer": {"material": 10, "nozzle": 15, "temperature": 3, "bed_heating": 3},
+    "KnittingMachine": {"yarn": 15, "number of yarns/colors": 20, "tension": 2},
+}
+
+
+@dataclass
+class _Loop:
+    values: str # repr of what it looped over when it was planned
+    iterations: list[list] # per value, in the written order: its setups and inner _Loops
+    order: list[int] | None = None
+
+
+@dataclass
+class _Frame:
+    # a Parallel loop that is running
+    key: tuple
+    loop: _Loop | None
+    current: int = 0
+    started: dict[int, int] = field(default_factory=dict) # inner loops started, per iteration
+
+
+class ChangeoverPlan:
+
+    def __init__(self, costs: dict[str, dict[str, float]]):
+        self.costs = costs
+        self.collecting = True
+        self.top: list = [] # setups and loops outside any Parallel loop
+        self.loops: dict[tuple, _Loop] = {}
+        self.frames: list[_Frame] = []
+        self.top_loops = 0
+        self.run = None # the context of the experiment call the loops are counted in
+        self.written_minutes = 0.
+        self.planned_minutes = 0.
+        self.memo: dict[tuple, tuple[float, dict]] = {}
+
+    def _items(self) -> list:
+        # where what's happening now goes
+        if not self.frames:
+            return self.top
+        frame = self.frames[-1]
+        return frame.loop.iterations[frame.current]
+
+    def setup(self, device: str, settings: dict):
+        costed = self.costs.get(device)
+        if self.collecting and costed:
+            self._items().append((device, {k: settings[k] for k in costed if k in settings}))
+
+    def iterate(self, values: list):
+        if self.frames:
+            parent = self.frames[-1]
+            number = parent.started.get(parent.current, 0)
+            parent.started[parent.current] = number + 1
+            key = parent.key + ((parent.current, number),)
+        else:
+            context = current_context()
+            if context is not self.run:
+                self.run, self.top_loops = context, 0
+            key = ((None, self.top_loops),)
+            self.top_loops += 1
+        if self.collecting:
+            loop = _Loop(repr(values), [[] for _ in values])
+            self._items().append(loop)
+            self.loops[key] = loop
+            order = range(len(values))
+        else:
+            loop = self.loops.get(key)
+            if loop is None or loop.values != repr(values) or loop.order is None:
+                order = range(len(values))
+            else:
+                order = loop.order
+                if order != sorted(order):
+                    note("doing these in the order {} to save setup changes", args=([values[i] for i in order],))
+        frame = _Frame(key, loop)
+        self.frames.append(frame)
+        try:
+            for i in order:
+                frame.current = i
+                yield values[i]
+        finally:
+            self.frames.remove(frame)
+
+    # planning
+
+    def _changeovers(self, state: dict, setups: list) -> tuple[float, dict]:
+        state = dict(state)
+        minutes = 0.
+        for device, settings in setups:
+            for name, value in settings.items():
+                before = state.get((device, name))
+                if before is not None and before != value:
+                    minutes += self.costs[device][name]
+                state[(device, name)] = value
+        return minutes, state
+
+    def _flatten(self, items: list, planned: bool) -> list:
+        setups = []
+        for item in items:
+            if isinstance(item, _Loop):
+                order = item.order if planned and item.order is not None else range(len(item.iterations))
+                for i in order:
+                    setups += self._flatten(item.iterations[i], planned)
+            else:
+                setups.append(item)
+        return setups
+
+    def _run(self, items: list, state: dict, keep: bool) -> tuple[float, dict]:
+        # the fewest changeover minutes for items from state (and the state after), ordering
+        # their loops on the way; keep saves those orders
+        memo_key = (id(items), repr(sorted(state.items(), key=repr)))
+        if not keep and memo_key in self.memo:
+            return self.memo[memo_key]
+        minutes = 0.
+        after = state
+        for item in items:
+            if isinstance(item, _Loop):
+                loop_minutes, after = self._order(item, after, keep)
+            else:
+                loop_minutes, after = self._changeovers(after, [item])
+            minutes += loop_minutes
+        self.memo[memo_key] = (minutes, after)
+        return minutes, after
+
+    def _order(self, loop: _Loop, state: dict, keep: bool) -> tuple[float, dict]:
+        # nearest neighbour: next, always the iteration that's cheapest to do from here
+        remaining = list(range(len(loop.iterations)))
+        order = []
+        minutes = 0.
+        while remaining:
+            best = min(remaining, key=lambda i: (self._run(loop.iterations[i], state, False)[0], i))
+            remaining.remove(best)
+            order.append(best)
+            iteration_minutes, state = self._run(loop.iterations[best], state, keep)
+            minutes += iteration_minutes
+        if keep:
+            loop.order = order
+        return minutes, state
+
+    def plan(self):
+        self.written_minutes = self._changeovers({}, self._flatten(self.top, False))[0]
+        self.planned_minutes = self._run(self.top, {}, True)[0]
+        self.memo.clear()
+        self.collecting = False
+        self.run = None
+
+    def report(self) -> str:
+        return (f"setup changes: {self.written_minutes:.0f} minutes in the written order, "
+                f"{self.planned_minutes:.0f} minutes as planned")
+
+
+def setup_used(device, settings: dict):
+    # called by each fab(), so a rehearsal sees what every iteration sets up
+    plan = current_context().changeovers
+    if plan is not None:
+        plan.setup(getattr(device, "__name__", device), settings)
+
+
+def in_plan_order(parallel):
+    """The iterator a Parallel loop runs: in its planned order when executing a planned
+    experiment, and watched while planning it."""
+    context = current_context()
+    plan = context.changeovers
+    if plan is None or context.branch:
+        return parallel.iterator
+    from control import Execute
+    if not plan.collecting and not isinstance(context.mode, Execute):
+        return parallel.iterator
+    return plan.iterate(list(parallel.iterator))
+
+
+def plan_changeovers(experiment, *args, costs: dict[str, dict[str, float]] | None = None, **kwargs) -> ChangeoverPlan:
+    """Evaluates experiment(*args, **kwargs) to see what its Parallel iterations set up, orders
+    them to keep setup changes down, prints how much time that saves, and keeps the plan for
+    the next run of the experiment."""
+    context = current_context()
+    plan = ChangeoverPlan(CHANGEOVER_MINUTES if costs is None else costs)
+    with experiment_context(context.rehearsal(changeovers=plan)):
+        experiment(*args, **kwargs)
+    plan.plan()
+    print(plan.report())
+    context.changeovers = plan
+    return plan
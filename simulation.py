@@ -0,0 +1,253 @@
+import heapq
+from collections import deque
+from dataclasses import dataclass, field
+
+# simulation: with control.MODE = Simulate(), calling an experiment evaluates it as usual (the
+# flowchart XML is written too), and also works out how long executing it would take. every
+# step the flowchart is given becomes a task: an instruction is OPERATOR_MINUTES of an
+# operator's time, a measurement is MEASUREMENT_MINUTES of it, fabricating an object keeps its
+# machine busy for the job's minutes= setting (or DevicePool.minutes for that kind of machine),
+# and an Environment wait holds its objects back without keeping anyone busy. notes (like
+# "this creates physical object #3") take no time.
+#
+# tasks follow each other in the order the experiment gives them, except that the iterations
+# of a Parallel loop all start together, and the loop is over once all of them are; a task on
+# an object also waits for the last task on that object. the tasks are then run through a
+# discrete-event simulation for each staffing level asked for (Simulate(operators=(1, 3))),
+# with one of each machine, or the ones declared in DevicePool at their speeds. tasks that
+# are ready queue for an operator or their machine in the order they became ready.
+#
+# each run reports the total time, the critical path (the chain of tasks ending with the last
+# one, each held up by the one before it, or by whoever was using its machine), how long every
+# machine and operator sat idle, and the longest queue each kind had. symbolic evaluation
+# doesn't run every iteration, so @fedt_experiment won't simulate a symbolic experiment.
+
+OPERATOR_MINUTES = 2. # an instruction the operator carries out
+MEASUREMENT_MINUTES: dict[str, float] = {} # by Measurement name
+DEFAULT_MEASUREMENT_MINUTES = 3.
+DEFAULT_FAB_MINUTES = 60. # for machines that aren't in DevicePool.minutes
+
+OPERATOR = "operator"
+WAIT = "waiting"
+
+
+@dataclass
+class _Frame:
+    parallel: bool
+    start: int | None # the task the loop's iterations come after
+    ends: list[int] = field(default_factory=list) # the last task of each finished iteration
+
+
+def _duration(minutes: float) -> str:
+    if minutes >= 2 * 24 * 60:
+        return f"{minutes / (24 * 60):.1f} days"
+    if minutes >= 2 * 60:
+        return f"{minutes / 60:.1f} hours"
+    return f"{minutes:.0f} minutes"
+
+
+class Simulation:
+    """The tasks of one simulated experiment call, as the flowchart is given them."""
+
+    def __init__(self):
+        self.resources: list[object] = [] # per task: OPERATOR, a device class, or None
+        self.minutes: list[float] = []
+        self.deps: list[tuple[int, ...]] = []
+        self.labels: list[tuple[str, tuple]] = [] # (template, args), formatted when reported
+        self.tail: int | None = None # the last task of the iteration we're in
+        self.last_on: dict[int, int] = {} # uid -> the last task on that object
+        self.frames: list[_Frame] = []
+
+    def _task(self, resource, minutes: float, label: tuple[str, tuple], uids=(), deps=None) -> int:
+        if deps is None:
+            deps = [] if self.tail is None else [self.tail]
+        for uid in uids:
+            last = self.last_on.get(uid)
+            if last is not None and last not in deps:
+                deps.append(last)
+        task = len(self.minutes)
+        self.resources.append(resource)
+        self.minutes.append(float(minutes))
+        self.deps.append(tuple(deps))
+        self.labels.append(label)
+        self.tail = task
+        for uid in uids:
+            self.last_on[uid] = task
+        return task
+
+    # what FlowChart passes on
+
+    def add_instruction(self, template: str, args: tuple, header: bool, fabbing: bool, device, measurement,
+                        uids, kwargs: dict):
+        label = (template, args)
+        if fabbing:
+            if device is None:
+                self._task(OPERATOR, OPERATOR_MINUTES, label, uids)
+                return
+            from lib import DevicePool
+            minutes = kwargs.get("minutes")
+            if minutes is None:
+                minutes = DevicePool.minutes.get(device, DEFAULT_FAB_MINUTES)
+            self._task(device, minutes, label, uids)
+        elif header or kwargs.get("attended") is False:
+            return
+        elif kwargs.get("wait_minutes") is not None:
+            self._task(None, kwargs["wait_minutes"], label, uids)
+        elif measurement is not None:
+            name = getattr(measurement, "name", measurement)
+            self._task(OPERATOR, MEASUREMENT_MINUTES.get(name, DEFAULT_MEASUREMENT_MINUTES), label, uids)
+        else:
+            self._task(OPERATOR, OPERATOR_MINUTES, label, uids)
+
+    def enter_loop(self, kind: str):
+        self.frames.append(_Frame(kind == "parallel", self.tail))
+
+    def end_body(self):
+        frame = self.frames[-1]
+        if frame.parallel:
+            frame.ends.append(self.tail)
+            self.tail = frame.start
+
+    def exit_loop(self):
+        frame = self.frames.pop()
+        if not frame.parallel:
+            return
+        if self.tail != frame.start:
+            frame.ends.append(self.tail) # broken out of partway through a body
+        ends = list(dict.fromkeys(x for x in frame.ends if x is not None))
+        if len(ends) > 1:
+            self._task(None, 0., ("end of a parallel loop", ()), deps=ends)
+        else:
+            self.tail = ends[0] if ends else frame.start
+
+    # running it
+
+    def _units(self, resource, operators: int) -> list[tuple[str, float]]:
+        # (name, speed) of each operator or machine that can do the resource's tasks
+        if resource is OPERATOR:
+            return [(f"operator {i + 1}", 1.) for i in range(operators)]
+        from lib import DevicePool
+        declared = DevicePool.instances.get(resource)
+        if declared:
+            return [(x.name, x.speed) for x in declared]
+        return [(getattr(resource, "__name__", str(resource)), 1.)]
+
+    def run(self, operators: int = 1) -> "SimulationResult":
+        """Simulates executing the tasks with this many operators."""
+        count = len(self.minutes)
+        waiting = [len(x) for x in self.deps]
+        after: list[list[int]] = [[] for _ in range(count)]
+        for task, deps in enumerate(self.deps):
+            for x in deps:
+                after[x].append(task)
+        start = [0.] * count
+        ready = [0.] * count
+        cause: list[int | None] = [None] * count
+        unit_of: list[int | None] = [None] * count
+        units: dict[object, list[tuple[str, float]]] = {}
+        free: dict[object, list[int]] = {}
+        queues: dict[object, deque[int]] = {}
+        last_on_unit: dict[tuple[object, int], int] = {}
+        busy: dict[str, float] = {}
+        peak: dict[object, int] = {}
+        finishes: list[tuple[float, int]] = []
+
+        def begin(task: int, now: float, unit: int | None, speed: float):
+            start[task] = now
+            unit_of[task] = unit
+            heapq.heappush(finishes, (now + self.minutes[task] / speed, task))
+
+        def dispatch(resource, now: float):
+            queue = queues[resource]
+            idle = free[resource]
+            while queue and idle:
+                task = queue.popleft()
+                unit = max(idle, key=lambda x: (units[resource][x][1], -x))
+                idle.remove(unit)
+                if now > ready[task]:
+                    cause[task] = last_on_unit.get((resource, unit), cause[task])
+                begin(task, now, unit, units[resource][unit][1])
+
+        def make_ready(task: int, now: float):
+            ready[task] = now
+            resource = self.resources[task]
+            if resource is None:
+                begin(task, now, None, 1.)
+                return
+            if resource not in units:
+                units[resource] = self._units(resource, operators)
+                free[resource] = list(range(len(units[resource])))
+                queues[resource] = deque()
+                peak[resource] = 0
+                for name, _ in units[resource]:
+                    busy[name] = 0.
+            queues[resource].append(task)
+            peak[resource] = max(peak[resource], len(queues[resource]))
+            dispatch(resource, now)
+
+        for task in range(count):
+            if not waiting[task]:
+                make_ready(task, 0.)
+        end, last = 0., None
+        while finishes:
+            now, task = heapq.heappop(finishes)
+            end, last = now, task
+            resource = self.resources[task]
+            if resource is not None:
+                unit = unit_of[task]
+                busy[units[resource][unit][0]] += now - start[task]
+                free[resource].append(unit)
+                last_on_unit[(resource, unit)] = task
+            for x in after[task]:
+                waiting[x] -= 1
+                if not waiting[x]:
+                    cause[x] = task
+                    make_ready(x, now)
+            if resource is not None:
+                dispatch(resource, now)
+
+        path = []
+        while last is not None:
+            path.append(last)
+            last = cause[last]
+        path.reverse()
+        return SimulationResult(self, operators, end, busy, {k: end - v for k, v in busy.items()},
+                                {getattr(k, "__name__", k): v for k, v in peak.items()}, path)
+
+
+@dataclass
+class SimulationResult:
+    simulation: Simulation
+    operators: int
+    minutes: float # from the first task starting to the last one finishing
+    busy: dict[str, float] # minutes, per operator and machine
+    idle: dict[str, float]
+    peak_queue: dict[str, int] # the most tasks ever waiting, per kind of machine and for operators
+    critical_path: list[int] # task numbers, first to last
+
+    def critical_minutes(self) -> dict[str, float]:
+        """Where the time on the critical path goes: per kind of machine, operators and waits."""
+        out: dict[str, float] = {}
+        for task in self.critical_path:
+            resource = self.simulation.resources[task]
+            name = WAIT if resource is None else getattr(resource, "__name__", resource)
+            out[name] = out.get(name, 0.) + self.simulation.minutes[task]
+        return dict(sorted(out.items(), key=lambda x: -x[1]))
+
+    def step(self, task: int) -> str:
+        template, args = self.simulation.labels[task]
+        return template.format(*args) if args else template
+
+    def report(self) -> str:
+        staff = f"{self.operators} operator{'s' if self.operators != 1 else ''}"
+        lines = [f"with {staff}: {_duration(self.minutes)} for {len(self.simulation.minutes)} tasks"]
+        spent = ", ".join(f"{_duration(v)} {k}" for k, v in self.critical_minutes().items() if v)
+        lines.append(f"  critical path: {len(self.critical_path)} tasks ({spent or 'nothing'})")
+        longest = max(self.critical_path, key=lambda x: self.simulation.minutes[x], default=None)
+        if longest is not None and self.simulation.minutes[longest]:
+            lines.append(f"    longest step on it: {self.step(longest)} ({_duration(self.simulation.minutes[longest])})")
+        for name, busy in self.busy.items():
+            lines.append(f"  {name}: {_duration(busy)} busy, {_duration(self.idle[name])} idle")
+        queues = ", ".join(f"{v} for {k}" for k, v in self.peak_queue.items())
+        lines.append(f"  longest queues: {queues or 'none'}")
+        return "\n".join(lines)
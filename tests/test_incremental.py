@@ -0,0 +1,54 @@
+import os
+import random
+
+import incremental
+from context import ExperimentContext, experiment_context
+from decorator import CACHE_DIR, fedt_experiment
+from iterators import Parallel
+from lib import *
+from measurement import BatchMeasurements, ImmediateMeasurements
+
+
+@fedt_experiment(sink="count", incremental=True)
+def laser_sweep(empty, kept: list):
+    sizes = empty()
+    for power in Parallel(range(10, 100, 10)):
+        for speed in Parallel(range(1, 4)):
+            cut = Laser.fab(GeometryFile('square.svg'), material='wood', power=power, speed=speed)
+            sizes += Calipers.measure_size(cut, "width")
+
+    kept.append(sizes)
+
+
+def evaluate_twice(empty, monkeypatch):
+    incremental.clear_loop_cache(os.path.join(os.path.dirname(__file__), CACHE_DIR))
+    replayed = []
+    replay = incremental.LoopCache.replay
+    monkeypatch.setattr(incremental.LoopCache, "replay", lambda self: replayed.append(replay(self)) or replayed[-1])
+
+    runs = []
+    for _ in range(2):
+        kept = []
+        random.seed(0)
+        with experiment_context(ExperimentContext()):
+            laser_sweep(empty, kept)
+        runs.append((kept[0], laser_sweep.last_index.summary()))
+    return replayed, runs
+
+
+def test_batch_measuring_loop_replays(monkeypatch):
+    replayed, (first, second) = evaluate_twice(BatchMeasurements.empty, monkeypatch)
+
+    assert replayed == [False, True]
+    assert first[1] == second[1]
+    assert list(first[0].objects) == list(second[0].objects)
+    assert first[0].instruction() == second[0].instruction()
+
+
+def test_immediate_measuring_loop_replays(monkeypatch):
+    replayed, (first, second) = evaluate_twice(ImmediateMeasurements.empty, monkeypatch)
+
+    assert replayed == [False, True]
+    assert first[1] == second[1]
+    assert first[0].how_many() == second[0].how_many() == 27
+    assert first[0].data_points == second[0].data_points
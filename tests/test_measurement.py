@@ -0,0 +1,68 @@
+import threading
+
+from context import ExperimentContext, experiment_context
+from decorator import fedt_experiment
+from iterators import Series
+from lib import *
+from measurement import BatchMeasurements, ImmediateMeasurements
+
+
+@fedt_experiment(sink="count")
+def paint_layers(kept: list):
+    photos = ImmediateMeasurements.empty()
+    for coats in Series(range(1, 4)):
+        flower = Laser.fab(GeometryFile('flower.svg'), material='wood')
+        flower = Human.post_process(flower, f"add {coats} coats of paint")
+        photos += Camera.take_picture(flower)
+
+    kept.append(photos)
+
+
+@fedt_experiment(sink="count")
+def measure_sizes(empty):
+    sizes = empty()
+    for width in Series(range(5)):
+        block = Laser.fab(GeometryFile(f'block{width}.svg'), material='wood')
+        sizes += Calipers.measure_size(block, "width")
+
+
+def test_immediate_measurements_twice_in_one_process():
+    first, second = [], []
+    with experiment_context(ExperimentContext()):
+        paint_layers(first)
+    with experiment_context(ExperimentContext()):
+        paint_layers(second)
+
+    assert first[0] is not second[0]
+    assert first[0].how_many() == second[0].how_many() == 3
+    assert [x.uid for x in first[0].objects] == [x.uid for x in second[0].objects]
+
+
+def test_immediate_measurements_in_threads():
+    kept, errors = [[] for _ in range(8)], []
+
+    def run(mine):
+        try:
+            with experiment_context(ExperimentContext()):
+                paint_layers(mine)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(x,)) for x in kept]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert all(x[0].how_many() == 3 for x in kept)
+    assert len({tuple(obj.uid for obj in x[0].objects) for x in kept}) == 1
+
+
+def test_immediate_and_batch_measurements_count_the_same():
+    measure_sizes(BatchMeasurements.empty)
+    batch = measure_sizes.last_index.measurement("size")
+    measure_sizes(ImmediateMeasurements.empty)
+    immediate = measure_sizes.last_index.measurement("size")
+
+    assert batch == immediate == 5
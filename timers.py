@@ -0,0 +1,106 @@
+import heapq
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+from context import current_context
+from engine import blocking_wait_until
+
+# timed waits: in Execute mode, Environment's waits go through a TimerQueue. each object's
+# clock starts the first time it's waited on, and a cohort (the objects of one wait) is due
+# once the last of their clocks has run long enough. the due times of every cohort are kept in
+# a heap, so a wait sleeps until the next deadline (nothing checks the clock in between), says
+# which cohorts have come due, and goes back to sleep until its own.
+#
+# a journaled experiment (see journal.py) keeps its queue in fedt-<experiment>.timers, rewritten
+# whenever it changes, so when it's started again after a crash its objects' clocks are still
+# running and it only waits for what's left. the clocks go with the journal: a run whose
+# journal has nothing to replay starts them over, and one without a journal keeps them in
+# memory. the file is deleted once the experiment finishes.
+# with concurrent=True (see engine.py), cohorts in different Parallel iterations age side by
+# side, and whichever branch wakes first tells the operator about the others.
+
+
+def _objects(uids: list[int]) -> str:
+    if not uids:
+        return "nothing"
+    return ("object #" if len(uids) == 1 else "objects #") + ", #".join(str(x) for x in uids)
+
+
+class TimerQueue:
+    """When each object started waiting, and a heap of the cohorts that aren't due yet."""
+
+    def __init__(self, path: str | None = None, resume: bool = True):
+        self.path = path
+        self.started: dict[str, str] = {} # uid -> when its clock started, isoformat
+        self.due: list[tuple[str, str, list[int]]] = [] # heap of (due, what for, uids)
+        self.lock = threading.Lock()
+        if path is not None and resume and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.started = saved["started"]
+            self.due = [tuple(x) for x in saved["due"]]
+            heapq.heapify(self.due)
+
+    def _save(self):
+        if self.path is None:
+            return
+        partial = self.path + ".partial"
+        with open(partial, "w") as f:
+            json.dump({"started": self.started, "due": self.due}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, self.path)
+
+    def schedule(self, uids: list[int], wait, label: str) -> datetime:
+        """When the cohort of uids is due: wait (a timedelta or relativedelta) after the last of
+        their clocks started. Clocks that haven't started start now."""
+        now = datetime.now().isoformat(timespec="seconds")
+        with self.lock:
+            starts = [self.started.setdefault(str(uid), now) for uid in uids] or [now]
+            due = (datetime.fromisoformat(max(starts)) + wait).isoformat(timespec="seconds")
+            entry = (due, label, list(uids))
+            if entry not in self.due:
+                heapq.heappush(self.due, entry)
+            self._save()
+        return datetime.fromisoformat(due)
+
+    def age(self, uid: int) -> timedelta:
+        """How long the object has been waiting, all told."""
+        started = self.started.get(str(uid))
+        return datetime.now() - datetime.fromisoformat(started) if started is not None else timedelta(0)
+
+    def _come_due(self) -> tuple[list, datetime | None]:
+        # the cohorts that are due now (taken off the heap), and the next deadline after them
+        now = datetime.now().isoformat(timespec="seconds")
+        with self.lock:
+            due = []
+            while self.due and self.due[0][0] <= now:
+                due.append(heapq.heappop(self.due))
+            if due:
+                self._save()
+            return due, datetime.fromisoformat(self.due[0][0]) if self.due else None
+
+    def wait(self, until: datetime):
+        """Sleeps until `until`, waking at each deadline on the way to say what's come due."""
+        while True:
+            due, deadline = self._come_due()
+            for _, label, uids in due:
+                print(f"{label} is up for {_objects(uids)}")
+            if datetime.now() >= until:
+                return
+            blocking_wait_until(until if deadline is None else min(deadline, until))
+
+    def finish(self):
+        # the experiment is done with these clocks
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+_UNSAVED = TimerQueue() # for waits outside a decorated experiment
+
+
+def timer_queue() -> TimerQueue:
+    timers = current_context().timers
+    return _UNSAVED if timers is None else timers
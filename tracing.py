@@ -0,0 +1,107 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import nullcontext
+
+from context import current_context
+
+# tracing: with @fedt_experiment(trace=True), the experiment's loops, their iterations and the
+# calls it makes on classes (Laser.fab, Printer.fab, Calipers.measure_size, ...) are timed as
+# spans, and written out as Chrome trace events next to the flowchart XML. open the file in
+# chrome://tracing or https://ui.perfetto.dev to see where evaluation (or execution) time goes.
+#
+# every span also counts how many more memory blocks python had allocated at its end than at
+# its start (sys.getallocatedblocks()), which points at the loops that build up big flowcharts.
+# iterations run in forked worker processes (processes=N) show up under their own pid.
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "category", "args", "start", "blocks")
+
+    def __init__(self, tracer: "Tracer", name: str, category: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.blocks = sys.getallocatedblocks()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+        self.args["allocated_blocks"] = sys.getallocatedblocks() - self.blocks
+        # complete ("X") events, in microseconds
+        self.tracer.events.append({"name": self.name, "cat": self.category, "ph": "X",
+                                   "ts": (self.start - self.tracer.origin) / 1000,
+                                   "dur": (end - self.start) / 1000,
+                                   "pid": os.getpid(), "tid": threading.get_ident(), "args": self.args})
+        return False
+
+
+class Tracer:
+    """The spans of one traced experiment call."""
+
+    def __init__(self):
+        self.origin = time.perf_counter_ns()
+        self.events: list[dict] = []
+
+    def span(self, name: str, category: str, args: dict | None = None) -> _Span:
+        return _Span(self, name, category, args or {})
+
+    def totals(self, category: str | None = None) -> dict[str, float]:
+        """Total milliseconds per span name (of one category, if given), biggest first."""
+        out: dict[str, float] = {}
+        for e in self.events:
+            if category is None or e["cat"] == category:
+                out[e["name"]] = out.get(e["name"], 0) + e["dur"] / 1000
+        return dict(sorted(out.items(), key=lambda x: -x[1]))
+
+    def write(self, file_name: str):
+        with open(file_name, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+def trace_span(name: str, category: str, **args):
+    # what the transformed experiment wraps its loops and iterations in
+    tracer = current_context().tracer
+    if tracer is None:
+        return nullcontext()
+    return tracer.span(name, category, args)
+
+
+def device_class(value) -> bool:
+    # a machine, design or slicing software, or an instrument (a class with Measurements, like
+    # Calipers): what FixLoops has time its calls, rather than every Name.attr(...) call
+    from design import ConfigSoftware, DesignSoftware, ToolpathSoftware
+    from fabricate import FabricationDevice, PostProcessDevice
+    from measurement import Measurement
+    if not isinstance(value, type):
+        return False
+    return issubclass(value, (FabricationDevice, PostProcessDevice, DesignSoftware, ConfigSoftware, ToolpathSoftware)) \
+        or any(isinstance(x, Measurement) for x in vars(value).values())
+
+
+def traced_call(owner, attribute: str):
+    # owner.attribute, timed if owner is a class (a device or measurement helper) and we're
+    # tracing or keeping metrics (see metrics.py)
+    function = getattr(owner, attribute)
+    context = current_context()
+    tracer, metrics = context.tracer, context.metrics
+    if (tracer is None and metrics is None) or not isinstance(owner, type):
+        return function
+    name = f"{owner.__name__}.{attribute}"
+
+    def call(*args, **kwargs):
+        start = time.monotonic()
+        try:
+            with tracer.span(name, "call", {}) if tracer is not None else nullcontext():
+                return function(*args, **kwargs)
+        finally:
+            if metrics is not None:
+                metrics.observe("fedt_device_call_seconds", time.monotonic() - start, call=name, device=owner.__name__)
+
+    return call